@@ -1,18 +1,47 @@
 import csv
-import requests
 import json
-from flask import Flask, jsonify, render_template_string, request
+from flask import Flask, Response, g, jsonify, render_template_string, request
 import time
-from math import radians, sin, cos, sqrt, atan2
-import urllib.request
-import zipfile
-import io
+from math import radians, sin, cos, sqrt, atan2, isfinite
 import os
-from concurrent.futures import ThreadPoolExecutor
-import base64
+import threading
+import requests
+from urllib.parse import urlparse
 from flask import send_from_directory
+from atm_cache import WaitTimeCache, shared_store_from_env
+from atm_client import ATMClient
+from app_logging import begin_request, configure_logging, debug_targets, get_logger, set_level, settings as log_settings
+from atm_fanout import LINE_FETCH_DEADLINE, FanOutEngine
+from gtfs_ingest import GTFS_DATA_DIR, ingest_gtfs
+from gtfs_snapshot import SNAPSHOT_PATH, open_snapshot, snapshot_key, write_snapshot
+from journey_planner import WALK_SPEED_MPS, JourneyPlanner
+from line_index import LineIndex
+from line_poller import LinePoller, RedisLinePollStore
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, registry as metrics
+from payload_cache import PayloadCache
+from shape_geometry import MAX_SHAPE_ZOOM, MIN_SHAPE_ZOOM, SHAPE_FORMATS, encode_polyline, format_paths, simplify_paths
+from spatial_index import StopSpatialIndex
+from stop_tiles import StopTileCache
+from timetable import Timetable
+from tracing import span_tree, tracer
+from vehicle_inference import AVERAGE_SPEEDS, infer_vehicles
 
 app = Flask(__name__)
+configure_logging()
+log = get_logger('app')
+
+# Instrumentation exposed on /metrics (the gauges read their sources at scrape time, see below)
+REQUEST_LATENCY = metrics.histogram('milanopt_http_request_duration_seconds', 'Time spent answering a request',
+                                    ('endpoint', 'method', 'status'))
+ATM_LATENCY = metrics.histogram('milanopt_atm_request_duration_seconds', 'Latency of one ATM proxy call', ('outcome',))
+ATM_RESPONSES = metrics.counter('milanopt_atm_responses_total', 'ATM proxy calls by HTTP status, or error/timeout', ('status',))
+ATM_PARSE_FAILURES = metrics.counter('milanopt_atm_parse_failures_total',
+                                     'ATM bodies (json) or wait messages (wait_message) that could not be parsed', ('kind',))
+FANOUT_LATENCY = metrics.histogram('milanopt_atm_fanout_duration_seconds', 'Duration of a line fan-out over its stops')
+FANOUT_MISSED = metrics.counter('milanopt_atm_fanout_missed_stops_total', 'Stops left out of a line fan-out by a failed fetch or its deadline')
+FANOUTS_IN_FLIGHT = metrics.gauge('milanopt_atm_fanouts_in_flight', 'Line fan-outs currently waiting on ATM')
+LINE_BUILD_LATENCY = metrics.histogram('milanopt_line_vehicle_build_seconds',
+                                       'Time /get_line_vehicle_data payloads spend fetching waits and building vehicles', ('phase',))
 
 # Add a route to serve vehicle images
 @app.route('/static/vehicle_images/<path:filename>')
@@ -25,129 +54,90 @@ line_paths = {}
 station_lines = {}
 routes = {}
 line_stations_memory = {}
-
-# Load stops data globally
-stops = []
-with open('stops_processed.csv', newline='', encoding='utf-8') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        stops.append({
-            "lat": float(row['stop_lat']),
-            "lon": float(row['stop_lon']),
-            "name": row['stop_name'],
-            "id": row['stop_id']
-        })
-
-def load_and_process_gtfs_data():
-    print("Full GTFS data processing initiated...")
-    global line_paths, station_lines, routes
-    line_paths = {}
-    station_lines = {}
-    routes = {}
-    
-    with open('given_data/routes.txt', 'r', encoding='utf-8') as f:
+stop_patterns = {}
+timetable = None
+journey_planner = None
+gtfs_snapshot = None
+line_index = LineIndex({})
+stop_index = StopSpatialIndex([])
+stop_tiles = StopTileCache(stop_index, b'')
+track_line_payloads = PayloadCache(b'')
+line_projection_payloads = PayloadCache(b'')
+
+# Files the GTFS snapshot is built from; changing any of them triggers a rebuild
+SNAPSHOT_INPUTS = [GTFS_DATA_DIR, 'stops_processed.csv', 'FINAL.json']
+
+def load_stops_csv():
+    stops_list = []
+    with open('stops_processed.csv', newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         for row in reader:
-            routes[row['route_id']] = {
-                'short_name': row['route_short_name'],
-                'type': row['route_type']
-            }
-    print(f"Loaded {len(routes)} routes.")
+            stops_list.append({
+                "lat": float(row['stop_lat']),
+                "lon": float(row['stop_lon']),
+                "name": row['stop_name'],
+                "id": row['stop_id']
+            })
+    return stops_list
 
-    stops_data = {}
-    with open('given_data/stops.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            stops_data[row['stop_id']] = {
-                'Y': float(row['stop_lat']),
-                'X': float(row['stop_lon']),
-                'name': row['stop_name']
-            }
-    print(f"Loaded {len(stops_data)} stops for processing.")
+def load_and_process_gtfs_data():
+    print("Full GTFS data processing initiated...")
 
-    shapes = {}
-    with open('given_data/shapes.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            shape_id = row['shape_id']
-            if shape_id not in shapes:
-                shapes[shape_id] = []
-            shapes[shape_id].append({'Y': float(row['shape_pt_lat']), 'X': float(row['shape_pt_lon']), 'seq': int(row['shape_pt_sequence'])})
-    
-    for shape_id in shapes:
-        shapes[shape_id].sort(key=lambda x: x['seq'])
-    print(f"Loaded {len(shapes)} shapes.")
+    # One streaming pass over the feed builds every structure, including the line stations memory
+    ingested = ingest_gtfs()
+    station_lines_built = ingested['station_lines']
 
-    trips_lookup = {}
-    with open('given_data/trips.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            trips_lookup[row['trip_id']] = {'route_id': row['route_id'], 'shape_id': row['shape_id']}
-    print(f"Loaded {len(trips_lookup)} trips for lookup.")
-
-    # Populate line_paths from shapes via trips
-    line_shapes_added = {}
-    for trip_id, trip_info in trips_lookup.items():
-        route_id = trip_info['route_id']
-        shape_id = trip_info['shape_id']
-
-        route_info = routes.get(route_id)
-        if not route_info:
-            continue
-
-        line_short_name = route_info['short_name']
-        route_type = route_info['type']
-        current_shape_points = shapes[shape_id]
-
-        # Use route_id as the primary key for line_paths (e.g., "M5", "T3", "B90")
-        if route_id not in line_paths:
-            line_paths[route_id] = []
-            line_shapes_added[route_id] = set()
-
-        if shape_id not in line_shapes_added[route_id]:
-            line_paths[route_id].append(current_shape_points)
-            line_shapes_added[route_id].add(shape_id)
-        
-        # Add route_short_name as a secondary key if it's different and unprefixed
-        # This handles cases where user might input just '5' for a Metro line that's 'M5' in GTFS
-        if route_id != line_short_name and not line_short_name.startswith(('M', 'T', 'B')):
-            if line_short_name not in line_paths:
-                line_paths[line_short_name] = []
-                line_shapes_added[line_short_name] = set()
-            
-            if shape_id not in line_shapes_added[line_short_name]:
-                line_paths[line_short_name].append(current_shape_points)
-                line_shapes_added[line_short_name].add(shape_id)
-
-    print(f"Populated {len(line_paths)} unique line paths.")
-    print(f"Available line_paths keys after processing: {sorted(list(line_paths.keys()))}") # Debug: print all keys
-
-    # Populate station_lines from stop_times
-    for row in csv.DictReader(open('given_data/stop_times.txt', 'r', encoding='utf-8')):
-        trip_id = row['trip_id']
-        stop_id = row['stop_id']
-
-        if trip_id in trips_lookup and stop_id in stops_data:
-            route_id_for_stop = trips_lookup[trip_id]['route_id']
-            # Use route_id to link lines to stations for consistency
-            # line_name_for_station will be the route_id itself (e.g., "M5", "B90")
-            line_name_for_station = route_id_for_stop # Use route_id directly as the line identifier
-            
-            if line_name_for_station:
-                if stop_id not in station_lines:
-                    station_lines[stop_id] = []
-                if line_name_for_station not in station_lines[stop_id]:
-                    station_lines[stop_id].append(line_name_for_station)
-    print(f"Populated {len(station_lines)} station lines.")
     print(f"Sample station_lines entries (first 5 stops):")
-    sample_stops = list(station_lines.keys())[:5]
+    sample_stops = list(station_lines_built.keys())[:5]
     for stop_id in sample_stops:
-        print(f"  Stop {stop_id}: {station_lines[stop_id]}")
+        print(f"  Stop {stop_id}: {station_lines_built[stop_id]}")
 
-    # Save to cache
-    with open('gtfs_cache.json', 'w') as f:
-        json.dump({'line_paths': line_paths, 'station_lines': station_lines}, f)
+    # Load line stations memory
+    try:
+        print("Attempting to load line stations memory from FINAL.json...")
+        with open('FINAL.json', 'r', encoding='utf-8') as f:
+            final_memory = json.load(f)
+        print(f"Loaded stations memory for {len(final_memory)} line entries from FINAL.json.")
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"Error loading stations memory from FINAL.json ({e}). Exiting...")
+        raise
+
+    # Save to the binary snapshot
+    write_snapshot(SNAPSHOT_PATH, snapshot_key(SNAPSHOT_INPUTS), ingested['routes'], ingested['line_paths'],
+                   station_lines_built, load_stops_csv(), final_memory, ingested['stop_patterns'],
+                   ingested['timetable'])
     print("GTFS data processed and cached successfully.")
+    return ingested
+
+def load_gtfs_snapshot():
+    """Map the GTFS snapshot (rebuilding it first if the feed changed) and expose it through the globals"""
+    global gtfs_snapshot, line_paths, station_lines, routes, line_stations_memory, line_index, stop_index, stop_tiles
+    global track_line_payloads, line_projection_payloads, stop_patterns, timetable, journey_planner
+    print("Attempting to load GTFS data from snapshot...")
+    key = snapshot_key(SNAPSHOT_INPUTS)
+    snapshot = open_snapshot(SNAPSHOT_PATH, key)
+    if snapshot is None:
+        print("Reprocessing GTFS data...")
+        load_and_process_gtfs_data()
+        snapshot = open_snapshot(SNAPSHOT_PATH, key)
+
+    gtfs_snapshot = snapshot
+    routes = snapshot.routes()
+    line_paths = snapshot.line_paths()
+    station_lines = snapshot.station_lines()
+    line_stations_memory = snapshot.line_stations_memory()
+    stop_patterns = snapshot.stop_patterns()
+    timetable = Timetable(snapshot)
+    journey_planner = JourneyPlanner(timetable, snapshot)
+    line_index = LineIndex(routes)
+    # Stops plus every line station, stored as columns when the snapshot was written
+    stop_index = StopSpatialIndex.from_columns(*snapshot.index_stops())
+    stop_tiles = StopTileCache(stop_index, snapshot.key)
+    track_line_payloads = PayloadCache(snapshot.key)
+    line_projection_payloads = PayloadCache(snapshot.key)
+    print(f"Mapped {len(line_paths)} line paths, {len(station_lines)} station lines, "
+          f"{len(line_stations_memory)} line station entries, {snapshot.stop_count()} stops and stop patterns of "
+          f"{len(stop_patterns)} routes and {len(timetable)} timetabled trips from {SNAPSHOT_PATH}.")
 
 def build_line_stations_memory():
     """
@@ -156,118 +146,111 @@ def build_line_stations_memory():
     """
     print("Building line stations memory...")
     global line_stations_memory
-    line_stations_memory = {}
-    
-    # Load all required data
-    stops_data = {}
-    with open('given_data/stops.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            stops_data[row['stop_id']] = {
-                'id': row['stop_id'],
-                'name': row['stop_name'],
-                'lat': float(row['stop_lat']),
-                'lon': float(row['stop_lon'])
-            }
-    
-    routes_data = {}
-    with open('given_data/routes.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            routes_data[row['route_id']] = {
-                'short_name': row['route_short_name'],
-                'long_name': row['route_long_name'],
-                'type': row['route_type']
-            }
-    
-    trips_data = {}
-    with open('given_data/trips.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            trips_data[row['trip_id']] = {
-                'route_id': row['route_id'],
-                'shape_id': row['shape_id']
-            }
-    
-    # Build line -> stations mapping
-    line_stations_raw = {}  # temp storage: {route_id: set(stop_ids)}
-    
-    with open('given_data/stop_times.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            trip_id = row['trip_id']
-            stop_id = row['stop_id']
-            
-            if trip_id in trips_data and stop_id in stops_data:
-                route_id = trips_data[trip_id]['route_id']
-                
-                if route_id not in line_stations_raw:
-                    line_stations_raw[route_id] = set()
-                line_stations_raw[route_id].add(stop_id)
-    
-    # Convert to final format with full station objects
-    for route_id, stop_ids in line_stations_raw.items():
-        if route_id in routes_data:
-            route_info = routes_data[route_id]
-            stations_list = []
-            
-            for stop_id in stop_ids:
-                if stop_id in stops_data:
-                    stations_list.append(stops_data[stop_id])
-            
-            # Sort stations by name for consistency
-            stations_list.sort(key=lambda x: x['name'])
-            
-            line_stations_memory[route_id] = {
-                'stations': stations_list,
-                'route_info': route_info,
-                'station_count': len(stations_list)
-            }
-            
-            # Also add by short_name if different (for easier lookup)
-            short_name = route_info['short_name']
-            if short_name != route_id and short_name not in line_stations_memory:
-                line_stations_memory[short_name] = line_stations_memory[route_id]
-    
-    print(f"Built memory for {len(line_stations_raw)} lines")
+    line_stations_memory = ingest_gtfs()['line_stations_memory']
     print(f"Total memory entries: {len(line_stations_memory)}")
-    
-    # Save to cache
-    with open('line_stations_cache.json', 'w', encoding='utf-8') as f:
-        json.dump(line_stations_memory, f, ensure_ascii=False, indent=2)
-    print("Line stations memory cached successfully.")
-    
     return line_stations_memory
 
-# Main GTFS loading logic at startup
-try:
-    print("Attempting to load GTFS data from cache...")
-    with open('gtfs_cache.json', 'r') as f:
-        cached_data = json.load(f)
-        line_paths = cached_data.get('line_paths', {})
-        station_lines = cached_data.get('station_lines', {})
-    
-    # Force reprocessing if the cache is empty or seems to be missing prefixed Metro lines
-    if not line_paths or not station_lines or any(not line_paths.get(f'M{i}') for i in range(1, 6)):
-        print("Cache incomplete, empty, or missing expected Metro lines. Reprocessing GTFS data...")
-        load_and_process_gtfs_data()
-    else:
-        print(f"Loaded {len(line_paths)} line paths and {len(station_lines)} station lines from cache.")
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    print(f"Error loading GTFS cache ({e}). Reprocessing GTFS data...")
-    load_and_process_gtfs_data()
-
-# Load line stations memory
-try:
-    print("Attempting to load line stations memory from FINAL.json...")
-    with open('FINAL.json', 'r', encoding='utf-8') as f:
-        line_stations_memory = json.load(f)
-    print(f"Loaded stations memory for {len(line_stations_memory)} line entries from FINAL.json.")
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    print(f"Error loading stations memory from FINAL.json ({e}). Exiting...")
-    raise
-
-server_url = "https://giromilano.atm.it/proxy.tpportal/proxy.ashx"
+# GTFS loading happens on demand, never at import: create_app() picks when
+#   eager       load before returning (wsgi.py, so the workers fork with the data mapped)
+#   background  load in a thread; the server binds at once and answers 503 until ready
+#   lazy        load on the first request that needs the data (tests and tooling)
+DATA_LOADING = os.environ.get('DATA_LOADING', 'background')
+# Endpoints served whether or not the data is loaded
+DATA_FREE_ENDPOINTS = {'healthz', 'readyz', 'index', 'static', 'serve_vehicle_image', 'atm_cache_stats', 'line_poller_stats',
+                       'debug_logging', 'metrics_endpoint', 'debug_traces', 'debug_trace'}
+_started_at = time.monotonic()
+_data_lock = threading.Lock()
+_data_state = {'mode': 'lazy', 'status': 'not_loaded', 'error': None, 'seconds': None}
+
+def ensure_data_loaded():
+    """Map the GTFS snapshot once per process (the first caller loads, concurrent ones wait); True when ready"""
+    if _data_state['status'] == 'ready':
+        return True
+    with _data_lock:
+        if _data_state['status'] != 'ready':
+            _data_state.update(status='loading', error=None)
+            start = time.perf_counter()
+            try:
+                load_gtfs_snapshot()
+            except Exception as e:
+                print(f"Error loading GTFS data: {e}")
+                _data_state.update(status='failed', error=str(e))
+                return False
+            _data_state.update(status='ready', seconds=round(time.perf_counter() - start, 2))
+            if os.environ.get('TRACK_LINE_WARMUP', 'background') == 'background':
+                # Serialize and compress every line's payload in the background right after loading.
+                # wsgi.py turns this off and warms them in the master instead, so the workers share them.
+                threading.Thread(target=warm_track_line_payloads, name='track-line-warmup', daemon=True).start()
+    return True
+
+def create_app(data_loading=None):
+    """Return the Flask app, with the GTFS data loaded as data_loading (default: DATA_LOADING) says"""
+    mode = data_loading or DATA_LOADING
+    if mode not in ('eager', 'background', 'lazy'):
+        raise ValueError(f"data_loading must be eager, background or lazy, not {mode}")
+    _data_state['mode'] = mode
+    if mode == 'eager':
+        if not ensure_data_loaded():
+            raise RuntimeError(f"GTFS data could not be loaded: {_data_state['error']}")
+    elif mode == 'background' and _data_state['status'] == 'not_loaded':
+        threading.Thread(target=ensure_data_loaded, name='gtfs-load', daemon=True).start()
+    return app
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    g.trace_root = tracer.start_trace(request.endpoint or 'unmatched', method=request.method, path=request.full_path)
+
+@app.after_request
+def _observe_request(response):
+    start = g.get('request_start')
+    if start is not None:
+        REQUEST_LATENCY.observe(time.perf_counter() - start, request.endpoint or 'unmatched', request.method, response.status_code)
+    root = g.get('trace_root')
+    if root is not None and root.trace is not None:
+        response.headers['X-Trace-Id'] = root.trace.trace_id
+        tracer.finish_trace(root, status=response.status_code)
+    return response
+
+@app.before_request
+def _begin_request_logging():
+    line = request.args.get('line_number')
+    if line is not None and _data_state['status'] == 'ready':
+        line = line_index.route_id(line) or line
+    begin_request(request.endpoint, line=line, stop=request.args.get('stop_id'))
+
+@app.before_request
+def _require_data():
+    if request.endpoint in DATA_FREE_ENDPOINTS or _data_state['status'] == 'ready':
+        return None
+    if _data_state['mode'] == 'lazy' and ensure_data_loaded():
+        return None
+    response = jsonify({"error": "GTFS data is not loaded yet", "status": _data_state['status']})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving, whatever the state of the data"""
+    return jsonify({"status": "ok", "uptime_s": round(time.monotonic() - _started_at, 1)})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once the GTFS snapshot is mapped, 503 while loading or if loading failed"""
+    if _data_state['status'] != 'ready':
+        return jsonify({"status": _data_state['status'], "error": _data_state['error']}), 503
+    return jsonify({
+        "status": "ready",
+        "load_seconds": _data_state['seconds'],
+        "snapshot": SNAPSHOT_PATH,
+        "routes": len(routes),
+        "stops": len(stop_index),
+        "timetabled_trips": len(timetable) if timetable else 0
+    })
+
+# ATM_SERVER_URL points the app at another proxy, e.g. mock_atm.py for benchmarks
+server_url = os.environ.get('ATM_SERVER_URL', "https://giromilano.atm.it/proxy.tpportal/proxy.ashx")
 
 # Headers with cookie
 HEADERS = {
@@ -286,10 +269,13 @@ HEADERS = {
     "Sec-Ch-Ua": '"Chromium";v="122", "Not(A:Brand";v="24", "Google Chrome";v="122"',
     "Sec-Ch-Ua-Mobile": "?0",
     "Sec-Ch-Ua-Platform": '"Windows"',
-    "Host": "giromilano.atm.it",
+    "Host": urlparse(server_url).netloc,
     "Cookie": "_ga=GA1.1.277381945.1749850577; _ga_5W1ZB23GRH=GS2.1.s1749850577$o1$g0$t1749850580$j57$l0$h0; dtCookie9205gfup=v_4_srv_4_sn_7B1A6E823D9725BDCEB469D8E5ACABA0_perc_100000_ol_0_mul_1_app-3Aea7c4b59f27d43eb_0_rcs-3Acss_0; TS01ac3475=0199b2c74aa0ce7c7fd55f6c7442488b938c1ee7c44d85c464b46c88ed160742cc6ce5ef398f536a587fb9ac2732c9568f7851f6c0748983876c576ae090b2242d8ed089f7; _ga=GA1.1.277381945.1749850577; _gid=GA1.1.1209712740.1749862760; _gat=1; _ga_RD7BG8RLV0=GS2.1.s1749862759$o1$g1$t1749862812$j7$l0$h0"
 }
 
+# Pooled keep-alive session shared by the batch fetcher and the single-stop endpoints
+atm_client = ATMClient(server_url, HEADERS)
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     R = 6371  # Earth's radius in kilometers
     lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
@@ -309,130 +295,144 @@ def parse_wait_time(wait_message):
             return int(wait_message.split()[0])
         return None
     except:
+        ATM_PARSE_FAILURES.inc('wait_message')
         return None
 
-def _fetch_batch_wait_times_for_stops(stop_ids):
-    """Fetch wait times for multiple stops concurrently to avoid rate limits"""
-    def fetch_single_stop(stop_id):
-        try:
-            data = f"url=tpPortal%2Fgeodata%2Fpois%2Fstops%2F{stop_id}"
-            response = requests.post(server_url, headers=HEADERS, data=data, timeout=5)
-            print(f"Response from stop {stop_id}: {response.status_code}")
-            if response.status_code == 200:
-                json_data = response.json()
-                lines = json_data.get("Lines", [])
-                print(f"Got {len(lines)} lines for stop {stop_id}")
-                return stop_id, lines
-        except Exception as e:
-            print(f"Error fetching wait time for stop {stop_id}: {e}")
-        return stop_id, []
-    
-    # Use ThreadPoolExecutor for concurrent requests with reduced concurrency
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        # Process stop IDs in batches to avoid overwhelming the server
-        batch_size = 10
-        results = {}
-        
-        for i in range(0, len(stop_ids), batch_size):
-            batch = stop_ids[i:i+batch_size]
-            futures = [executor.submit(fetch_single_stop, stop_id) for stop_id in batch]
-            
-            for future in futures:
-                try:
-                    stop_id, lines_data = future.result(timeout=5)
-                    results[stop_id] = lines_data
-                except Exception as e:
-                    print(f"Error processing batch result: {e}")
-                    continue
-        
-        return results
-
-def _fetch_raw_wait_times_for_stop(stop_id):
-    data = f"url=tpPortal%2Fgeodata%2Fpois%2Fstops%2F{stop_id}"
+def _fetch_stop_lines_upstream(stop_id):
+    """POST one stop to the ATM proxy and return its "Lines", or None if the call failed"""
+    start = time.perf_counter()
     try:
-        print(f"\n=== Raw ATM Proxy Request for Stop {stop_id} ===")
-        print(f"URL: {server_url}")
-        print(f"Data: {data}")
-        print(f"Headers: {json.dumps(HEADERS, indent=2)}")
-        
-        response = requests.post(server_url, headers=HEADERS, data=data, timeout=5)
-        print(f"Status Code: {response.status_code}")
-        print(f"Response Headers: {dict(response.headers)}")
-        print(f"Response Text (first 500 chars): {response.text[:500]}...")
-        
-        if response.status_code == 200:
-            json_data = response.json()
-            print(f"Parsed JSON (first 500 chars): {json.dumps(json_data, indent=2)[:500]}...")
-            return json_data.get("Lines", [])
+        response = atm_client.post_stop(stop_id)
     except Exception as e:
-        print(f"Error fetching raw wait time for stop {stop_id}: {e}")
-        print(f"Full error details: {str(e)}")
-    return []
+        outcome = 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'error'
+        ATM_LATENCY.observe(time.perf_counter() - start, outcome)
+        ATM_RESPONSES.inc(outcome)
+        log.warning('atm_error', "Error fetching wait time: %s", e, stop=stop_id)
+        return None
+    ATM_LATENCY.observe(time.perf_counter() - start, 'ok' if response.status_code == 200 else 'http_error')
+    ATM_RESPONSES.inc(response.status_code)
+    if response.status_code != 200:
+        log.warning('atm_response', "ATM answered %s", response.status_code, stop=stop_id, status=response.status_code)
+        return None
+    try:
+        lines = response.json().get("Lines", [])
+    except (ValueError, AttributeError) as e:
+        ATM_PARSE_FAILURES.inc('json')
+        log.warning('atm_parse_error', "Unreadable ATM answer: %s", e, stop=stop_id)
+        return None
+    log.debug('atm_response', stop=stop_id, status=200, lines=len(lines))
+    return lines
+
+# Shared by every endpoint that needs ATM wait times (and by every worker process when
+# ATM_CACHE_REDIS_URL is set)
+wait_time_cache = WaitTimeCache(_fetch_stop_lines_upstream, shared=shared_store_from_env())
+
+def _cached_stop_lines(stop_id):
+    # Runs on the fan-out loop thread: local entries only, the shared store is asked from
+    # the executor by wait_time_cache.get
+    cached = wait_time_cache.peek(stop_id, shared=False)
+    return cached[0] if cached else None
+
+# Async fan-out over the stops of a line, with a global concurrency and rate limit on ATM
+fanout_engine = FanOutEngine(wait_time_cache.get, lookup=_cached_stop_lines)
+
+def _fetch_batch_wait_times_for_stops(stop_ids, deadline=LINE_FETCH_DEADLINE):
+    """
+    Fetch wait times for multiple stops concurrently.
+    Stops whose fetch failed or that have not answered by the deadline are left out, so the
+    result may be partial.
+    """
+    results = {}
+    FANOUTS_IN_FLIGHT.inc()
+    try:
+        with FANOUT_LATENCY.time(), tracer.span('fanout', stops=len(stop_ids)) as span:
+            for stop_id, lines_data in fanout_engine.stream(stop_ids, deadline, span=span):
+                results[stop_id] = lines_data
+    finally:
+        FANOUTS_IN_FLIGHT.dec()
+    missed = len(set(stop_ids)) - len(results)
+    if missed:
+        FANOUT_MISSED.inc(amount=missed)
+        span.set(missed=missed)
+    return results
+
+def _fetch_raw_wait_times_for_stop(stop_id):
+    """The ATM lines of one stop, or None if ATM could not be reached"""
+    lines = wait_time_cache.get(stop_id)
+    log.debug('stop_lines', stop=stop_id, lines=None if lines is None else len(lines))
+    return lines
 
 def fetch_wait_times_for_line(stop_code, line_number):
     # This function is now used for single stop clicks in the frontend. It should only return the specific line's wait time.
     all_lines_data = _fetch_raw_wait_times_for_stop(stop_code)
-    for line in all_lines_data:
+    for line in all_lines_data or []:
         if str(line.get("BookletUrl2", "")) == str(line_number):
             wait_msg = line.get("WaitMessage", "No data")
-            print(f"Found wait time for line {line_number} at stop {stop_code}: {wait_msg}")
+            log.debug('line_wait', wait_msg, line=line_number, stop=stop_code)
             return parse_wait_time(wait_msg)
-    print(f"No wait time data found for line {line_number} at stop {stop_code}.")
+    log.debug('line_wait', "No wait time data", line=line_number, stop=stop_code)
     return None
 
 def fetch_line_path(line_number):
     # Strip any prefix (M, T, B) from the line number
     clean_line = line_number.lstrip('MTB')
-    print(f"Looking up path for line {clean_line} (original: {line_number})")
+    log.debug('line_path', "Looking up path for %s", clean_line, line=line_number)
     
     # Use GTFS data instead of API
     if clean_line in line_paths:
         return line_paths[clean_line]
-    print(f"Available line numbers: {list(line_paths.keys())[:10]}...")  # Print first 10 lines for debugging
+    log.debug('line_path', "Not found", line=line_number)
     return None
 
+def resolve_line(line_number):
+    """Canonical route_id for user input like "M5", "5" or "90" (the input itself if no route matches)"""
+    route_id = line_index.route_id(line_number)
+    if route_id is None:
+        return line_number
+    alternatives = line_index.alternatives(line_number)
+    if alternatives:
+        log.debug('line_ambiguous', "Ambiguous between %s, using %s", alternatives, route_id, line=line_number)
+    return route_id
+
 def find_vehicle_positions(line_number, stops):
     # Get all stops along this line's path from GTFS data
-    print(f"\nFinding vehicle positions for line {line_number}")
+    log.debug('vehicle_positions', line=line_number)
     
     # Use route_id (which is the key in line_paths now) to get the paths
-    if line_number not in line_paths:
-        # As a fallback, try to find a route_id that has this short_name
-        found_route_id = None
-        for r_id, r_info in routes.items():
-            if r_info['short_name'] == line_number:
-                found_route_id = r_id
-                break
-        if found_route_id and found_route_id in line_paths:
-            line_paths_to_use = line_paths[found_route_id]
-        else:
-            print(f"Line {line_number} not found in GTFS data (neither route_id nor short_name match).")
-            return []
-    else:
-        line_paths_to_use = line_paths[line_number]
+    route_id = resolve_line(line_number)
+    if route_id not in line_paths:
+        log.info('line_not_found', "Neither route_id nor short_name match", line=line_number)
+        return []
+    line_paths_to_use = line_paths[route_id]
 
     # ... (rest of find_vehicle_positions remains the same, but it's currently not used for line tracking)
     # This function is not currently used for line drawing so we will remove the rest of it for now
     return []
 
+def scheduled_vehicles(route_id, line_number=''):
+    """Vehicles of a route where the timetable puts them right now"""
+    if timetable is None:
+        return []
+    return timetable.scheduled_vehicles(route_id, track_for=lambda shape_index: line_shape_track(route_id, shape_index),
+                                        id_prefix=f"{line_number}_sched_")
+
+def line_stop_positions(route_id):
+    """{stop_id: (direction_id, stop_sequence, dist_m)} from the route's canonical stop patterns"""
+    positions = {}
+    for pattern in stop_patterns.get(route_id, []):
+        for stop in pattern['stops']:
+            # A stop served in both directions keeps its place in the first one
+            positions.setdefault(stop['stop_id'], (pattern['direction_id'], stop['stop_sequence'], stop['dist_m']))
+    return positions
+
 def get_vehicle_type(line_number):
-    # Get routes info from the global routes dictionary
-    # We need to find the route_id based on line_number (which could be prefixed)
-    # This requires iterating through routes to find a match.
-    
-    # First, try to find a direct match for the line_number in route_short_name (e.g., M5, T3)
-    for route_id, route_info in routes.items():
-        if route_info['short_name'] == line_number:
-            route_type = route_info['type']
-            if route_type == "1":
-                return "METRO"
-            elif route_type == "0":
-                return "TRAM"
-            elif route_type == "3":
-                return "BUS"
+    # Resolve the line (prefixed or not, route_id or short_name) through the alias index
+    entry = line_index.resolve(line_number)
+    if entry:
+        return entry['vehicle_type']
     
     # Fallback if no direct match or if get_vehicle_type is called with a non-standard name
-    print(f"Warning: Could not determine vehicle type for line '{line_number}' from GTFS data. Defaulting to BUS.")
+    log.debug('vehicle_type_unknown', "Not in the GTFS data, defaulting to BUS", line=line_number)
     return "BUS"
 
 def fetch_vehicle_positions(line_number):
@@ -440,62 +440,146 @@ def fetch_vehicle_positions(line_number):
     pass
 
 def normalize_line_number(line_number):
-    # Remove any leading 'M', 'T', or 'B'
+    # Unprefixed number of the resolved route (e.g. "5" for "M5"), else remove any leading 'M', 'T', or 'B'
     if line_number and isinstance(line_number, str):
+        entry = line_index.resolve(line_number)
+        if entry:
+            return entry['number']
         return line_number.lstrip('MTB')
     return line_number
 
-@app.route('/track_line')
-def track_line():
-    line_number = request.args.get('line_number')
-    if not line_number:
-        return jsonify({"error": "Missing line_number"}), 400
-    
-    print(f"\n=== Tracking Line {line_number} ===")
-    
-    print(f"Looking up GTFS path for line {line_number}")
-    
+def build_track_line_payload(line_number, zoom=None, path_format='json'):
+    """
+    Paths, vehicle type and stations of a line, as returned by /track_line.
+    With a zoom the paths are simplified for that zoom level; path_format picks plain
+    point lists, Google encoded polylines or packed integer deltas (see shape_geometry).
+    """
     paths = [] # Will now store a list of paths
     
-    # Direct lookup using the user's input line_number (e.g., M5, T3, B90)
-    if line_number in line_paths:
-        paths = line_paths[line_number]
-        print(f"Found {len(paths)} GTFS paths for line {line_number}")
-    # If the direct prefixed match fails, try to find a route_id that has this short_name
+    # Resolve the user's input (e.g., M5, 5, T3, B90) to its route_id through the alias index
+    route_id = resolve_line(line_number)
+    if route_id in line_paths:
+        paths = line_paths[route_id]
     else:
-        found_route_id_by_short_name = None
-        for r_id, r_info in routes.items():
-            if r_info['short_name'] == line_number:
-                found_route_id_by_short_name = r_id
-                break
-        if found_route_id_by_short_name and found_route_id_by_short_name in line_paths:
-            paths = line_paths[found_route_id_by_short_name]
-            print(f"Found {len(paths)} GTFS paths for line {line_number} via short_name fallback.")
-        else:
-            print(f"Line {line_number} not found in GTFS data.")
-            print(f"Available lines: {sorted(list(line_paths.keys()))}") # Debug: print all available keys
+        log.info('line_not_found', line=line_number)
 
     # Get vehicle type
     vehicle_type = get_vehicle_type(line_number)
-    print(f"Vehicle type: {vehicle_type}")
     
     # Get stations for this line from our pre-processed data
-    line_info = line_stations_memory.get(line_number)
+    line_info = line_stations_memory.get(route_id) or line_stations_memory.get(line_number)
     line_stops = []
     actual_station_count = 0
     if line_info:
         line_stops = line_info.get('stations', [])
         actual_station_count = line_info.get('station_count', 0)
 
-    print(f"Actual station count for {line_number}: {actual_station_count}")
-
-    return jsonify({
+    patterns = stop_patterns.get(route_id, [])
+    if zoom is not None:
+        # Variants are only merged within a direction; shape_index is remapped to the kept
+        # paths, and is None for patterns whose shape was merged into another one
+        directions = {}
+        for pattern in patterns:
+            if pattern['shape_index'] is not None:
+                directions.setdefault(pattern['shape_index'], pattern['direction_id'])
+        paths, kept = simplify_paths(paths, zoom, [directions.get(i) for i in range(len(paths))])
+        position = {original: i for i, original in enumerate(kept)}
+        patterns = [{**pattern, 'shape_index': position.get(pattern['shape_index'])} for pattern in patterns]
+
+    return {
         "vehicle_type": vehicle_type,
-        "paths": paths,
+        "format": path_format,
+        "paths": format_paths(paths, path_format),
         "path_lengths": [len(p) for p in paths],
         "actual_station_count": actual_station_count,
-        "line_stops": line_stops  # Send the actual stations
-    })
+        "line_stops": line_stops,  # Send the actual stations
+        # Stops in travel order per direction, with their distance along paths[shape_index]
+        "stop_patterns": patterns
+    }
+
+# Zoom the map page requests shapes at: simplified to under a meter, still street-level sharp
+TRACK_LINE_CLIENT_ZOOM = 16
+
+def warm_track_line_payloads():
+    """Serialize and compress the /track_line payload of every route ahead of the first request"""
+    start = time.perf_counter()
+    for route_id in routes:
+        if route_id in line_paths:
+            # The variant the map page asks for
+            track_line_payloads.get((route_id, TRACK_LINE_CLIENT_ZOOM, 'polyline'),
+                                    lambda: build_track_line_payload(route_id, TRACK_LINE_CLIENT_ZOOM, 'polyline'),
+                                    best=True)
+    stats = track_line_payloads.stats()
+    print(f"Precompressed {stats['entries']} /track_line payloads in {time.perf_counter() - start:.1f}s "
+          f"({stats['raw_bytes'] / 1e6:.1f} MB raw, {stats['gzip_bytes'] / 1e6:.1f} MB gzip)")
+
+@app.route('/track_line')
+def track_line():
+    line_number = request.args.get('line_number')
+    if not line_number:
+        return jsonify({"error": "Missing line_number"}), 400
+    
+    zoom = request.args.get('zoom')
+    if zoom is not None:
+        try:
+            zoom = int(zoom)
+        except ValueError:
+            return jsonify({"error": "zoom must be an integer"}), 400
+        zoom = max(MIN_SHAPE_ZOOM, min(zoom, MAX_SHAPE_ZOOM))
+    path_format = request.args.get('format', 'json')
+    if path_format not in SHAPE_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(SHAPE_FORMATS)}"}), 400
+    
+    log.info('track_line', line=line_number, zoom=zoom, format=path_format)
+
+    route_id = line_index.route_id(line_number)
+    if route_id is None:
+        # Unknown lines are answered but not cached
+        return jsonify(build_track_line_payload(line_number, zoom, path_format))
+
+    # The payload only changes with the feed: serve the precompressed copy (or a 304)
+    payload = track_line_payloads.get((route_id, zoom, path_format),
+                                      lambda: build_track_line_payload(route_id, zoom, path_format))
+    return payload.response(request)
+
+def line_shape_track(route_id, shape_index):
+    """ShapeTrack (positions by distance in O(log n)) of one of a route's paths, or None"""
+    if gtfs_snapshot is None or shape_index is None:
+        return None
+    return gtfs_snapshot.shape_track(route_id, shape_index)
+
+def build_line_projection_payload(route_id):
+    """Each direction's shape at full resolution with cumulative meters, and where its stops fall on it"""
+    patterns = []
+    for pattern in stop_patterns.get(route_id, []):
+        track = line_shape_track(route_id, pattern['shape_index'])
+        patterns.append({
+            "direction_id": pattern['direction_id'],
+            "shape_index": pattern['shape_index'],
+            "length_m": round(track.length_m, 1) if track else None,
+            # Same points as paths[shape_index], so segment indexes line up with cumulative_m
+            "shape": encode_polyline([{'Y': lat, 'X': lon} for lat, lon in zip(track.lat, track.lon)]) if track else None,
+            "cumulative_m": [round(distance, 1) for distance in track.cumulative] if track else [],
+            "stops": [{key: stop[key] for key in ('stop_id', 'stop_sequence', 'segment', 'fraction', 'dist_m')}
+                      for stop in pattern['stops']]
+        })
+    return {"route_id": route_id, "patterns": patterns}
+
+@app.route('/line_projection')
+def line_projection():
+    """
+    Stop-to-shape projection table of a line: per direction, every stop's shape segment,
+    fraction along it and meters from the start, so positions can be interpolated with a
+    binary search over cumulative_m instead of scanning the polyline
+    """
+    line_number = request.args.get('line_number')
+    if not line_number:
+        return jsonify({"error": "Missing line_number"}), 400
+    route_id = line_index.route_id(line_number)
+    if route_id is None:
+        return jsonify({"error": f"Unknown line {line_number}"}), 404
+    payload = line_projection_payloads.get(route_id, lambda: build_line_projection_payload(route_id))
+    return payload.response(request)
 
 @app.route('/wait_time')
 def wait_time():
@@ -503,40 +587,212 @@ def wait_time():
     if not stop_id:
         return jsonify({"error": "Missing stop_id"}), 400
     
-    data = f"url=tpPortal%2Fgeodata%2Fpois%2Fstops%2F{stop_id}"
+    log.info('wait_time', stop=stop_id)
+    lines = wait_time_cache.get(stop_id)
+    if lines is None:
+        return jsonify({"error": "Wait times unavailable", "stop_id": stop_id}), 502
+    wait_times = []
+
+    for line in lines:
+        wait_msg = line.get("WaitMessage", "")
+        wait_time = 0 if (wait_msg is not None and wait_msg.lower() == "in arrivo") else parse_wait_time(wait_msg)
+        wait_times.append({
+            "line_number": line.get("BookletUrl2", ""),
+            "wait_time": wait_time,
+            "raw_message": wait_msg
+        })
+
+    return jsonify({"wait_times": wait_times})
+
+# Live wait times older than this are not merged into /departures
+DEPARTURES_LIVE_MAX_AGE = float(os.environ.get('DEPARTURES_LIVE_MAX_AGE', '60'))
+
+def _format_gtfs_time(seconds):
+    return f"{seconds // 3600 % 24:02d}:{seconds % 3600 // 60:02d}"
+
+def build_departures(stop_id, per_line=3, horizon_minutes=180, live=True):
+    """Next departures per line at a stop from the timetable, with cached live waits merged in when fresh"""
+    by_route = timetable.stop_departures(stop_id, horizon=horizon_minutes * 60, per_route=per_line) if timetable else {}
+    lines = {}
+    for route_id, departures in by_route.items():
+        entry = line_index.entries.get(route_id, {})
+        lines[route_id] = {
+            "route_id": route_id,
+            "line_number": entry.get('short_name', route_id),
+            "vehicle_type": entry.get('vehicle_type', 'BUS'),
+            "departures": [{
+                "trip_id": departure['trip_id'],
+                "direction_id": departure['direction_id'],
+                "time": _format_gtfs_time(departure['seconds']),
+                "in_minutes": departure['in_seconds'] // 60
+            } for departure in departures],
+            "live": None
+        }
+
+    # Only what the shared cache already holds: /departures never waits on the ATM proxy
+    cached = wait_time_cache.peek(stop_id, max_age=DEPARTURES_LIVE_MAX_AGE) if live else None
+    if cached is not None:
+        atm_lines, age = cached
+        for atm_line in atm_lines:
+            code = str(atm_line.get("BookletUrl2", ""))
+            route_id = line_index.route_id(code) or code
+            wait_msg = atm_line.get("WaitMessage")
+            line = lines.setdefault(route_id, {"route_id": route_id, "line_number": code,
+                                               "vehicle_type": get_vehicle_type(code), "departures": [], "live": None})
+            line["live"] = {"wait_time": parse_wait_time(wait_msg), "raw_message": wait_msg, "age_s": round(age, 1)}
+
+    return {
+        "stop_id": stop_id,
+        "stop_name": timetable.stop_name(stop_id) if timetable else None,
+        "live_age_s": round(cached[1], 1) if cached is not None else None,
+        "lines": sorted(lines.values(), key=lambda line: line["departures"][0]["in_minutes"] if line["departures"] else 1e9)
+    }
+
+@app.route('/departures')
+def departures():
+    """Next departures per line at a stop (?stop_id=&limit=3&horizon=180&live=1), answered from memory"""
+    stop_id = request.args.get('stop_id')
+    if not stop_id:
+        return jsonify({"error": "Missing stop_id"}), 400
     try:
-        print(f"\n=== Wait Time Request Details ===")
-        print(f"URL: {server_url}")
-        print(f"Data: {data}")
-        print(f"Headers: {json.dumps(HEADERS, indent=2)}")
-        
-        response = requests.post(server_url, headers=HEADERS, data=data, timeout=5)
-        print(f"\n=== Response Details ===")
-        print(f"Status Code: {response.status_code}")
-        print(f"Response Headers: {dict(response.headers)}")
-        print(f"Response Text: {response.text[:1000]}")
-        
-        if response.status_code == 200:
-            json_data = response.json()
-            lines = json_data.get("Lines", [])
-            wait_times = []
-            
-            for line in lines:
-                wait_msg = line.get("WaitMessage", "")
-                wait_time = 0 if (wait_msg is not None and wait_msg.lower() == "in arrivo") else parse_wait_time(wait_msg)
-                wait_times.append({
-                    "line_number": line.get("BookletUrl2", ""),
-                    "wait_time": wait_time,
-                    "raw_message": wait_msg
-                })
-            
-            return jsonify({"wait_times": wait_times})
-            
-    except Exception as e:
-        print(f"Error in wait_time endpoint for stop {stop_id}: {e}")
-        print(f"Full error details: {str(e)}")
-    
-    return jsonify({"wait_times": []})
+        per_line = max(1, min(int(request.args.get('limit', 3)), 20))
+        horizon = max(1, min(int(request.args.get('horizon', 180)), 24 * 60))
+    except ValueError:
+        return jsonify({"error": "limit and horizon must be integers"}), 400
+    live = request.args.get('live', '1') not in ('0', 'false')
+    return jsonify(build_departures(stop_id, per_line, horizon, live))
+
+# A /plan endpoint given as lat,lon can walk this far to its first or from its last stop
+PLAN_ACCESS_RADIUS_M = 600
+
+def _plan_endpoint(value):
+    """[(stop index, walk seconds)] for a /plan endpoint given as a stop_id or as lat,lon"""
+    parts = value.split(',')
+    if len(parts) != 2:
+        return journey_planner.stop_access(value)
+    lat, lon = float(parts[0]), float(parts[1])
+    nearby = stop_index.within_radius(lat, lon, PLAN_ACCESS_RADIUS_M, limit=50) or stop_index.nearest(lat, lon, 3)
+    access = []
+    for stop in nearby:
+        position = timetable.stop_ids.position(stop['id'])
+        if position is not None:
+            access.append((position, round(stop['distance_m'] / WALK_SPEED_MPS)))
+    return access
+
+def _format_leg(leg):
+    formatted = {**leg, "departure": _format_gtfs_time(leg['departure']), "arrival": _format_gtfs_time(leg['arrival'])}
+    if leg['mode'] == 'ride':
+        entry = line_index.entries.get(leg['route_id'], {})
+        formatted["line_number"] = entry.get('short_name', leg['route_id'])
+        formatted["vehicle_type"] = entry.get('vehicle_type', 'BUS')
+    return formatted
+
+@app.route('/plan')
+def plan():
+    """Earliest-arrival itineraries (?from=<stop_id|lat,lon>&to=<stop_id|lat,lon>&time=HH:MM&count=1)"""
+    if not request.args.get('from') or not request.args.get('to'):
+        return jsonify({"error": "Missing from or to"}), 400
+    if journey_planner is None:
+        return jsonify({"error": "Timetable not loaded"}), 503
+    try:
+        origins = _plan_endpoint(request.args['from'])
+        destinations = _plan_endpoint(request.args['to'])
+        count = max(1, min(int(request.args.get('count', 1)), 5))
+        when = timetable.now()
+        if request.args.get('time'):
+            hours, minutes = request.args['time'].split(':')
+            when = when.replace(hour=int(hours), minute=int(minutes), second=0, microsecond=0)
+    except ValueError:
+        return jsonify({"error": "from/to must be a stop_id or lat,lon, time HH:MM and count an integer"}), 400
+    if not origins or not destinations:
+        return jsonify({"error": "No stop found for " + ("from" if not origins else "to")}), 404
+
+    start = time.perf_counter()
+    itineraries = journey_planner.plan(origins, destinations, when, count)
+    return jsonify({
+        "date": when.date().isoformat(),
+        "itineraries": [{**itinerary,
+                         "departure": _format_gtfs_time(itinerary['departure']),
+                         "arrival": _format_gtfs_time(itinerary['arrival']),
+                         "legs": [_format_leg(leg) for leg in itinerary['legs']]} for itinerary in itineraries],
+        "elapsed_ms": round((time.perf_counter() - start) * 1000, 1)
+    })
+
+@app.route('/atm_cache_stats')
+def atm_cache_stats():
+    return jsonify(wait_time_cache.stats())
+
+@app.route('/resolve_line')
+def resolve_line_endpoint():
+    line_number = request.args.get('line_number')
+    if not line_number:
+        return jsonify({"error": "Missing line_number"}), 400
+
+    entry = line_index.resolve(line_number)
+    if not entry:
+        return jsonify({"error": f"Unknown line {line_number}"}), 404
+    return jsonify({**entry, "ambiguous_with": line_index.alternatives(line_number)})
+
+def _float_args(*names):
+    """Parse the named query parameters as finite floats; raises ValueError if any is missing or invalid"""
+    missing = [name for name in names if name not in request.args]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+    values = [float(request.args[name]) for name in names]
+    invalid = [name for name, value in zip(names, values) if not isfinite(value)]
+    if invalid:
+        raise ValueError(f"Invalid {', '.join(invalid)}")
+    return values
+
+def _with_station_lines(found_stops):
+    for stop in found_stops:
+        stop['lines'] = station_lines.get(stop['id'], [])
+    return found_stops
+
+@app.route('/stops/nearest')
+def stops_nearest():
+    try:
+        lat, lon = _float_args('lat', 'lon')
+        k = max(1, min(int(request.args.get('k', 5)), 100))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"stops": _with_station_lines(stop_index.nearest(lat, lon, k))})
+
+@app.route('/stops/radius')
+def stops_within_radius():
+    try:
+        lat, lon, radius = _float_args('lat', 'lon', 'radius')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    radius = min(radius, 5000)
+    return jsonify({"stops": _with_station_lines(stop_index.within_radius(lat, lon, radius, limit=500))})
+
+@app.route('/stops/bbox')
+def stops_in_bbox():
+    # bbox=west,south,east,north as produced by Leaflet's map.getBounds().toBBoxString()
+    try:
+        west, south, east, north = [float(value) for value in request.args.get('bbox', '').split(',')]
+        if not all(isfinite(value) for value in (west, south, east, north)):
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "bbox must be west,south,east,north"}), 400
+    return jsonify({"stops": stop_index.in_bbox(west, south, east, north, limit=5000)})
+
+@app.route('/stops/tile/<int:z>/<int:x>/<int:y>')
+def stops_tile(z, x, y):
+    """Stops (or per-cell stop counts at low zoom) of one map tile, encoded once and cacheable"""
+    try:
+        etag, body = stop_tiles.get(z, x, y)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
 
 @app.route('/station_lines')
 def get_station_lines():
@@ -547,113 +803,311 @@ def get_station_lines():
     lines = station_lines.get(stop_id, [])
     return jsonify({"lines": lines})
 
-@app.route('/get_line_vehicle_data')
-def get_line_vehicle_data():
-    line_number = request.args.get('line_number')
-    if not line_number:
-        return jsonify({"error": "Missing line_number"}), 400
-    
-    print(f"\n=== Fetching vehicle data for line {line_number} ===")
+def build_line_vehicle_payload(line_number):
+    """Fetch the wait times of every stop on a line and build the vehicles/stops payload"""
+    build_start = time.perf_counter()
+    fetch_seconds = 0.0
     
     # Get stations for this line from our pre-processed data
     line_info = line_stations_memory.get(line_number)
     line_stops_with_wait_times = []
+    # Every form ATM may use for this line in BookletUrl2
+    line_codes = {str(line_number), normalize_line_number(line_number)}
+    entry = line_index.resolve(line_number)
+    if entry:
+        line_codes.add(entry['short_name'])
     vehicles = []
+    missing_stops = 0
     
     if line_info:
         stops_data = line_info.get('stations', [])
         stop_ids = [stop['stop_id'] for stop in stops_data]
         
-        # Create a mapping of stop IDs to their sequence in the line
-        stop_sequence = {stop['stop_id']: idx for idx, stop in enumerate(stops_data)}
+        # Direction, GTFS stop_sequence and distance along the shape of every stop of the line
+        route_id = entry['route_id'] if entry else None
+        patterns = stop_patterns.get(route_id, []) if route_id else []
+        stop_positions = line_stop_positions(route_id) if route_id else {}
+        no_position = (None, None, None)
+        # Pattern stops missing from the stations list are needed to place the vehicles too
+        known_ids = set(stop_ids)
+        fetch_ids = stop_ids + list(dict.fromkeys(stop['stop_id'] for pattern in patterns for stop in pattern['stops']
+                                                  if stop['stop_id'] not in known_ids))
         
         # Batch fetch wait times for all stops
-        print(f"Fetching wait times for {len(stop_ids)} stops...")
-        wait_times_data = _fetch_batch_wait_times_for_stops(stop_ids)
-        print(f"Got wait times data for {len(wait_times_data)} stops")
+        fetch_start = time.perf_counter()
+        wait_times_data = _fetch_batch_wait_times_for_stops(fetch_ids)
+        fetch_seconds = time.perf_counter() - fetch_start
+        LINE_BUILD_LATENCY.observe(fetch_seconds, 'fetch')
+        missing_stops = len(set(fetch_ids) - set(wait_times_data))
+        
+        # Find the wait time announced for this line at each stop: {stop_id: (minutes or None, message)}
+        span = tracer.current().child('parse_waits')
+        stop_waits = {}
+        for stop_id in fetch_ids:
+            for line in wait_times_data.get(stop_id, []):
+                booklet_url2 = str(line.get("BookletUrl2", ""))
+                if booklet_url2 in line_codes:
+                    wait_msg = line.get("WaitMessage")
+                    stop_waits[stop_id] = (parse_wait_time(wait_msg), wait_msg or "No data")
+                    break
+        span.finish()
         
         # Process wait times and create vehicle positions
         processed_times = []
-        all_wait_times = []  # For debugging
+        debugging = log.is_enabled(line=line_number)
         
         # First pass: collect all wait times
-        for stop in stops_data:
+        for index, stop in enumerate(stops_data):
             stop_id = stop['stop_id']
-            lines_data = wait_times_data.get(stop_id, [])
+            if stop_id not in stop_waits:
+                continue
+            wait_time, wait_msg = stop_waits[stop_id]
+            direction_id, sequence, distance_m = stop_positions.get(stop_id, no_position)
+            if sequence is None:
+                # Not on a GTFS stop pattern: the station's place in the FINAL.json list
+                sequence = stop.get('sequence', index + 1)
             
-            # Find wait time for this line
-            for line in lines_data:
-                booklet_url2 = str(line.get("BookletUrl2", ""))
-                if booklet_url2 == str(line_number) or booklet_url2 == normalize_line_number(line_number):
-                    wait_msg = line.get("WaitMessage")
-                    wait_time = parse_wait_time(wait_msg)
-                    
-                    if wait_time is not None:  # Only process stops with valid wait times
-                        processed_times.append({
-                            'stop_id': stop_id,
-                            'stop_name': stop['name'],
-                            'lat': float(stop['lat']),
-                            'lon': float(stop['lon']),
-                            'wait_time': wait_time,
-                            'raw_message': wait_msg or "No data",
-                            'sequence': stop_sequence[stop_id]  # Add sequence number
-                        })
-                    
-                    all_wait_times.append(f"Stop {stop['name']} (seq {stop_sequence[stop_id]}): {wait_msg or 'No data'} (parsed as {wait_time} min)")
-                    
-                    # Add to stops list regardless of wait time
-                    line_stops_with_wait_times.append({
-                        'stop_id': stop_id,
-                        'name': stop['name'],
-                        'lat': float(stop['lat']),
-                        'lon': float(stop['lon']),
-                        'wait_message': wait_msg or "No data",
-                        'sequence': stop_sequence[stop_id]
-                    })
-                    break
+            if wait_time is not None:  # Only process stops with valid wait times
+                processed_times.append({
+                    'stop_id': stop_id,
+                    'stop_name': stop['name'],
+                    'lat': float(stop['lat']),
+                    'lon': float(stop['lon']),
+                    'wait_time': wait_time,
+                    'raw_message': wait_msg,
+                    'sequence': sequence,  # Add sequence number
+                    'direction_id': direction_id,
+                    'distance_m': distance_m
+                })
+            
+            if debugging:
+                log.debug('stop_wait', wait_msg, line=line_number, stop=stop_id, name=stop['name'], sequence=sequence, minutes=wait_time)
+            
+            # Add to stops list regardless of wait time
+            line_stops_with_wait_times.append({
+                'stop_id': stop_id,
+                'name': stop['name'],
+                'lat': float(stop['lat']),
+                'lon': float(stop['lon']),
+                'wait_message': wait_msg,
+                'sequence': sequence,
+                'direction_id': direction_id,
+                'distance_m': distance_m
+            })
 
-        # Print all wait times for debugging
-        print("\nAll wait times received:")
-        for wait_time in all_wait_times:
-            print(wait_time)
-        
         # Sort by wait time to process closest vehicles first
+        span = tracer.current().child('assemble_vehicles', patterns=len(patterns))
         processed_times.sort(key=lambda x: x['wait_time'])
-        print(f"\nFound {len(processed_times)} stops with valid wait times")
-
-        # Create vehicles for all stops with valid wait times (not just "in arrivo")
-        # This is the key fix - we need to create vehicles for all stops with wait times
-        # Create vehicles ONLY for stops with 0 minute wait times ("in arrivo")
-        for time_data in processed_times:
-            # Only create vehicles for arriving vehicles (wait_time == 0)
-            if time_data['wait_time'] == 0:
-                # Create a unique vehicle ID for each stop
-                vehicle_id = f"{line_number}_{time_data['stop_id']}_{time_data['sequence']}"
+
+        if patterns:
+            # Every vehicle, placed along each direction's stop pattern and shape from the waits
+            speed = AVERAGE_SPEEDS.get(entry['vehicle_type'], AVERAGE_SPEEDS['BUS'])
+            for pattern in patterns:
+                track = line_shape_track(route_id, pattern['shape_index'])
+                vehicles.extend(infer_vehicles(pattern, stop_waits, track, speed, id_prefix=f"{line_number}_"))
+            # Stretches without a live wait (slow or "no serv." stops) fall back to the timetable
+            vehicles.extend(vehicle for vehicle in scheduled_vehicles(route_id, line_number)
+                            if stop_waits.get(vehicle['stop_id'], (None,))[0] is None)
+            for vehicle in vehicles:
+                vehicle['line_number'] = str(line_number)
+        else:
+            # Without a stop pattern only the arriving vehicles can be placed, at their stop
+            for time_data in processed_times:
+                # Only create vehicles for arriving vehicles (wait_time == 0)
+                if time_data['wait_time'] == 0:
+                    # Create a unique vehicle ID for each stop
+                    vehicle_id = f"{line_number}_{time_data['stop_id']}_{time_data['sequence']}"
                 
-                vehicles.append({
-                    'id': vehicle_id,  # Add unique ID
-                    'lat': time_data['lat'],
-                    'lon': time_data['lon'],
-                    'stop_name': time_data['stop_name'],
-                    'line_number': str(line_number),
-                    'wait_time': time_data['wait_time'],
-                    'raw_message': time_data['raw_message'],
-                    'sequence': time_data['sequence'],
-                    'next_stops': []  # Optionally, you can add next stops if you want
-                })
+                    vehicles.append({
+                        'id': vehicle_id,  # Add unique ID
+                        'stop_id': time_data['stop_id'],
+                        'lat': time_data['lat'],
+                        'lon': time_data['lon'],
+                        'stop_name': time_data['stop_name'],
+                        'line_number': str(line_number),
+                        'wait_time': time_data['wait_time'],
+                        'raw_message': time_data['raw_message'],
+                        'sequence': time_data['sequence'],
+                        'direction_id': time_data['direction_id'],
+                        'distance_m': time_data['distance_m'],  # along the direction's shape
+                        'next_stops': []  # Optionally, you can add next stops if you want
+                    })
+        span.set(vehicles=len(vehicles))
+        span.finish()
 
-    print(f"\nReturning {len(vehicles)} vehicles and {len(line_stops_with_wait_times)} stops with wait times")
-    if vehicles:
-        print("\nVehicle wait times:")
+    LINE_BUILD_LATENCY.observe(time.perf_counter() - build_start - fetch_seconds, 'process')
+    log.info('line_vehicles', line=line_number, vehicles=len(vehicles), stops=len(line_stops_with_wait_times),
+             missing_stops=missing_stops)
+    if log.is_enabled(line=line_number):
         for vehicle in vehicles:
-            print(f"Vehicle {vehicle['id']} at {vehicle['stop_name']}: {vehicle['raw_message']} ({vehicle['wait_time']} min)")
-    
-    print("\nSample vehicle:", vehicles[0] if vehicles else "No vehicles")
-    return jsonify({
+            log.debug('vehicle', vehicle.get('raw_message') or '', line=line_number, id=vehicle.get('id'),
+                      stop=vehicle.get('stop_id'), source=vehicle.get('source'), minutes=vehicle.get('wait_time'))
+    return {
         "vehicles": vehicles,
         "line_stops_with_wait_times": line_stops_with_wait_times,
-        "update_interval": 60000
-    })
+        "partial": missing_stops > 0,  # some stops failed or missed the fetch deadline
+        "missing_stops": missing_stops,
+        "update_interval": int(line_poller.interval * 1000)
+    }
+
+# Refreshes each watched line once per interval and pushes it to all of its viewers; with
+# ATM_CACHE_REDIS_URL set, one worker process polls each line for all of them
+line_poller = LinePoller(build_line_vehicle_payload,
+                         shared=RedisLinePollStore(wait_time_cache.shared.client) if wait_time_cache.shared else None)
+
+@app.route('/get_line_vehicle_data')
+def get_line_vehicle_data():
+    line_number = request.args.get('line_number')
+    if not line_number:
+        return jsonify({"error": "Missing line_number"}), 400
+
+    # Lines somebody is streaming are already refreshed by the poller
+    route_id = resolve_line(line_number)
+    payload = line_poller.latest(route_id)
+    if payload is None:
+        payload = build_line_vehicle_payload(route_id)
+    return jsonify(payload)
+
+@app.route('/line_stream')
+def line_stream():
+    """Server-Sent Events stream of the vehicle data of a line, pushed on every poller refresh"""
+    line_number = request.args.get('line_number')
+    if not line_number:
+        return jsonify({"error": "Missing line_number"}), 400
+
+    subscription = line_poller.subscribe(resolve_line(line_number))
+    if subscription is None:
+        # Every stream holds a worker thread: past the cap the page falls back to polling
+        return jsonify({"error": "Too many open streams, poll /get_line_vehicle_data instead"}), 503
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                message = subscription.get(timeout=15)
+                if message is None:
+                    yield ": keep-alive\n\n"  # also lets us notice clients that went away
+                else:
+                    yield f"data: {message}\n\n"
+        finally:
+            line_poller.unsubscribe(subscription)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/debug/logging', methods=['GET', 'POST'])
+def debug_logging():
+    """
+    Logging settings. POST level=DEBUG changes the level; line=<line>&enabled=1 (or stop=<stop_id>)
+    writes every record about that line or stop until switched off with enabled=0.
+    """
+    if request.method == 'POST':
+        enabled = request.values.get('enabled', '1') not in ('0', 'false')
+        if request.values.get('level'):
+            try:
+                set_level(request.values['level'])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        line = request.values.get('line')
+        if line:
+            debug_targets.set('line', line, enabled)
+            route_id = line_index.route_id(line) if _data_state['status'] == 'ready' else None
+            if route_id is not None:
+                debug_targets.set('line', route_id, enabled)
+        if request.values.get('stop'):
+            debug_targets.set('stop', request.values['stop'], enabled)
+    return jsonify(log_settings())
+
+@app.route('/debug/trace')
+def debug_traces():
+    """The slowest recent requests (those over TRACE_SLOW_MS), slowest first"""
+    return jsonify({"slow_ms": tracer.slow_ms, "traces": tracer.recent()})
+
+@app.route('/debug/trace/<trace_id>')
+def debug_trace(trace_id):
+    """One kept trace as a span tree; ?format=html draws it as a waterfall"""
+    trace = tracer.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Unknown trace, or not slow enough to be kept"}), 404
+    tree = span_tree(trace)
+    if request.args.get('format') != 'html':
+        return jsonify({**{key: trace[key] for key in ('trace_id', 'name', 'start', 'duration_ms')}, "spans": tree})
+    rows = []
+    def add_rows(nodes, depth):
+        for node in nodes:
+            rows.append((depth, node))
+            add_rows(node['children'], depth + 1)
+    add_rows(tree, 0)
+    total = max(trace['duration_ms'] or 0, 0.001)
+    return render_template_string(r"""
+<!DOCTYPE html>
+<html><head><title>Trace {{ trace.trace_id }}</title>
+<style>
+  body { font: 13px sans-serif; margin: 20px; }
+  td { padding: 2px 6px; white-space: nowrap; }
+  .bar { position: relative; width: 600px; height: 12px; background: #f0f0f0; }
+  .bar div { position: absolute; height: 12px; background: #4a90d9; min-width: 1px; }
+  .attrs { color: #666; font-size: 11px; }
+</style></head>
+<body>
+<h3>{{ trace.name }} &mdash; {{ trace.duration_ms }} ms</h3>
+<table>
+{% for depth, span in rows %}
+<tr>
+  <td style="padding-left: {{ depth * 16 + 6 }}px">{{ span.name }}</td>
+  <td>{{ span.duration_ms }} ms</td>
+  <td><div class="bar"><div style="left: {{ (span.start - trace.start) * 100000 / total }}%; width: {{ span.duration_ms * 100 / total }}%"></div></div></td>
+  <td class="attrs">{% for key, value in span.attributes.items() %}{{ key }}={{ value }} {% endfor %}</td>
+</tr>
+{% endfor %}
+</table>
+</body></html>
+""", trace=trace, rows=rows, total=total)
+
+def _gtfs_sizes():
+    if _data_state['status'] != 'ready':
+        return {}
+    return {('routes',): len(routes), ('line_paths',): len(line_paths), ('stops',): len(stop_index),
+            ('station_lines',): len(station_lines), ('stop_patterns',): len(stop_patterns),
+            ('timetabled_trips',): len(timetable), ('connections',): len(journey_planner.connections)}
+
+def _atm_cache_metric(*keys):
+    stats = wait_time_cache.stats()
+    return {(key,): stats[key] for key in keys}
+
+def _payload_cache_bytes():
+    sizes = {}
+    for name, cache in (('track_line', track_line_payloads), ('line_projection', line_projection_payloads)):
+        stats = cache.stats()
+        for encoding in ('raw', 'gzip', 'br'):
+            sizes[(name, encoding)] = stats[f'{encoding}_bytes']
+    return sizes
+
+metrics.callback('milanopt_data_ready', 'Whether the GTFS snapshot is mapped (1) or not (0)',
+                 lambda: {(): int(_data_state['status'] == 'ready')})
+metrics.callback('milanopt_gtfs_loaded_items', 'Number of loaded GTFS items by kind', _gtfs_sizes, ('kind',))
+metrics.callback('milanopt_gtfs_snapshot_bytes', 'Size of the mapped GTFS snapshot',
+                 lambda: {(): os.path.getsize(SNAPSHOT_PATH)} if _data_state['status'] == 'ready' else {})
+metrics.callback('milanopt_atm_cache_lookups_total', 'ATM wait-time cache lookups by result',
+                 lambda: _atm_cache_metric('hits', 'misses', 'coalesced', 'shared_hits'), ('result',), kind='counter')
+metrics.callback('milanopt_atm_cache_hit_ratio', 'Share of ATM cache lookups answered without a new upstream call',
+                 lambda: {(): wait_time_cache.stats()['hit_ratio']})
+metrics.callback('milanopt_atm_cache_entries', 'Stops held in the ATM wait-time cache', lambda: {(): wait_time_cache.stats()['size']})
+metrics.callback('milanopt_payload_cache_bytes', 'Size of the precompressed payload caches', _payload_cache_bytes,
+                 ('cache', 'encoding'))
+metrics.callback('milanopt_line_poller_watched_lines', 'Lines refreshed by the background poller',
+                 lambda: {(): line_poller.stats()['watched_lines']})
+metrics.callback('milanopt_line_poller_subscribers', 'Clients subscribed to /line_stream',
+                 lambda: {(): line_poller.stats()['subscribers']})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of the metrics of this process"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/line_poller_stats')
+def line_poller_stats():
+    return jsonify(line_poller.stats())
 
 @app.route('/')
 def index():
@@ -746,13 +1200,21 @@ def index():
 </div>
 
 <script>
-  const stops = {{ stops|tojson }};
-  const map = L.map('map').setView([45.4642, 9.1900], 12);
+  const map = L.map('map', { minZoom: 3 }).setView([45.4642, 9.1900], 12);
   let liveVehicleMarkersLayer = null;
   let highlightedStops = [];
   let trackingInterval = null;
+  let vehicleStream = null; // EventSource for pushed vehicle data
   let animationFrameId = null; // For smooth animation
   let allMarkers = L.markerClusterGroup();
+  // Stops are loaded per map tile for the visible area only (see loadVisibleStops)
+  const STOP_DETAIL_ZOOM = 14; // from this zoom tiles carry the stops themselves
+  const SHAPE_ZOOM = 16; // line shapes are requested simplified for this zoom
+  const STOP_MIN_ZOOM = 8; // zoomed out further than this no stops are shown
+  const MAX_STOP_TILES = 64; // never request more tiles than this for one view
+  const loadedStopTiles = new Set();
+  const loadedStopIds = new Set();
+  const stopOverviewLayers = new Map(); // zoom -> layer of per-cell stop counts
   let filteredMarkers = L.markerClusterGroup();
   let isTracking = false;
   let currentLineLayer = null; // Store the current line layer
@@ -1126,7 +1588,10 @@ function animateVehicles() {
     return false;
   }
 
-  stops.forEach(stop => {
+  function addStopMarker(stop) {
+    if (loadedStopIds.has(stop.id)) return;
+    loadedStopIds.add(stop.id);
+
     const marker = L.marker([stop.lat, stop.lon]);
     marker.bindPopup(`${stop.name}<br>Click marker to load wait time`);
 
@@ -1143,7 +1608,10 @@ function animateVehicles() {
           
           // Then get wait times
           fetch(`/wait_time?stop_id=${stop.id}`)
-            .then(response => response.json())
+            .then(response => {
+              if (!response.ok) throw new Error(`wait_time ${response.status}`);
+              return response.json();
+            })
             .then(waitData => {
               if(waitData.wait_times && waitData.wait_times.length > 0) {
                 const waitTimesHtml = waitData.wait_times
@@ -1170,17 +1638,115 @@ function animateVehicles() {
     });
 
     allMarkers.addLayer(marker);
-  });
+  }
+
+  function addStopCountMarker(layer, cluster) {
+    const size = cluster.count < 10 ? 'small' : (cluster.count < 100 ? 'medium' : 'large');
+    const marker = L.marker([cluster.lat, cluster.lon], {
+      icon: L.divIcon({
+        html: `<div><span>${cluster.count}</span></div>`,
+        className: `marker-cluster marker-cluster-${size}`,
+        iconSize: [40, 40]
+      })
+    });
+    marker.on('click', () => map.setView([cluster.lat, cluster.lon], Math.min(map.getZoom() + 2, STOP_DETAIL_ZOOM)));
+    layer.addLayer(marker);
+  }
 
-  map.addLayer(allMarkers);
+  function decodePolyline(encoded) {
+    // Google encoded polyline -> [{Y, X}] points, as the path helpers expect
+    const points = [];
+    let index = 0, lat = 0, lon = 0;
+    while (index < encoded.length) {
+      for (const axis of [0, 1]) {
+        let result = 0, shift = 0, byte;
+        do {
+          byte = encoded.charCodeAt(index++) - 63;
+          result |= (byte & 0x1f) << shift;
+          shift += 5;
+        } while (byte >= 0x20);
+        const delta = (result & 1) ? ~(result >> 1) : (result >> 1);
+        if (axis === 0) lat += delta; else lon += delta;
+      }
+      points.push({Y: lat / 1e5, X: lon / 1e5});
+    }
+    return points;
+  }
+
+  // Slippy-map tiles covering the bounds at the given zoom
+  function tilesForBounds(bounds, zoom) {
+    const n = Math.pow(2, zoom);
+    const clamp = v => Math.max(0, Math.min(n - 1, v));
+    const tileX = lon => clamp(Math.floor((lon + 180) / 360 * n));
+    const tileY = lat => {
+      const rad = Math.max(-85.05, Math.min(85.05, lat)) * Math.PI / 180;
+      return clamp(Math.floor((1 - Math.log(Math.tan(rad) + 1 / Math.cos(rad)) / Math.PI) / 2 * n));
+    };
+    const tiles = [];
+    for (let x = tileX(bounds.getWest()); x <= tileX(bounds.getEast()); x++) {
+      for (let y = tileY(bounds.getNorth()); y <= tileY(bounds.getSouth()); y++) {
+        tiles.push([zoom, x, y]);
+      }
+    }
+    return tiles;
+  }
+
+  function hideStopLayers() {
+    map.removeLayer(allMarkers);
+    stopOverviewLayers.forEach(layer => map.removeLayer(layer));
+  }
+
+  // Load only the tiles of the visible area: stops when zoomed in, stop counts when zoomed out
+  function loadVisibleStops() {
+    if (isTracking) return;
+
+    const zoom = Math.round(map.getZoom());
+    const detailed = zoom >= STOP_DETAIL_ZOOM;
+    const tileZoom = detailed ? STOP_DETAIL_ZOOM : zoom;
+
+    hideStopLayers();
+    if (zoom < STOP_MIN_ZOOM) return;
+    const tiles = tilesForBounds(map.getBounds(), tileZoom);
+    if (tiles.length > MAX_STOP_TILES) return;
+    let targetLayer = allMarkers;
+    if (!detailed) {
+      if (!stopOverviewLayers.has(tileZoom)) {
+        stopOverviewLayers.set(tileZoom, L.layerGroup());
+      }
+      targetLayer = stopOverviewLayers.get(tileZoom);
+    }
+    map.addLayer(targetLayer);
+
+    tiles.forEach(([z, x, y]) => {
+      const key = `${z}/${x}/${y}`;
+      if (loadedStopTiles.has(key)) return;
+      loadedStopTiles.add(key);
+      fetch(`/stops/tile/${key}`)
+        .then(response => response.json())
+        .then(tile => {
+          if (tile.stops) {
+            tile.stops.forEach(addStopMarker);
+          } else if (tile.clusters) {
+            tile.clusters.forEach(cluster => addStopCountMarker(targetLayer, cluster));
+          }
+        })
+        .catch(error => {
+          console.error(`Error loading stop tile ${key}:`, error);
+          loadedStopTiles.delete(key); // retry on the next move
+        });
+    });
+  }
+
+  map.on('moveend', loadVisibleStops);
+  loadVisibleStops();
 
   function resetMap() {
     clearTracking();
     clearAnimations();
     if (isTracking) {
       map.removeLayer(filteredMarkers);
-      map.addLayer(allMarkers);
       isTracking = false;
+      loadVisibleStops();
     }
     // Remove the line layer if it exists
     if (currentLineLayer) {
@@ -1208,6 +1774,12 @@ function animateVehicles() {
       clearInterval(trackingInterval);
       trackingInterval = null;
     }
+
+    // Close the vehicle data stream
+    if (vehicleStream) {
+      vehicleStream.close();
+      vehicleStream = null;
+    }
     
     // Clear animation frame
     if (animationFrameId) {
@@ -1308,15 +1880,16 @@ function animateVehicles() {
     
     // Remove all markers and add filtered ones
     if (!isTracking) {
-        map.removeLayer(allMarkers);
+        hideStopLayers();
         isTracking = true;
     }
     
     console.log(`Tracking line: ${lineNumber}`);
     
-    fetch(`/track_line?line_number=${lineNumber}`)
+    fetch(`/track_line?line_number=${lineNumber}&zoom=${SHAPE_ZOOM}&format=polyline`)
         .then(response => response.json())
         .then(data => {
+            data.paths = (data.paths || []).map(decodePolyline);
             console.log('Received data for line tracking:', data);
             
             document.getElementById('tracking-status').textContent = 
@@ -1369,7 +1942,10 @@ function animateVehicles() {
                         stationMarker.on('click', function(e) {
                             this.getPopup().setContent(`${stop.name}<br>Loading wait times 2...`).openOn(map);
                             fetch(`/wait_time?stop_id=${stop.stop_id}`)
-                                .then(response => response.json())
+                                .then(response => {
+                                  if (!response.ok) throw new Error(`wait_time ${response.status}`);
+                                  return response.json();
+                                })
                                 .then(waitData => {
                                   if(waitData.wait_times && waitData.wait_times.length > 0) {
                                     const waitTimesHtml = waitData.wait_times
@@ -1426,15 +2002,23 @@ function animateVehicles() {
         clearInterval(trackingInterval);
         console.log('⏹️ Cleared previous tracking interval');
     }
+    if (vehicleStream) {
+        vehicleStream.close();
+        vehicleStream = null;
+    }
     
-    const updateVehiclePositions = () => {
-        console.log('📡 Fetching vehicle data for line:', lineNumber);
-        
-        fetch(`/get_line_vehicle_data?line_number=${lineNumber}`)
-            .then(response => {
-                console.log('📨 Response status:', response.status);
-                return response.json();
-            })
+    // pushedData comes from the /line_stream push; without it the data is polled
+    const updateVehiclePositions = (pushedData) => {
+        const vehicleDataPromise = pushedData ? Promise.resolve(pushedData) : (() => {
+            console.log('📡 Fetching vehicle data for line:', lineNumber);
+            return fetch(`/get_line_vehicle_data?line_number=${lineNumber}`)
+                .then(response => {
+                    console.log('📨 Response status:', response.status);
+                    return response.json();
+                });
+        })();
+
+        vehicleDataPromise
             .then((data) => {
                 console.log('📊 RAW VEHICLE DATA RECEIVED:', JSON.stringify(data, null, 2));
                 
@@ -1460,9 +2044,11 @@ function animateVehicles() {
                 // Add back the red highlight markers for approaching stops
                 console.log('🔴 Creating highlight markers for approaching stops...');
                 data.vehicles.forEach((vehicle, idx) => {
-                    console.log(`🔴 Creating highlight marker ${idx + 1} for ${vehicle.stop_name} at [${vehicle.lat}, ${vehicle.lon}]`);
+                    // Vehicles placed by the server carry the stop they are heading to
+                    const approaching = vehicle.next_stop || vehicle;
+                    console.log(`🔴 Creating highlight marker ${idx + 1} for ${vehicle.stop_name} at [${approaching.lat}, ${approaching.lon}]`);
                     
-                    const highlightMarker = L.circleMarker([vehicle.lat, vehicle.lon], {
+                    const highlightMarker = L.circleMarker([approaching.lat, approaching.lon], {
                         radius: 10,
                         fillColor: '#FF4444',
                         color: '#fff',
@@ -1521,9 +2107,17 @@ function animateVehicles() {
                         let vehiclePosition = stopLatLon; // Start directly at the approaching station
                         console.log(`  📍 Vehicle spawned directly at approaching station: ${vehicle.stop_name} [${vehiclePosition[0]}, ${vehiclePosition[1]}]`);
 
-                        // Find the next station to move towards
+                        // Find the next station to move towards (already known for server-placed vehicles)
                         let nextStop = null;
-                        if (currentLinePaths.length > 0 && allStops.length > 0) {
+                        if (vehicle.next_stop) {
+                            nextStop = vehicle.next_stop;
+                            currentStop = {
+                                lat: nextStop.lat,
+                                lon: nextStop.lon,
+                                name: nextStop.name,
+                                id: nextStop.stop_id
+                            };
+                        } else if (currentLinePaths.length > 0 && allStops.length > 0) {
                             nextStop = findNextStationByWaitTime(vehicle, allStops, currentLinePaths);
                             if (nextStop) {
                                 console.log(`  🎯 Next destination: ${nextStop.name}`);
@@ -1546,9 +2140,9 @@ function animateVehicles() {
                             }
                         }
 
-                        // Calculate bearing towards next station
-                        bearing = 0;
-                        if (nextStop) {
+                        // Calculate bearing towards next station, unless the server inferred it along the shape
+                        bearing = typeof vehicle.bearing === 'number' ? vehicle.bearing : 0;
+                        if (nextStop && typeof vehicle.bearing !== 'number') {
                             const lat1 = vehicle.lat * Math.PI / 180;
                             const lon1 = vehicle.lon * Math.PI / 180;
                             const lat2 = nextStop.lat * Math.PI / 180;
@@ -1643,12 +2237,31 @@ function animateVehicles() {
             });
     };
 
-    // Run immediately and then every 60 seconds
-    console.log('⏰ Running initial vehicle position update...');
-    updateVehiclePositions();
-    
-    console.log('⏰ Setting up 60-second interval for updates...');
-    trackingInterval = setInterval(updateVehiclePositions, 60000);
+    const startPolling = () => {
+        // Run immediately and then every 60 seconds
+        console.log('⏰ Running initial vehicle position update...');
+        updateVehiclePositions();
+
+        console.log('⏰ Setting up 60-second interval for updates...');
+        trackingInterval = setInterval(() => updateVehiclePositions(), 60000);
+    };
+
+    // Prefer the server push stream: the server refreshes each line once for all of its viewers
+    if (window.EventSource) {
+        console.log('📡 Subscribing to vehicle data stream for line:', lineNumber);
+        vehicleStream = new EventSource(`/line_stream?line_number=${encodeURIComponent(lineNumber)}`);
+        vehicleStream.onmessage = (event) => updateVehiclePositions(JSON.parse(event.data));
+        vehicleStream.onerror = () => {
+            // The browser reconnects on its own unless the stream was closed for good
+            if (vehicleStream && vehicleStream.readyState === EventSource.CLOSED) {
+                console.warn('⚠️ Vehicle data stream closed, falling back to polling');
+                vehicleStream = null;
+                startPolling();
+            }
+        };
+    } else {
+        startPolling();
+    }
   }
 
   function zoomToVehicle() {
@@ -1902,8 +2515,10 @@ function findNextStationByWaitTime(currentVehicle, allStops, allPaths) {
 
 </body>
 </html>
-""", stops=stops)
+""")
 
 if __name__ == "__main__":
     print("Starting server on port 8080...")
+    # The debug reloader runs this file twice: only the child that serves requests loads the data
+    create_app(None if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' else 'lazy')
     app.run(debug=True, port=8080)
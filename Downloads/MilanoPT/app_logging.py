@@ -0,0 +1,153 @@
+# Structured logging for the request paths: levels, per-endpoint sampling and runtime debug
+# switches for single lines or stops. A record below the level returns after a flag and a
+# cached level check, before its message or fields are formatted.
+import contextvars
+import json
+import logging
+import os
+import random
+import sys
+import threading
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# text (one readable line per record) or json (one JSON object per line)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# Share of the requests of an endpoint whose INFO/DEBUG records are written, e.g.
+# "wait_time=0.01,get_line_vehicle_data=0.1"; endpoints not listed use LOG_SAMPLE_DEFAULT.
+# Warnings and errors are always written.
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'wait_time=0.05,departures=0.05,track_line=0.2')
+LOG_SAMPLE_DEFAULT = float(os.environ.get('LOG_SAMPLE_DEFAULT', '1'))
+
+# (sampled, debug) of the request being served; work outside requests is always sampled
+_request_state = contextvars.ContextVar('log_request_state', default=(True, False))
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            endpoint, rate = item.split('=', 1)
+            rates[endpoint.strip()] = max(0.0, min(float(rate), 1.0))
+    return rates
+
+
+class DebugTargets:
+    """Lines and stops whose records are written at DEBUG level whatever the level and sampling"""
+    def __init__(self):
+        self.lines = set()
+        self.stops = set()
+        self.active = False  # any target at all: checked first by every disabled record
+        self._lock = threading.Lock()
+
+    def set(self, kind, value, enabled):
+        targets = self.lines if kind == 'line' else self.stops
+        with self._lock:
+            if enabled:
+                targets.add(str(value))
+            else:
+                targets.discard(str(value))
+            self.active = bool(self.lines or self.stops)
+
+    def matches(self, line=None, stop=None):
+        return (line is not None and str(line) in self.lines) or (stop is not None and str(stop) in self.stops)
+
+    def snapshot(self):
+        with self._lock:
+            return {'lines': sorted(self.lines), 'stops': sorted(self.stops)}
+
+
+debug_targets = DebugTargets()
+sample_rates = parse_sample_rates(LOG_SAMPLE_RATES)
+
+
+def begin_request(endpoint, line=None, stop=None):
+    """Decide once per request whether its records are sampled, and whether it is being debugged"""
+    rate = sample_rates.get(endpoint, LOG_SAMPLE_DEFAULT)
+    sampled = rate >= 1.0 or random.random() < rate
+    debug = debug_targets.active and debug_targets.matches(line, stop)
+    _request_state.set((sampled, debug))
+
+
+class StructuredLogger:
+    """
+    log.info("event", "message %s", arg, stop=stop_id, lines=3): the message is %-formatted
+    and the keyword fields attached to the record only if it is written. Records carrying a
+    line= or stop= field that is a debug target are written even at DEBUG level.
+    """
+    def __init__(self, name):
+        self._logger = logging.getLogger(name)
+
+    def _log(self, level, event, message, args, fields):
+        if not (debug_targets.active and (_request_state.get()[1] or debug_targets.matches(fields.get('line'), fields.get('stop')))):
+            if not self._logger.isEnabledFor(level) or (level < logging.WARNING and not _request_state.get()[0]):
+                return
+        record = self._logger.makeRecord(self._logger.name, level, '(unknown file)', 0, message, args, None,
+                                         extra={'event': event, 'fields': fields})
+        self._logger.handle(record)
+
+    def debug(self, event, message='', *args, **fields):
+        if debug_targets.active or self._logger.isEnabledFor(logging.DEBUG):
+            self._log(logging.DEBUG, event, message, args, fields)
+
+    def info(self, event, message='', *args, **fields):
+        if debug_targets.active or self._logger.isEnabledFor(logging.INFO):
+            self._log(logging.INFO, event, message, args, fields)
+
+    def warning(self, event, message='', *args, **fields):
+        self._log(logging.WARNING, event, message, args, fields)
+
+    def error(self, event, message='', *args, **fields):
+        self._log(logging.ERROR, event, message, args, fields)
+
+    def is_enabled(self, level=logging.DEBUG, line=None, stop=None):
+        """For records whose arguments are expensive to build: would one at this level be written?"""
+        sampled, debugging = _request_state.get()
+        if debugging or (debug_targets.active and debug_targets.matches(line, stop)):
+            return True
+        return (sampled or level >= logging.WARNING) and self._logger.isEnabledFor(level)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = ' '.join(f"{key}={value}" for key, value in getattr(record, 'fields', {}).items())
+        message = record.getMessage()
+        return (f"{self.formatTime(record)} {record.levelname} {getattr(record, 'event', record.name)}"
+                f"{': ' + message if message else ''}{' ' + fields if fields else ''}")
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'event': getattr(record, 'event', None)}
+        message = record.getMessage()
+        if message:
+            entry['msg'] = message
+        for key, value in getattr(record, 'fields', {}).items():
+            entry[key if key not in entry and key not in _RESERVED else f"field_{key}"] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """Send the milanopt.* loggers to stdout (where the startup prints go) in the chosen format"""
+    root = logging.getLogger('milanopt')
+    root.setLevel(level)
+    root.propagate = False
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(_JsonFormatter() if fmt == 'json' else _TextFormatter())
+    root.handlers[:] = [handler]
+
+
+def get_logger(name):
+    return StructuredLogger(f"milanopt.{name}")
+
+
+def set_level(level):
+    logging.getLogger('milanopt').setLevel(level.upper())
+
+
+def settings():
+    return {'level': logging.getLevelName(logging.getLogger('milanopt').level), 'format': LOG_FORMAT,
+            'sample_rates': dict(sample_rates), 'sample_default': LOG_SAMPLE_DEFAULT, 'debug': debug_targets.snapshot()}
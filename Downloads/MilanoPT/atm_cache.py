@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from app_logging import get_logger
+
+try:
+    import redis  # optional: only needed for a cache shared between worker processes
+except ImportError:
+    redis = None
+
+# How long a stop's ATM answer is reused, and how many stops are kept at most
+ATM_CACHE_TTL = float(os.environ.get('ATM_CACHE_TTL', '15'))
+ATM_CACHE_MAX_STOPS = int(os.environ.get('ATM_CACHE_MAX_STOPS', '5000'))
+# redis://host:port/db shared by every worker process; unset keeps the cache per process
+ATM_CACHE_REDIS_URL = os.environ.get('ATM_CACHE_REDIS_URL', '')
+
+log = get_logger('atm_cache')
+
+
+class RedisWaitTimeStore:
+    """
+    Second cache level shared by all the worker processes: one key per stop holding the ATM
+    answer and its fetch time, expiring with the TTL, plus a short-lived lock key so only
+    one process at a time calls ATM for a given stop.
+    """
+    def __init__(self, url, ttl, prefix='milanopt:atm:'):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, stop_id):
+        """(lines, age_seconds) of a stop, or None"""
+        raw = self.client.get(self.prefix + stop_id)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry['lines'], max(0.0, time.time() - entry['fetched_at'])
+
+    def put(self, stop_id, lines):
+        value = json.dumps({'fetched_at': time.time(), 'lines': lines}, separators=(',', ':'))
+        self.client.set(self.prefix + stop_id, value, px=max(1, int(self.ttl * 1000)))
+        self.client.delete(self.prefix + 'lock:' + stop_id)
+
+    def lock(self, stop_id, timeout):
+        """True if this process should fetch the stop, False if another one already is"""
+        return bool(self.client.set(self.prefix + 'lock:' + stop_id, b'1', nx=True, px=max(1, int(timeout * 1000))))
+
+    def unlock(self, stop_id):
+        """Give up the fetch without an answer, so other processes don't wait out the lock"""
+        self.client.delete(self.prefix + 'lock:' + stop_id)
+
+
+def shared_store_from_env(ttl=ATM_CACHE_TTL):
+    """The RedisWaitTimeStore configured by ATM_CACHE_REDIS_URL, or None"""
+    if not ATM_CACHE_REDIS_URL:
+        return None
+    if redis is None:
+        print("ATM_CACHE_REDIS_URL is set but the redis package is not installed: the ATM cache stays per process")
+        return None
+    print(f"ATM cache shared through {ATM_CACHE_REDIS_URL}")
+    return RedisWaitTimeStore(ATM_CACHE_REDIS_URL, ttl)
+
+
+class _Flight:
+    """One upstream fetch in progress; concurrent callers for the same stop wait on it"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.lines = None
+
+
+class WaitTimeCache:
+    """
+    Process-wide, stop-level cache of the ATM "Lines" answers.
+    - entries expire after ttl seconds and the least recently used stop is evicted past max_stops
+    - concurrent misses for the same stop are coalesced into a single upstream call
+    - failed fetches (fetch returns None) are not cached, and get() returns None for them
+    - with a shared store (see RedisWaitTimeStore), a local miss is looked up there before
+      calling ATM, so worker processes share answers and in-flight fetches as well
+    """
+    def __init__(self, fetch, ttl=ATM_CACHE_TTL, max_stops=ATM_CACHE_MAX_STOPS, wait_timeout=10, shared=None):
+        self.fetch = fetch
+        self.shared = shared
+        self.ttl = ttl
+        self.max_stops = max_stops
+        self.wait_timeout = wait_timeout
+        self._entries = OrderedDict()  # stop_id -> (fetched_at, lines)
+        self._flights = {}  # stop_id -> _Flight
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'errors': 0, 'shared_hits': 0, 'shared_errors': 0}
+
+    def get(self, stop_id):
+        """
+        Return the ATM lines for stop_id, from the cache when fresh, else from one shared upstream
+        call. None if that call failed (or, for a coalesced caller, did not finish in wait_timeout).
+        """
+        stop_id = str(stop_id)
+        with self._lock:
+            entry = self._entries.get(stop_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(stop_id)
+                self.counters['hits'] += 1
+                return entry[1]
+            flight = self._flights.get(stop_id)
+            if flight is not None:
+                self.counters['coalesced'] += 1
+                leader = False
+            else:
+                flight = self._flights[stop_id] = _Flight()
+                self.counters['misses'] += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait(self.wait_timeout)
+            return flight.lines
+
+        try:
+            flight.lines = self._fetch_through_shared(stop_id) if self.shared is not None else self.fetch(stop_id)
+        finally:
+            with self._lock:
+                del self._flights[stop_id]
+                if flight.lines is None:
+                    self.counters['errors'] += 1
+                else:
+                    self._store(stop_id, flight.lines)
+            flight.done.set()
+        return flight.lines
+
+    def _fetch_through_shared(self, stop_id):
+        """Leader side of a local miss: the shared store first, then ATM if no other process is on it"""
+        deadline = time.monotonic() + self.wait_timeout
+        locked = False
+        try:
+            while True:
+                found = self.shared.get(stop_id)
+                if found is not None:
+                    lines, age = found
+                    with self._lock:
+                        self.counters['shared_hits'] += 1
+                        self._store(stop_id, lines, age)
+                    return lines
+                locked = self.shared.lock(stop_id, self.wait_timeout)
+                if locked or time.monotonic() >= deadline:
+                    break
+                time.sleep(0.05)  # another worker is fetching this stop
+        except Exception as e:
+            log.warning('shared_cache_error', "Shared ATM cache unavailable (%s), calling ATM directly", e, stop=stop_id)
+            with self._lock:
+                self.counters['shared_errors'] += 1
+            return self.fetch(stop_id)
+
+        lines = None
+        try:
+            lines = self.fetch(stop_id)
+            if lines is not None:
+                try:
+                    self.shared.put(stop_id, lines)
+                except Exception as e:
+                    log.warning('shared_cache_error', "Could not share the ATM answer: %s", e, stop=stop_id)
+                    with self._lock:
+                        self.counters['shared_errors'] += 1
+        finally:
+            if locked and lines is None:
+                try:
+                    self.shared.unlock(stop_id)
+                except Exception as e:
+                    log.warning('shared_cache_error', "Could not release the shared fetch lock: %s", e, stop=stop_id)
+        return lines
+
+    def peek(self, stop_id, max_age=None, shared=True):
+        """
+        Return (lines, age_seconds) for a cached stop without fetching, or None. With
+        shared=False only this process's entries are looked at, so it never blocks on the network.
+        """
+        max_age = self.ttl if max_age is None else max_age
+        stop_id = str(stop_id)
+        with self._lock:
+            entry = self._entries.get(stop_id)
+        if entry is None and shared and self.shared is not None:
+            try:
+                found = self.shared.get(stop_id)
+            except Exception:
+                found = None
+            if found is not None:
+                with self._lock:
+                    self.counters['shared_hits'] += 1
+                    self._store(stop_id, *found)
+                    entry = self._entries[stop_id]
+        if entry is None:
+            return None
+        age = time.monotonic() - entry[0]
+        if age >= max_age:
+            return None
+        return entry[1], age
+
+    def _store(self, stop_id, lines, age=0.0):
+        self._entries[stop_id] = (time.monotonic() - age, lines)
+        self._entries.move_to_end(stop_id)
+        while len(self._entries) > self.max_stops:
+            self._entries.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self._entries)
+            stats['in_flight'] = len(self._flights)
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_ratio'] = round((stats['hits'] + stats['coalesced']) / lookups, 3) if lookups else 0.0
+        stats['ttl'] = self.ttl
+        stats['max_stops'] = self.max_stops
+        stats['shared'] = self.shared is not None
+        return stats
@@ -0,0 +1,54 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection pool and retry settings for the ATM proxy
+ATM_POOL_SIZE = int(os.environ.get('ATM_POOL_SIZE', '16'))  # connections kept alive per host
+ATM_POOL_HOSTS = int(os.environ.get('ATM_POOL_HOSTS', '4'))  # number of per-host pools kept
+ATM_CONNECT_TIMEOUT = float(os.environ.get('ATM_CONNECT_TIMEOUT', '3.05'))
+ATM_READ_TIMEOUT = float(os.environ.get('ATM_READ_TIMEOUT', '5'))
+ATM_RETRIES = int(os.environ.get('ATM_RETRIES', '2'))
+ATM_RETRY_BACKOFF = float(os.environ.get('ATM_RETRY_BACKOFF', '0.25'))
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class ATMClient:
+    """
+    Keep-alive HTTP client for the ATM proxy.
+    One requests.Session is shared by all threads; its adapter keeps up to pool_size
+    connections per host and blocks callers beyond that instead of opening new ones.
+    Connect/read timeouts and 5xx answers are retried with exponential backoff.
+    """
+    def __init__(self, server_url, headers, pool_size=ATM_POOL_SIZE, pool_hosts=ATM_POOL_HOSTS,
+                 connect_timeout=ATM_CONNECT_TIMEOUT, read_timeout=ATM_READ_TIMEOUT,
+                 retries=ATM_RETRIES, backoff=ATM_RETRY_BACKOFF):
+        self.server_url = server_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['POST']),  # the proxy POSTs are read-only lookups
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post_stop(self, stop_id):
+        """Ask the proxy for the lines and wait messages of one stop; returns the requests.Response"""
+        data = f"url=tpPortal%2Fgeodata%2Fpois%2Fstops%2F{stop_id}"
+        return self.session.post(self.server_url, data=data, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app_logging import get_logger
+from tracing import tracer
+
+# Global limits on the calls made to ATM, shared by every line fan-out in the process
+ATM_MAX_CONCURRENCY = int(os.environ.get('ATM_MAX_CONCURRENCY', '8'))
+ATM_RATE_LIMIT = float(os.environ.get('ATM_RATE_LIMIT', '30'))  # requests per second
+ATM_RATE_BURST = int(os.environ.get('ATM_RATE_BURST', '30'))
+LINE_FETCH_DEADLINE = float(os.environ.get('LINE_FETCH_DEADLINE', '4'))  # seconds per line fan-out
+STREAM_GRACE = 1.0  # seconds past the deadline a caller waits on a stalled fan-out loop
+
+_DONE = object()
+log = get_logger('atm_fanout')
+
+
+class TokenBucket:
+    """asyncio token bucket: rate tokens per second, holding at most burst tokens"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FanOutEngine:
+    """
+    Fetches the wait times of many stops at once on a background asyncio loop.
+    Every fan-out shares one concurrency limit and one token bucket, so the load on ATM
+    stays bounded however many lines are requested at the same time. Stops that are
+    already cached (lookup returns their lines) skip both limits; lookup runs on the loop
+    thread, so it must not block (no network calls). Stops whose fetch
+    fails (returns None) are left out of the results like the ones past the deadline.
+    """
+    def __init__(self, fetch, lookup=None, max_concurrency=ATM_MAX_CONCURRENCY,
+                 rate=ATM_RATE_LIMIT, burst=ATM_RATE_BURST):
+        self.fetch = fetch
+        self.lookup = lookup
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='atm-fetch')
+        self._loop = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='atm-fanout', daemon=True).start()
+                # Loop-bound primitives have to be created from inside the loop
+                asyncio.run_coroutine_threadsafe(self._init_limits(), loop).result()
+                self._loop = loop
+        return self._loop
+
+    async def _init_limits(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._bucket = TokenBucket(self.rate, self.burst)
+
+    async def _fetch_one(self, stop_id, span):
+        queued = time.time()
+        if self.lookup is not None:
+            lines = self.lookup(stop_id)
+            if lines is not None:
+                tracer.record(span, 'stop_fetch', queued, time.time(), stop=stop_id, cached=True)
+                return stop_id, lines
+        async with self._semaphore:
+            await self._bucket.acquire()
+            started = time.time()
+            lines = await asyncio.get_running_loop().run_in_executor(self._executor, self.fetch, stop_id)
+        done = time.time()
+        # Queue wait: behind the concurrency limit and the token bucket; then the call itself
+        tracer.record(span, 'stop_fetch', queued, done, stop=stop_id, cached=False,
+                      queue_ms=round((started - queued) * 1000, 3), network_ms=round((done - started) * 1000, 3))
+        return stop_id, lines
+
+    async def _fan_out(self, stop_ids, deadline, emit, span=None):
+        tasks = [asyncio.ensure_future(self._fetch_one(stop_id, span)) for stop_id in dict.fromkeys(stop_ids)]
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=deadline):
+                try:
+                    stop_id, lines = await next_done
+                except asyncio.TimeoutError:
+                    raise
+                except Exception as e:
+                    log.error('fanout_error', "Error in line fan-out: %s", e)
+                    continue
+                if lines is not None:
+                    emit(stop_id, lines)
+        except asyncio.TimeoutError:
+            pending = sum(1 for task in tasks if not task.done())
+            log.warning('fanout_deadline', "Deadline of %ss reached", deadline, pending=pending, stops=len(tasks))
+            if span is not None:
+                span.set(pending=pending)
+        finally:
+            # Unfinished fetches keep running in the executor and still fill the cache
+            for task in tasks:
+                task.cancel()
+
+    def stream(self, stop_ids, deadline=LINE_FETCH_DEADLINE, span=None):
+        """
+        Yield (stop_id, lines) as each stop answers, stopping at the deadline; failed stops are
+        skipped. With a tracing span, every stop fetch is recorded under it. The caller stops
+        waiting a little after the deadline even if the loop itself is stalled.
+        """
+        results = queue.Queue()
+        give_up = time.monotonic() + deadline + STREAM_GRACE
+
+        async def run():
+            try:
+                await self._fan_out(stop_ids, deadline, lambda stop_id, lines: results.put((stop_id, lines)), span)
+            finally:
+                results.put(_DONE)
+
+        future = asyncio.run_coroutine_threadsafe(run(), self._ensure_loop())
+        while True:
+            try:
+                item = results.get(timeout=max(0.0, give_up - time.monotonic()))
+            except queue.Empty:
+                log.error('fanout_stalled', "Fan-out loop gave no answer %ss past the deadline", STREAM_GRACE,
+                          stops=len(stop_ids))
+                future.cancel()
+                return
+            if item is _DONE:
+                return
+            yield item
+
+    def fetch_all(self, stop_ids, deadline=LINE_FETCH_DEADLINE):
+        """Return {stop_id: lines} for the stops that answered successfully before the deadline"""
+        return dict(self.stream(stop_ids, deadline))
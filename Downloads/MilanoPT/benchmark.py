@@ -0,0 +1,348 @@
+# Benchmarks against a local mock of the ATM proxy (mock_atm.py), so nothing touches the live
+# service: cold GTFS ingest, snapshot load, and the throughput and latency percentiles of
+# /track_line, /wait_time and /get_line_vehicle_data at several client concurrencies. Results
+# are written as JSON; --compare checks them against an earlier run and exits with status 1
+# when something got slower by more than --tolerance.
+#
+# Run from (or point --data-dir at) a directory holding given_data/, stops_processed.csv and
+# FINAL.json: the app's own working directory, or a feed made by gtfs_synth.py:
+#
+#   python benchmark.py --concurrency 1,8,32 --duration 10 --output bench-before.json
+#   python benchmark.py --output bench-after.json --compare bench-before.json
+#   python benchmark.py --data-dir synthetic-5x --output bench-5x.json
+#
+# The ingest and the snapshot load run in fresh processes; the app is served by werkzeug, or by
+# gunicorn with --server gunicorn (or --url for a server you started yourself with
+# ATM_SERVER_URL pointing at a mock_atm.py).
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ('track_line', 'wait_time', 'get_line_vehicle_data')
+
+# Measured in a fresh interpreter; the last line printed is the JSON result
+_INGEST_CODE = """
+import json, resource, time
+start = time.perf_counter()
+import FINAL
+FINAL.load_and_process_gtfs_data()
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+_LOAD_CODE = """
+import json, resource, time
+start = time.perf_counter()
+import FINAL
+FINAL.create_app('eager')
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+_WERKZEUG_CODE = """
+import os, FINAL
+from werkzeug.serving import run_simple
+run_simple('127.0.0.1', int(os.environ['BENCH_PORT']), FINAL.create_app('eager'), threaded=True)
+"""
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_up(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{' '.join(process.args[:3])} exited with status {process.returncode}")
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} was not up after {timeout}s")
+
+
+def _run_python(code, env):
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark process failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_ingest(env):
+    """Cold ingest: stream the whole feed and write a new snapshot"""
+    result = _run_python(_INGEST_CODE, env)
+    return {'name': 'ingest', 'seconds': round(result['seconds'], 3), 'max_rss_mb': round(result['max_rss_mb'], 1)}
+
+
+def bench_snapshot_load(env, runs):
+    """Start-up with an existing snapshot, the median of `runs` fresh processes"""
+    results = sorted((_run_python(_LOAD_CODE, env) for _ in range(runs)), key=lambda result: result['seconds'])
+    median = results[len(results) // 2]
+    return {'name': 'snapshot_load', 'runs': runs, 'seconds': round(median['seconds'], 3),
+            'max_rss_mb': round(median['max_rss_mb'], 1)}
+
+
+def load_targets(path='FINAL.json'):
+    """Lines and stops to ask for, from the line stations memory"""
+    with open(path, encoding='utf-8') as f:
+        memory = json.load(f)
+    stops = sorted({str(station['stop_id']) for line_info in memory.values() for station in line_info.get('stations', [])})
+    return {'lines': sorted(memory), 'stops': stops}
+
+
+def request_path(endpoint, targets, rng):
+    if endpoint == 'wait_time':
+        return f"/wait_time?stop_id={rng.choice(targets['stops'])}"
+    return f"/{endpoint}?line_number={rng.choice(targets['lines'])}"
+
+
+def bench_endpoint(base_url, endpoint, concurrency, duration, warmup, targets, seed):
+    """
+    `concurrency` clients, each with its own keep-alive session, sending requests back to back
+    for `duration` seconds after `warmup` seconds that are not counted
+    """
+    latencies, statuses, lock = [], {}, threading.Lock()
+    start_at = time.monotonic() + warmup
+    stop_at = start_at + duration
+
+    def client(number):
+        rng = random.Random(seed * 1000 + number)
+        session = requests.Session()
+        mine, codes = [], {}
+        while True:
+            sent = time.monotonic()
+            if sent >= stop_at:
+                break
+            try:
+                status = session.get(base_url + request_path(endpoint, targets, rng), timeout=30).status_code
+            except requests.RequestException:
+                status = 'error'
+            if sent >= start_at:
+                mine.append(time.monotonic() - sent)
+                codes[status] = codes.get(status, 0) + 1
+        with lock:
+            latencies.extend(mine)
+            for status, count in codes.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 2) if seconds is not None else None
+    return {'name': 'http', 'endpoint': endpoint, 'concurrency': concurrency, 'requests': len(latencies),
+            'errors': sum(count for status, count in statuses.items() if status == 'error' or status >= 500),
+            'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            'rps': round(len(latencies) / duration, 1), 'p50_ms': ms(_percentile(latencies, 0.5)),
+            'p90_ms': ms(_percentile(latencies, 0.9)), 'p99_ms': ms(_percentile(latencies, 0.99)),
+            'max_ms': ms(latencies[-1] if latencies else None)}
+
+
+def start_mock(args, log_file):
+    port = _free_port()
+    command = [sys.executable, os.path.join(APP_DIR, 'mock_atm.py'), 'serve', '--port', str(port),
+               '--latency', str(args.atm_latency), '--jitter', str(args.atm_jitter),
+               '--error-rate', str(args.atm_error_rate), '--garbage-rate', str(args.atm_garbage_rate),
+               '--slow-rate', str(args.atm_slow_rate), '--seed', str(args.seed)]
+    if args.recordings:
+        command += ['--recordings', args.recordings]
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}/"
+    _wait_until_up(url + 'stats', process, 30)
+    return process, url
+
+
+def start_app(args, env, log_file):
+    port = _free_port()
+    env = dict(env, BENCH_PORT=str(port), BIND=f"127.0.0.1:{port}")
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(APP_DIR, 'gunicorn.conf.py'), 'wsgi:app']
+    else:
+        command = [sys.executable, '-c', _WERKZEUG_CODE]
+    process = subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    _wait_until_up(url + '/readyz', process, args.start_timeout)
+    return process, url
+
+
+def _mock_stats(mock_url):
+    try:
+        return requests.get(mock_url + 'stats', timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return {}
+
+
+def _feed_info():
+    sizes = {}
+    if os.path.isdir('given_data'):
+        for name in sorted(os.listdir('given_data')):
+            sizes[name] = os.path.getsize(os.path.join('given_data', name))
+    info = {'directory': os.getcwd(), 'file_bytes': sizes}
+    if os.path.exists('synthetic_feed.json'):
+        # Made by gtfs_synth.py: record its scale and counts so runs at different sizes compare
+        with open('synthetic_feed.json', encoding='utf-8') as f:
+            info['synthetic'] = {key: value for key, value in json.load(f).items() if key not in ('bytes', 'seconds')}
+    return info
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _result_key(result):
+    return (result['name'], result.get('endpoint'), result.get('concurrency'))
+
+
+# For every kind of result, the values compared between runs and whether higher is better
+_COMPARED = {'ingest': {'seconds': False, 'max_rss_mb': False},
+             'snapshot_load': {'seconds': False, 'max_rss_mb': False},
+             'http': {'rps': True, 'p50_ms': False, 'p99_ms': False}}
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing every value more than `tolerance` worse than in baseline"""
+    before = {_result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = before.get(_result_key(result))
+        if old is None:
+            continue
+        for field, higher_is_better in _COMPARED[result['name']].items():
+            new_value, old_value = result.get(field), old.get(field)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            if (-change if higher_is_better else change) > tolerance:
+                label = ' '.join(str(part) for part in _result_key(result) if part is not None)
+                regressions.append(f"{label} {field}: {old_value} -> {new_value} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MilanoPT benchmarks against a mock ATM proxy')
+    parser.add_argument('--data-dir', help='directory with the feed and the app inputs (default: the current one)')
+    parser.add_argument('--phases', default='ingest,load,http', help='any of ingest, load, http')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS))
+    parser.add_argument('--concurrency', default='1,8,32', help='comma-separated client counts')
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per endpoint and concurrency')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds run before each measurement')
+    parser.add_argument('--load-runs', type=int, default=3, help='fresh processes timed for the snapshot load')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--url', help='benchmark an app that is already running instead of starting one')
+    parser.add_argument('--start-timeout', type=float, default=600, help='seconds allowed for the app to get ready')
+    parser.add_argument('--recordings', help='ATM answers to replay (see mock_atm.py record)')
+    parser.add_argument('--atm-latency', type=float, default=0.05)
+    parser.add_argument('--atm-jitter', type=float, default=0.02)
+    parser.add_argument('--atm-error-rate', type=float, default=0.0)
+    parser.add_argument('--atm-garbage-rate', type=float, default=0.0)
+    parser.add_argument('--atm-slow-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='results file (default: benchmark-<time>.json)')
+    parser.add_argument('--compare', help='earlier results file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    # Output and recordings paths stay relative to where the benchmark was started
+    output = os.path.abspath(args.output or f"benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    for name in ('recordings', 'compare'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    if args.data_dir:
+        os.chdir(args.data_dir)
+    phases = {phase.strip() for phase in args.phases.split(',')}
+    workdir = tempfile.mkdtemp(prefix='milanopt-bench-')
+    log_path = os.path.join(workdir, 'processes.log')
+    log_file = open(log_path, 'w')
+    processes = []
+    results = []
+    meta = {'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'commit': _git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'server': 'external' if args.url else args.server, 'feed': _feed_info(),
+            'atm': {'latency': args.atm_latency, 'jitter': args.atm_jitter, 'error_rate': args.atm_error_rate,
+                    'garbage_rate': args.atm_garbage_rate, 'slow_rate': args.atm_slow_rate,
+                    'recordings': args.recordings},
+            'duration': args.duration, 'warmup': args.warmup}
+    try:
+        mock, mock_url = start_mock(args, log_file)
+        processes.append(mock)
+        env = dict(os.environ, ATM_SERVER_URL=mock_url, LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+                   PYTHONPATH=os.pathsep.join(filter(None, [APP_DIR, os.environ.get('PYTHONPATH')])),
+                   GTFS_SNAPSHOT_PATH=os.path.join(workdir, 'gtfs_snapshot.bin'))
+        if 'ingest' not in phases:
+            env['GTFS_SNAPSHOT_PATH'] = os.environ.get('GTFS_SNAPSHOT_PATH', 'gtfs_snapshot.bin')
+
+        if 'ingest' in phases:
+            results.append(bench_ingest(env))
+            print(f"ingest: {results[-1]['seconds']}s, {results[-1]['max_rss_mb']} MB", flush=True)
+        if 'load' in phases:
+            results.append(bench_snapshot_load(env, args.load_runs))
+            print(f"snapshot load: {results[-1]['seconds']}s, {results[-1]['max_rss_mb']} MB", flush=True)
+        if 'http' in phases:
+            if args.url:
+                base_url = args.url.rstrip('/')
+            else:
+                app, base_url = start_app(args, env, log_file)
+                processes.append(app)
+            targets = load_targets()
+            for endpoint in args.endpoints.split(','):
+                for concurrency in (int(value) for value in args.concurrency.split(',')):
+                    before = _mock_stats(mock_url).get('requests', 0)
+                    result = bench_endpoint(base_url, endpoint, concurrency, args.duration, args.warmup, targets, args.seed)
+                    result['atm_calls'] = _mock_stats(mock_url).get('requests', 0) - before
+                    results.append(result)
+                    print(f"{endpoint} x{concurrency}: {result['rps']} req/s, p50 {result['p50_ms']} ms, "
+                          f"p99 {result['p99_ms']} ms, {result['errors']} errors", flush=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        log_file.close()
+
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print(f"Results written to {output} (process output in {log_path})")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} against {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import csv
+import os
+import sys
+import time
+from array import array
+
+from stop_patterns import build_stop_patterns
+from timetable import TimetableBuilder, parse_gtfs_time
+
+# Directory holding the GTFS feed (routes.txt, stops.txt, shapes.txt, ...)
+GTFS_DATA_DIR = os.environ.get('GTFS_DATA_DIR', 'given_data')
+
+
+def _stream_gtfs_file(data_dir, file_name, report):
+    """Yield the rows of one GTFS file, recording its row count and read time in report"""
+    path = os.path.join(data_dir, file_name)
+    start = time.perf_counter()
+    rows = 0
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            rows += 1
+            yield row
+    elapsed = time.perf_counter() - start
+    report[file_name] = {'rows': rows, 'seconds': round(elapsed, 3)}
+    print(f"  {file_name}: {rows} rows in {elapsed:.2f}s")
+
+
+# Departure of a stop_times row with no arrival or departure time
+UNTIMED = -1
+
+
+def _interpolate_times(seconds):
+    """
+    Fill the UNTIMED entries of one trip's departures in place, linearly between the timed stops
+    around them (GTFS only requires the first and last stop to be timed). Entries before the
+    first or after the last timed stop copy it; a trip with no times at all stays UNTIMED.
+    """
+    timed = [i for i, sec in enumerate(seconds) if sec != UNTIMED]
+    if not timed:
+        return
+    for i in range(timed[0]):
+        seconds[i] = seconds[timed[0]]
+    for i in range(timed[-1] + 1, len(seconds)):
+        seconds[i] = seconds[timed[-1]]
+    for start, end in zip(timed, timed[1:]):
+        step = (seconds[end] - seconds[start]) / (end - start)
+        for i in range(start + 1, end):
+            seconds[i] = seconds[start] + round(step * (i - start))
+
+
+def ingest_gtfs(data_dir=GTFS_DATA_DIR):
+    """
+    Stream every GTFS file exactly once and build all the in-memory structures in one pass.
+    Returns a dict with 'routes', 'line_paths', 'station_lines', 'line_stations_memory',
+    'stop_patterns' (see stop_patterns.build_stop_patterns), 'timetable' (snapshot sections,
+    see timetable.TimetableBuilder) and 'report' ({file_name: {'rows': n, 'seconds': t}}).
+    stop_times.txt is streamed, not loaded: no CSV row or row dict is kept, each row only
+    updates the per-route and per-stop membership sets and appends to its trip's stop
+    pattern and departure times. Trips sharing a pattern share one tuple. Peak memory is
+    not bounded by a constant: every row keeps its departure (4 bytes in a per-trip array)
+    until the timetable is built, and the timetable itself stores several columns per row,
+    so both grow linearly with the stop_times row count.
+    Rows without times are interpolated between the timed stops of their trip.
+    """
+    print(f"Streaming GTFS feed from {data_dir}...")
+    ingest_start = time.perf_counter()
+    report = {}
+
+    timetable = TimetableBuilder()
+    if os.path.exists(os.path.join(data_dir, 'agency.txt')):
+        for row in _stream_gtfs_file(data_dir, 'agency.txt', report):
+            timetable.timezone = row.get('agency_timezone') or timetable.timezone
+    # calendar.txt, calendar_dates.txt and transfers.txt are all optional in GTFS
+    if os.path.exists(os.path.join(data_dir, 'calendar.txt')):
+        for row in _stream_gtfs_file(data_dir, 'calendar.txt', report):
+            timetable.add_calendar(row)
+    if os.path.exists(os.path.join(data_dir, 'calendar_dates.txt')):
+        for row in _stream_gtfs_file(data_dir, 'calendar_dates.txt', report):
+            timetable.add_calendar_date(row)
+    if os.path.exists(os.path.join(data_dir, 'transfers.txt')):
+        for row in _stream_gtfs_file(data_dir, 'transfers.txt', report):
+            timetable.add_transfer(row)
+
+    routes = {}
+    for row in _stream_gtfs_file(data_dir, 'routes.txt', report):
+        routes[row['route_id']] = {
+            'short_name': row['route_short_name'],
+            'long_name': row.get('route_long_name', ''),
+            'type': row['route_type']
+        }
+
+    stops_data = {}
+    for row in _stream_gtfs_file(data_dir, 'stops.txt', report):
+        stops_data[row['stop_id']] = {
+            'id': row['stop_id'],
+            'name': row['stop_name'],
+            'lat': float(row['stop_lat']),
+            'lon': float(row['stop_lon'])
+        }
+
+    shapes = {}
+    for row in _stream_gtfs_file(data_dir, 'shapes.txt', report):
+        shape_id = row['shape_id']
+        if shape_id not in shapes:
+            shapes[shape_id] = []
+        shapes[shape_id].append({'Y': float(row['shape_pt_lat']), 'X': float(row['shape_pt_lon']), 'seq': int(row['shape_pt_sequence'])})
+    for points in shapes.values():
+        points.sort(key=lambda x: x['seq'])
+
+    # Populate line_paths while the trips are streamed; only trip_id -> (route_id, direction,
+    # shape_id, service_id) is kept around for the stop_times pass.
+    line_paths = {}
+    line_shapes_added = {}
+    route_shapes = {}  # {route_id: {shape_id: index in line_paths[route_id]}}
+    trip_info = {}
+    for row in _stream_gtfs_file(data_dir, 'trips.txt', report):
+        route_id = sys.intern(row['route_id'])  # one shared string per route across all trips
+        route_info = routes.get(route_id)
+        if not route_info:
+            continue
+        shape_id = sys.intern(row.get('shape_id', ''))
+        trip_info[row['trip_id']] = (route_id, int(row.get('direction_id') or 0), shape_id, sys.intern(row['service_id']))
+
+        current_shape_points = shapes.get(shape_id)
+        if current_shape_points is None:
+            continue
+
+        # Use route_id as the primary key for line_paths (e.g., "M5", "T3", "B90")
+        if route_id not in line_paths:
+            line_paths[route_id] = []
+            line_shapes_added[route_id] = set()
+            route_shapes[route_id] = {}
+        if shape_id not in line_shapes_added[route_id]:
+            route_shapes[route_id][shape_id] = len(line_paths[route_id])
+            line_paths[route_id].append(current_shape_points)
+            line_shapes_added[route_id].add(shape_id)
+
+        # Add route_short_name as a secondary key if it's different and unprefixed
+        # This handles cases where user might input just '5' for a Metro line that's 'M5' in GTFS
+        line_short_name = route_info['short_name']
+        if route_id != line_short_name and not line_short_name.startswith(('M', 'T', 'B')):
+            if line_short_name not in line_paths:
+                line_paths[line_short_name] = []
+                line_shapes_added[line_short_name] = set()
+            if shape_id not in line_shapes_added[line_short_name]:
+                line_paths[line_short_name].append(current_shape_points)
+                line_shapes_added[line_short_name].add(shape_id)
+    del shapes, line_shapes_added
+
+    # Stop pattern of every trip, as a tuple of (stop_sequence, stop_id) shared by all the
+    # trips that stop at the same places, and its departure times
+    trip_patterns = {}
+    trip_seconds = {}
+    unique_patterns = {}
+
+    def close_trip(trip_id, trip_stops):
+        if trip_id is None or not trip_stops:
+            return
+        earlier = trip_patterns.get(trip_id)
+        if earlier is not None:
+            # the file is not grouped by trip
+            trip_stops = [(seq, stop_id, sec) for (seq, stop_id), sec in zip(earlier, trip_seconds[trip_id])] + trip_stops
+        trip_stops.sort()
+        pattern = tuple((seq, stop_id) for seq, stop_id, _ in trip_stops)
+        trip_patterns[trip_id] = unique_patterns.setdefault(pattern, pattern)
+        seconds = array('i', (sec for _, _, sec in trip_stops))
+        _interpolate_times(seconds)
+        trip_seconds[trip_id] = seconds
+
+    # Single pass over stop_times for station -> lines, line -> stations and trip patterns
+    station_lines_raw = {}  # {stop_id: {route_id: None}} keeps first-seen order
+    line_stations_raw = {}  # {route_id: set(stop_ids)}
+    current_trip, current_stops = None, []
+    for row in _stream_gtfs_file(data_dir, 'stop_times.txt', report):
+        trip_id = row['trip_id']
+        trip = trip_info.get(trip_id)
+        stop_id = row['stop_id']
+        if trip is None or stop_id not in stops_data:
+            continue
+        route_id = trip[0]
+        if trip_id != current_trip:
+            close_trip(current_trip, current_stops)
+            current_trip, current_stops = trip_id, []
+        departure = (row.get('departure_time') or '').strip() or (row.get('arrival_time') or '').strip()
+        current_stops.append((int(row['stop_sequence']), sys.intern(stop_id),
+                              parse_gtfs_time(departure) if departure else UNTIMED))
+        lines_at_stop = station_lines_raw.get(stop_id)
+        if lines_at_stop is None:
+            lines_at_stop = station_lines_raw[stop_id] = {}
+        if route_id not in lines_at_stop:
+            lines_at_stop[route_id] = None
+            line_stations_raw.setdefault(route_id, set()).add(stop_id)
+    close_trip(current_trip, current_stops)
+
+    # {(route_id, direction_id): {pattern: {shape_id: trips}}}
+    pattern_trips = {}
+    for trip_id, pattern in trip_patterns.items():
+        route_id, direction_id, shape_id, service_id = trip_info[trip_id]
+        shape_counts = pattern_trips.setdefault((route_id, direction_id), {}).setdefault(pattern, {})
+        shape_counts[shape_id] = shape_counts.get(shape_id, 0) + 1
+        seconds = trip_seconds[trip_id]
+        if seconds[0] != UNTIMED:  # a trip without a single time can't be planned on
+            timetable.add_trip(trip_id, route_id, direction_id, service_id, shape_id, pattern, seconds)
+    del trip_info, trip_patterns, trip_seconds, unique_patterns
+    stop_patterns = build_stop_patterns(pattern_trips, line_paths, route_shapes, stops_data)
+    timetable_sections = timetable.build(line_paths, route_shapes, stops_data)
+    del timetable
+
+    station_lines = {stop_id: list(lines) for stop_id, lines in station_lines_raw.items()}
+
+    line_stations_memory = {}
+    for route_id, stop_ids in line_stations_raw.items():
+        route_info = routes[route_id]
+        stations_list = [stops_data[stop_id] for stop_id in stop_ids]
+        # Sort stations by name for consistency
+        stations_list.sort(key=lambda x: x['name'])
+        line_stations_memory[route_id] = {
+            'stations': stations_list,
+            'route_info': route_info,
+            'station_count': len(stations_list)
+        }
+    # Also add by short_name if different (for easier lookup)
+    for route_id in line_stations_raw:
+        short_name = routes[route_id]['short_name']
+        if short_name != route_id and short_name not in line_stations_memory:
+            line_stations_memory[short_name] = line_stations_memory[route_id]
+
+    total_rows = sum(entry['rows'] for entry in report.values())
+    print(f"GTFS ingest finished: {total_rows} rows from {len(report)} files in {time.perf_counter() - ingest_start:.2f}s "
+          f"({len(routes)} routes, {len(line_paths)} line paths, {len(station_lines)} station lines, "
+          f"{len(line_stations_raw)} lines with stations, {len(pattern_trips)} stop patterns, {len(timetable_sections['tt_trip_start'])} timetabled trips)")
+
+    return {
+        'routes': routes,
+        'line_paths': line_paths,
+        'station_lines': station_lines,
+        'line_stations_memory': line_stations_memory,
+        'stop_patterns': stop_patterns,
+        'timetable': timetable_sections,
+        'report': report
+    }
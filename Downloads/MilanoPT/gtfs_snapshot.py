@@ -0,0 +1,459 @@
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+
+from stop_patterns import ShapeTrack, cumulative_distances
+
+# Binary snapshot of the processed GTFS data, opened with mmap and decoded lazily.
+#
+# Layout (native byte order, recorded in the header):
+#   header   MAGIC, format version, byte order, section count, 32-byte feed key
+#   table    one (name, offset, length) entry per section
+#   sections 8-byte aligned blobs: typed arrays, string tables or JSON
+#
+# Shapes are stored as contiguous float arrays with an offset table per shape, stops as
+# columnar arrays, and every id -> rows index (line -> shapes, stop -> lines, ...) as an
+# offset table into a flat array, so nothing is materialised until it is looked up.
+
+SNAPSHOT_PATH = os.environ.get('GTFS_SNAPSHOT_PATH', 'gtfs_snapshot.bin')
+SNAPSHOT_VERSION = 7
+
+MAGIC = b'MPTSNAP\0'
+_HEADER = struct.Struct('<8sIBxxxI32s')
+_SECTION = struct.Struct('<24sQQ')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def snapshot_key(paths):
+    """
+    Hash the name, size and modification time of every input file (directories are walked).
+    Replacing any file of the feed changes the key and so triggers a rebuild. The contents
+    are not read, so a file rewritten with the same size and mtime (copied with preserved
+    timestamps, say) keeps the old snapshot: delete the snapshot file to force a rebuild.
+    """
+    digest = hashlib.sha256(f"snapshot-v{SNAPSHOT_VERSION}".encode())
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            files = [path]
+        for file_path in files:
+            if not os.path.isfile(file_path):
+                continue
+            st = os.stat(file_path)
+            digest.update(f"{file_path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return digest.digest()
+
+
+class StringTableBuilder:
+    def __init__(self, deduplicate=True):
+        self.offsets = array('I', [0])
+        self.blob = bytearray()
+        self.index = {} if deduplicate else None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add(self, value):
+        """Append value (once, when deduplicating) and return its index in the table"""
+        if self.index is not None:
+            position = self.index.get(value)
+            if position is not None:
+                return position
+            self.index[value] = len(self)
+        self.blob += value.encode('utf-8')
+        self.offsets.append(len(self.blob))
+        return len(self) - 1
+
+
+class SnapshotWriter:
+    def __init__(self):
+        self.sections = []
+
+    def add_array(self, name, values):
+        self.sections.append((name, values.tobytes()))
+
+    def add_strings(self, name, table):
+        self.add_array(f"{name}.off", table.offsets)
+        self.add_bytes(f"{name}.str", table.blob)
+
+    def add_bytes(self, name, data):
+        self.sections.append((name, bytes(data)))
+
+    def add_json(self, name, value):
+        self.add_bytes(name, json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def write(self, path, key):
+        """Write all sections to path atomically (temp file + rename)"""
+        offset = _HEADER.size + _SECTION.size * len(self.sections)
+        table = []
+        for name, data in self.sections:
+            offset = (offset + 7) & ~7
+            table.append((name, offset, len(data)))
+            offset += len(data)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, SNAPSHOT_VERSION, _BYTE_ORDERS[sys.byteorder], len(self.sections), key))
+            for name, section_offset, length in table:
+                f.write(_SECTION.pack(name.encode('ascii'), section_offset, length))
+            for (name, data), (_, section_offset, _) in zip(self.sections, table):
+                f.write(b'\0' * (section_offset - f.tell()))
+                f.write(data)
+        os.replace(tmp_path, path)
+
+
+def write_snapshot(path, key, routes, line_paths, station_lines, stops, line_stations_memory, stop_patterns, timetable):
+    """
+    Serialize the processed GTFS structures into a snapshot file.
+    line_paths may share shape lists between keys (route_id and short_name aliases);
+    each distinct shape is stored once. timetable holds ready-made sections
+    ({name: array, StringTableBuilder or JSON value}, see timetable.TimetableBuilder).
+    """
+    writer = SnapshotWriter()
+    writer.add_json('routes', routes)
+
+    route_ids = StringTableBuilder()
+    for route_id in routes:
+        route_ids.add(route_id)
+
+    # Shapes: contiguous coordinate arrays plus a per-shape offset table
+    shape_lat, shape_lon, shape_seq, shape_dist = array('d'), array('d'), array('i'), array('d')
+    shape_offsets = array('I', [0])
+    shape_index = {}
+    line_keys = StringTableBuilder()
+    line_shape_offsets = array('I', [0])
+    line_shapes = array('I')
+    for line_key, paths in line_paths.items():
+        line_keys.add(line_key)
+        for points in paths:
+            position = shape_index.get(id(points))
+            if position is None:
+                position = shape_index[id(points)] = len(shape_offsets) - 1
+                for point in points:
+                    shape_lat.append(point['Y'])
+                    shape_lon.append(point['X'])
+                    shape_seq.append(point['seq'])
+                shape_dist.extend(cumulative_distances(points))
+                shape_offsets.append(len(shape_lat))
+            line_shapes.append(position)
+        line_shape_offsets.append(len(line_shapes))
+    writer.add_array('shape_lat', shape_lat)
+    writer.add_array('shape_lon', shape_lon)
+    writer.add_array('shape_seq', shape_seq)
+    writer.add_array('shape_dist', shape_dist)
+    writer.add_array('shape_offsets', shape_offsets)
+    writer.add_strings('line_keys', line_keys)
+    writer.add_array('line_shape_off', line_shape_offsets)
+    writer.add_array('line_shapes', line_shapes)
+
+    # Stop -> lines index; the lines are indexes into the route id table
+    station_keys = StringTableBuilder()
+    station_line_offsets = array('I', [0])
+    station_line_routes = array('I')
+    for stop_id, lines in station_lines.items():
+        station_keys.add(stop_id)
+        for line in lines:
+            station_line_routes.append(route_ids.add(line))
+        station_line_offsets.append(len(station_line_routes))
+    writer.add_strings('station_keys', station_keys)
+    writer.add_array('station_line_off', station_line_offsets)
+    writer.add_array('station_lines', station_line_routes)
+    writer.add_strings('route_ids', route_ids)
+
+    # Stops as columns
+    stop_ids, stop_names = StringTableBuilder(deduplicate=False), StringTableBuilder(deduplicate=False)
+    stop_lat, stop_lon = array('d'), array('d')
+    for stop in stops:
+        stop_ids.add(stop['id'])
+        stop_names.add(stop['name'])
+        stop_lat.append(stop['lat'])
+        stop_lon.append(stop['lon'])
+    writer.add_strings('stop_ids', stop_ids)
+    writer.add_strings('stop_names', stop_names)
+    writer.add_array('stop_lat', stop_lat)
+    writer.add_array('stop_lon', stop_lon)
+
+    # The stops of the spatial index: stops plus every line station, each stop id once, so
+    # loading the index needs neither the stop dicts nor the line stations documents
+    index_ids, index_names = StringTableBuilder(deduplicate=False), StringTableBuilder(deduplicate=False)
+    index_lat, index_lon = array('d'), array('d')
+    seen = set()
+    line_stations = (station for entry in line_stations_memory.values() for station in entry.get('stations', []))
+    for stop in itertools.chain(stops, line_stations):
+        stop_id = str(stop.get('id', stop.get('stop_id', '')))
+        if not stop_id or stop_id in seen:
+            continue
+        seen.add(stop_id)
+        index_ids.add(stop_id)
+        index_names.add(stop.get('name', ''))
+        index_lat.append(float(stop['lat']))
+        index_lon.append(float(stop['lon']))
+    writer.add_strings('index_stop_ids', index_ids)
+    writer.add_strings('index_stop_names', index_names)
+    writer.add_array('index_stop_lat', index_lat)
+    writer.add_array('index_stop_lon', index_lon)
+
+    # Line stations memory: one JSON document per line, decoded on access
+    memory_keys = StringTableBuilder()
+    memory_offsets = array('I', [0])
+    memory_blob = bytearray()
+    for line_key, entry in line_stations_memory.items():
+        memory_keys.add(line_key)
+        memory_blob += json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        memory_offsets.append(len(memory_blob))
+    writer.add_strings('memory_keys', memory_keys)
+    writer.add_array('memory_off', memory_offsets)
+    writer.add_bytes('memory_json', memory_blob)
+
+    # Stop patterns: route -> patterns -> stops, each level an offset table into the next;
+    # the stops themselves are stored once in their own columns
+    pattern_routes = StringTableBuilder()
+    pattern_route_offsets = array('I', [0])
+    pattern_direction, pattern_shape, pattern_trips = array('i'), array('i'), array('I')
+    pattern_stop_offsets = array('I', [0])
+    pattern_stops, pattern_stop_seq, pattern_stop_dist = array('I'), array('i'), array('f')
+    pattern_stop_segment, pattern_stop_fraction = array('i'), array('f')
+    pattern_stop_ids, pattern_stop_names = StringTableBuilder(), StringTableBuilder(deduplicate=False)
+    pattern_stop_lat, pattern_stop_lon = array('d'), array('d')
+    for route_id, patterns in stop_patterns.items():
+        pattern_routes.add(route_id)
+        for pattern in patterns:
+            pattern_direction.append(pattern['direction_id'])
+            pattern_shape.append(-1 if pattern['shape_index'] is None else pattern['shape_index'])
+            pattern_trips.append(pattern['trip_count'])
+            for stop in pattern['stops']:
+                known = len(pattern_stop_ids)
+                position = pattern_stop_ids.add(stop['stop_id'])
+                if position == known:
+                    pattern_stop_names.add(stop['name'])
+                    pattern_stop_lat.append(stop['lat'])
+                    pattern_stop_lon.append(stop['lon'])
+                pattern_stops.append(position)
+                pattern_stop_seq.append(stop['stop_sequence'])
+                pattern_stop_dist.append(stop['dist_m'])
+                pattern_stop_segment.append(-1 if stop['segment'] is None else stop['segment'])
+                pattern_stop_fraction.append(stop['fraction'] or 0.0)
+            pattern_stop_offsets.append(len(pattern_stops))
+        pattern_route_offsets.append(len(pattern_direction))
+    writer.add_strings('pattern_routes', pattern_routes)
+    writer.add_array('pattern_route_off', pattern_route_offsets)
+    writer.add_array('pattern_direction', pattern_direction)
+    writer.add_array('pattern_shape', pattern_shape)
+    writer.add_array('pattern_trips', pattern_trips)
+    writer.add_array('pattern_stop_off', pattern_stop_offsets)
+    writer.add_array('pattern_stops', pattern_stops)
+    writer.add_array('pattern_stop_seq', pattern_stop_seq)
+    writer.add_array('pattern_stop_dist', pattern_stop_dist)
+    writer.add_array('pattern_stop_seg', pattern_stop_segment)
+    writer.add_array('pattern_stop_frac', pattern_stop_fraction)
+    writer.add_strings('pattern_stop_ids', pattern_stop_ids)
+    writer.add_strings('pattern_stop_names', pattern_stop_names)
+    writer.add_array('pattern_stop_lat', pattern_stop_lat)
+    writer.add_array('pattern_stop_lon', pattern_stop_lon)
+
+    for name, value in timetable.items():
+        if isinstance(value, array):
+            writer.add_array(name, value)
+        elif isinstance(value, StringTableBuilder):
+            writer.add_strings(name, value)
+        else:
+            writer.add_json(name, value)
+
+    writer.write(path, key)
+    print(f"Wrote GTFS snapshot {path} ({os.path.getsize(path) / 1e6:.1f} MB, {len(shape_offsets) - 1} shapes, "
+          f"{len(stop_lat)} stops, {len(line_keys)} line keys, {len(pattern_direction)} stop patterns, "
+          f"{len(timetable['tt_trip_start'])} timetabled trips)")
+
+
+class _StringTable:
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+        self._index = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        return str(self.blob[self.offsets[position]:self.offsets[position + 1]], 'utf-8')
+
+    def position(self, value):
+        """Index of value in the table, or None (the reverse index is built on first use)"""
+        if self._index is None:
+            self._index = {self[i]: i for i in range(len(self))}
+        return self._index.get(value)
+
+
+class _OffsetIndex(Mapping):
+    """Read-only mapping from a string table to rows of a flat array via an offset table"""
+    def __init__(self, keys, offsets, decode):
+        self.keys_table = keys
+        self.offsets = offsets
+        self.decode = decode
+
+    def __getitem__(self, key):
+        position = self.keys_table.position(key)
+        if position is None:
+            raise KeyError(key)
+        return self.decode(self.offsets[position], self.offsets[position + 1])
+
+    def __contains__(self, key):
+        # Mapping's default would decode the whole row just to test membership
+        return self.keys_table.position(key) is not None
+
+    def __iter__(self):
+        return (self.keys_table[i] for i in range(len(self.keys_table)))
+
+    def __len__(self):
+        return len(self.keys_table)
+
+
+class GTFSSnapshot:
+    def __init__(self, path, mm, sections, key):
+        self.path = path
+        self.key = key
+        self._mm = mm
+        self._view = memoryview(mm)
+        self._sections = sections
+        self._line_keys = None
+
+    def section(self, name):
+        offset, length = self._sections[name]
+        return self._view[offset:offset + length]
+
+    def has_section(self, name):
+        return name in self._sections
+
+    def array(self, name, typecode):
+        return self.section(name).cast(typecode)
+
+    def strings(self, name):
+        return _StringTable(self.array(f"{name}.off", 'I'), self.section(f"{name}.str"))
+
+    def line_keys(self):
+        """The line_keys string table, built once so its reverse index is kept between lookups"""
+        if self._line_keys is None:
+            self._line_keys = self.strings('line_keys')
+        return self._line_keys
+
+    def json(self, name):
+        return json.loads(str(self.section(name), 'utf-8'))
+
+    def shape_points(self, shape_index):
+        """Decode one shape into the [{'Y', 'X', 'seq'}] point list used by the API"""
+        offsets = self.array('shape_offsets', 'I')
+        lat, lon, seq = self.array('shape_lat', 'd'), self.array('shape_lon', 'd'), self.array('shape_seq', 'i')
+        return [{'Y': lat[i], 'X': lon[i], 'seq': seq[i]} for i in range(offsets[shape_index], offsets[shape_index + 1])]
+
+    def shape_track(self, line_key, shape_index):
+        """ShapeTrack over the mapped arrays of line_paths[line_key][shape_index] (no copy)"""
+        position = self.line_keys().position(line_key)
+        line_offsets = self.array('line_shape_off', 'I')
+        if position is None or not 0 <= shape_index < line_offsets[position + 1] - line_offsets[position]:
+            return None
+        shape = self.array('line_shapes', 'I')[line_offsets[position] + shape_index]
+        offsets = self.array('shape_offsets', 'I')
+        start, end = offsets[shape], offsets[shape + 1]
+        return ShapeTrack(self.array('shape_lat', 'd')[start:end], self.array('shape_lon', 'd')[start:end],
+                          self.array('shape_dist', 'd')[start:end])
+
+    def line_paths(self):
+        line_shapes = self.array('line_shapes', 'I')
+        return _OffsetIndex(self.line_keys(), self.array('line_shape_off', 'I'),
+                            lambda start, end: [self.shape_points(line_shapes[i]) for i in range(start, end)])
+
+    def station_lines(self):
+        route_ids = self.strings('route_ids')
+        lines = self.array('station_lines', 'I')
+        return _OffsetIndex(self.strings('station_keys'), self.array('station_line_off', 'I'),
+                            lambda start, end: [route_ids[lines[i]] for i in range(start, end)])
+
+    def line_stations_memory(self):
+        blob = self.section('memory_json')
+        return _OffsetIndex(self.strings('memory_keys'), self.array('memory_off', 'I'),
+                            lambda start, end: json.loads(str(blob[start:end], 'utf-8')))
+
+    def stop_patterns(self):
+        """{route_id: [{'direction_id', 'shape_index', 'trip_count', 'stops'}]}, decoded per route"""
+        direction, shape, trips = self.array('pattern_direction', 'i'), self.array('pattern_shape', 'i'), self.array('pattern_trips', 'I')
+        stop_offsets, pattern_stops = self.array('pattern_stop_off', 'I'), self.array('pattern_stops', 'I')
+        sequence, distance = self.array('pattern_stop_seq', 'i'), self.array('pattern_stop_dist', 'f')
+        segment, fraction = self.array('pattern_stop_seg', 'i'), self.array('pattern_stop_frac', 'f')
+        ids, names = self.strings('pattern_stop_ids'), self.strings('pattern_stop_names')
+        lat, lon = self.array('pattern_stop_lat', 'd'), self.array('pattern_stop_lon', 'd')
+
+        def decode_stops(p):
+            result = []
+            for i in range(stop_offsets[p], stop_offsets[p + 1]):
+                s = pattern_stops[i]
+                result.append({'stop_id': ids[s], 'name': names[s], 'lat': lat[s], 'lon': lon[s],
+                               'stop_sequence': sequence[i],
+                               'segment': segment[i] if segment[i] >= 0 else None,
+                               'fraction': round(fraction[i], 4) if segment[i] >= 0 else None,
+                               'dist_m': round(distance[i], 1)})
+            return result
+
+        return _OffsetIndex(self.strings('pattern_routes'), self.array('pattern_route_off', 'I'),
+                            lambda start, end: [{'direction_id': direction[p],
+                                                 'shape_index': shape[p] if shape[p] >= 0 else None,
+                                                 'trip_count': trips[p],
+                                                 'stops': decode_stops(p)} for p in range(start, end)])
+
+    def routes(self):
+        return self.json('routes')
+
+    def stops(self):
+        ids, names = self.strings('stop_ids'), self.strings('stop_names')
+        lat, lon = self.array('stop_lat', 'd'), self.array('stop_lon', 'd')
+        return [{"lat": lat[i], "lon": lon[i], "name": names[i], "id": ids[i]} for i in range(len(lat))]
+
+    def stop_count(self):
+        return len(self.array('stop_lat', 'd'))
+
+    def index_stops(self):
+        """(ids, names, lat, lon) columns of the spatial index stops, mapped without a copy"""
+        return (self.strings('index_stop_ids'), self.strings('index_stop_names'),
+                self.array('index_stop_lat', 'd'), self.array('index_stop_lon', 'd'))
+
+
+def open_snapshot(path, key):
+    """
+    Map a snapshot file read-only. Returns None when the file is missing, corrupt,
+    from another format version or byte order, or was built from a different feed.
+    """
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError, OSError) as e:
+        print(f"GTFS snapshot {path} not available ({e}).")
+        return None
+
+    try:
+        magic, version, byte_order, section_count, stored_key = _HEADER.unpack_from(mm, 0)
+    except struct.error:
+        magic = None
+    if magic != MAGIC or version != SNAPSHOT_VERSION or byte_order != _BYTE_ORDERS[sys.byteorder]:
+        print(f"GTFS snapshot {path} has an unsupported format, ignoring it.")
+        mm.close()
+        return None
+    if stored_key != key:
+        print(f"GTFS snapshot {path} was built from a different feed, ignoring it.")
+        mm.close()
+        return None
+
+    sections = {}
+    for i in range(section_count):
+        name, offset, length = _SECTION.unpack_from(mm, _HEADER.size + i * _SECTION.size)
+        if offset + length > len(mm):
+            print(f"GTFS snapshot {path} is truncated, ignoring it.")
+            mm.close()
+            return None
+        sections[name.rstrip(b'\0').decode('ascii')] = (offset, length)
+    return GTFSSnapshot(path, mm, sections, stored_key)
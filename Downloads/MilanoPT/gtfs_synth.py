@@ -0,0 +1,388 @@
+# Synthetic GTFS feeds shaped like Milan's ATM network, to test how ingest and queries scale
+# without the real ~1 GB feed. A feed has metro, tram and bus lines over a pool of stops that
+# is densest in the centre: metro and tram lines cross the city through the centre, two bus
+# lines ring it and the other buses run between outer neighbourhoods, so lines share stops and
+# journeys need transfers. Timetables have peak, daytime and evening headways, separate
+# weekday/Saturday/Sunday services for winter and summer, holidays in calendar_dates.txt and
+# trips running past midnight.
+#
+# --scale 1 has about the route and stop counts of the ATM urban network; the number of routes
+# and stops grows with the scale over an area that grows with it too, so density and line
+# lengths stay Milan-like. Every count can be set explicitly as well:
+#
+#   python gtfs_synth.py synthetic-1x --scale 1
+#   python gtfs_synth.py synthetic-5x --scale 5
+#   python gtfs_synth.py synthetic-20x --scale 20 --seed 3
+#
+# The output directory holds given_data/, stops_processed.csv and FINAL.json, so the app,
+# ingest_gtfs() and benchmark.py --data-dir can run from it directly.
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import random
+import time
+
+CENTER_LAT, CENTER_LON = 45.4642, 9.1900
+_METERS_PER_DEGREE = 111320
+
+# Per scale 1
+BASE_METRO_LINES = 5
+BASE_TRAM_LINES = 18
+BASE_BUS_LINES = 140
+BASE_STOPS = 6000
+BASE_RADIUS_M = 11000
+
+# route_type: (stop spacing in m, average speed in m/s including dwell, headways in minutes at
+# peak / daytime / evening, minutes the service starts before 05:30 and ends after 00:30)
+LINE_TYPES = {
+    '1': (900, 9.0, (3, 5, 8), 30, 30),
+    '0': (400, 4.5, (7, 10, 15), 15, 0),
+    '3': (350, 4.2, (10, 15, 25), 0, 0),
+}
+METRO_COLORS = ['E1001A', '8F3BA9', 'FCBE00', '0098D4', '00A34F']
+# (start, end, band) in seconds of the service day; band indexes the headway triple
+TIME_BANDS = [(5 * 3600 + 1800, 7 * 3600, 2), (7 * 3600, 9 * 3600 + 1800, 0), (9 * 3600 + 1800, 16 * 3600 + 1800, 1),
+              (16 * 3600 + 1800, 19 * 3600 + 1800, 0), (19 * 3600 + 1800, 24 * 3600 + 1800, 2)]
+# Headway multipliers of each service; summer runs July and August
+SERVICES = {'FER_INV': 1.0, 'SAB_INV': 1.25, 'FES_INV': 1.6, 'FER_EST': 1.3, 'SAB_EST': 1.5, 'FES_EST': 1.8}
+# Holidays with Sunday service: the national ones plus Sant'Ambrogio (7 December)
+HOLIDAYS = [(1, 1), (1, 6), (4, 25), (5, 1), (6, 2), (8, 15), (11, 1), (12, 7), (12, 8), (12, 25), (12, 26)]
+STREETS = ['v.le monza', 'c.so buenos aires', 'p.za duomo', 'v.le abruzzi', 'via padova', 'c.so sempione',
+           'v.le certosa', 'via novara', 'v.le forlanini', 'c.so lodi', 'via ripamonti', 'v.le famagosta',
+           'via lorenteggio', 'p.le loreto', 'c.so vercelli', 'via washington', 'v.le fulvio testi',
+           'via vittor pisani', 'c.so di porta romana', 'v.le tibaldi', 'via giambellino', 'v.le zara',
+           'p.za firenze', 'via mecenate', 'v.le umbria', 'c.so XXII marzo', 'via dei missaglia', 'v.le piave',
+           'via palmanova', 'v.le jenner', 'via bovisasca', 'p.le cadorna', 'via larga', 'c.so magenta',
+           'via console marcello', 'v.le ca granda', 'via gallarate', 'v.le sarca', 'via rogoredo', 'v.le lucania']
+
+
+def _time_strings(limit):
+    """HH:MM:SS of every second up to limit, past 24:00 for trips ending after midnight"""
+    return [f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in range(limit)]
+
+
+class StopPool:
+    """Stops scattered over a disc, denser towards the centre, with a grid for neighbour lookups"""
+    def __init__(self, count, radius, rng, cell=250):
+        self.cell = cell
+        self.xy = []
+        self.grid = {}
+        for _ in range(count):
+            r = radius * rng.random() ** 0.7
+            angle = rng.random() * 2 * math.pi
+            self.add(r * math.cos(angle), r * math.sin(angle))
+
+    def add(self, x, y):
+        stop = len(self.xy)
+        self.xy.append((x, y))
+        self.grid.setdefault((int(x // self.cell), int(y // self.cell)), []).append(stop)
+        return stop
+
+    def near(self, x, y, radius):
+        reach = int(radius // self.cell) + 1
+        cx, cy = int(x // self.cell), int(y // self.cell)
+        for gx in range(cx - reach, cx + reach + 1):
+            for gy in range(cy - reach, cy + reach + 1):
+                for stop in self.grid.get((gx, gy), ()):
+                    sx, sy = self.xy[stop]
+                    if (sx - x) ** 2 + (sy - y) ** 2 <= radius * radius:
+                        yield stop
+
+    def nearest(self, x, y):
+        radius = self.cell
+        while True:
+            found = min(self.near(x, y, radius), default=None,
+                        key=lambda stop: (self.xy[stop][0] - x) ** 2 + (self.xy[stop][1] - y) ** 2)
+            if found is not None:
+                return found
+            radius *= 2
+
+
+def walk_line(pool, waypoints, spacing):
+    """
+    Stops of a line through the waypoints: step about `spacing` towards the next waypoint and
+    take the pool stop nearest to that point, or go on without a stop where there is none
+    """
+    stops = [pool.nearest(*waypoints[0])]
+    seen = set(stops)
+    x, y = pool.xy[stops[0]]
+    for tx, ty in waypoints[1:]:
+        for _ in range(10000):
+            dx, dy = tx - x, ty - y
+            distance = math.hypot(dx, dy)
+            if distance < spacing * 0.75:
+                break
+            ix, iy = x + dx / distance * spacing, y + dy / distance * spacing
+            candidates = [stop for stop in pool.near(ix, iy, spacing * 0.7) if stop not in seen
+                          and (pool.xy[stop][0] - x) * dx + (pool.xy[stop][1] - y) * dy > spacing * 0.4 * distance]
+            if candidates:
+                stop = min(candidates, key=lambda stop: (pool.xy[stop][0] - ix) ** 2 + (pool.xy[stop][1] - iy) ** 2)
+                stops.append(stop)
+                seen.add(stop)
+                x, y = pool.xy[stop]
+            else:
+                x, y = ix, iy
+    return stops
+
+
+def _next_number(numbers, kind, taken, skip):
+    number = numbers[kind] + skip
+    while str(number) in taken:
+        number += 1
+    numbers[kind] = number + 1
+    taken.add(str(number))
+    return str(number)
+
+
+def _random_point(radius, rng, low=0.0):
+    r = radius * rng.uniform(low, 1.0)
+    angle = rng.random() * 2 * math.pi
+    return r * math.cos(angle), r * math.sin(angle)
+
+
+def line_waypoints(kind, index, radius, rng):
+    """
+    Where a line goes. Metro and tram lines cross a hub: the centre for the first BASE_*_LINES
+    of them, a random district beyond that. The first two buses ring the centre and the others
+    link a few districts a couple of kilometres apart. Lengths don't grow with the scale.
+    """
+    if kind in ('1', '0'):
+        base = BASE_METRO_LINES if kind == '1' else BASE_TRAM_LINES
+        hub = (0.0, 0.0) if index < base else _random_point(radius * 0.7, rng)
+        angle = (index % base + rng.random() * 0.5) * math.pi / base
+        reach = rng.uniform(6000, 9000) if kind == '1' else rng.uniform(3500, 6500)
+        bend = rng.uniform(-0.35, 0.35)
+        return [(hub[0] + reach * math.cos(angle), hub[1] + reach * math.sin(angle)),
+                (hub[0] + 300 * math.cos(angle + math.pi / 2), hub[1] + 300 * math.sin(angle + math.pi / 2)),
+                (hub[0] + reach * math.cos(angle + math.pi + bend), hub[1] + reach * math.sin(angle + math.pi + bend))]
+    if index < 2:
+        ring = 3300 if index == 0 else 5500
+        return [(ring * math.cos(step * math.pi / 12), ring * math.sin(step * math.pi / 12)) for step in range(25)]
+    points = [_random_point(radius, rng, 0.1)]
+    for _ in range(rng.choice((2, 3, 3, 4))):
+        step, angle = rng.uniform(2500, 6000), rng.random() * 2 * math.pi
+        x, y = points[-1][0] + step * math.cos(angle), points[-1][1] + step * math.sin(angle)
+        scale = min(1.0, radius / max(math.hypot(x, y), 1.0))  # stay inside the network
+        points.append((x * scale, y * scale))
+    return points
+
+
+def departures(headways, start_early, end_late, multiplier, frequency, rng):
+    """Trip start times (seconds) over the day's time bands"""
+    times = []
+    t = TIME_BANDS[0][0] - start_early * 60 + rng.randrange(0, 300)
+    end = TIME_BANDS[-1][1] + end_late * 60
+    while t < end:
+        band = next((b for start, stop, b in TIME_BANDS if start <= t < stop), 2)
+        times.append(t)
+        t += max(60, int(headways[band] * 60 * multiplier / frequency))
+    return times
+
+
+def generate(output, scale=1.0, metro=None, tram=None, bus=None, stops=None, frequency=1.0, start=None, days=400, seed=1):
+    """Write a feed to output/given_data plus the app's stops_processed.csv and FINAL.json; returns its summary"""
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    counts = {'1': round(BASE_METRO_LINES * math.sqrt(scale)) if metro is None else metro,
+              '0': round(BASE_TRAM_LINES * scale) if tram is None else tram,
+              '3': round(BASE_BUS_LINES * scale) if bus is None else bus}
+    stop_count = round(BASE_STOPS * scale) if stops is None else stops
+    radius = BASE_RADIUS_M * math.sqrt(scale)
+    pool = StopPool(stop_count, radius, rng)
+    lon_scale = _METERS_PER_DEGREE * math.cos(math.radians(CENTER_LAT))
+
+    def lat_lon(stop):
+        x, y = pool.xy[stop]
+        return round(CENTER_LAT + y / _METERS_PER_DEGREE, 6), round(CENTER_LON + x / lon_scale, 6)
+
+    # Lines: (route_id, short_name, route_type, stops in direction 0)
+    lines = []
+    # Trams are numbered from 1 and buses from 34 as in Milan, never reusing the rings' 90 and 91
+    taken = {'90', '91'}
+    numbers = {'0': 1, '3': 34}
+    for kind in ('1', '0', '3'):
+        for index in range(counts[kind]):
+            spacing = LINE_TYPES[kind][0]
+            line_stops = walk_line(pool, line_waypoints(kind, index, radius, rng), spacing)
+            if len(line_stops) < 2:
+                continue
+            if kind == '1':
+                route_id = short_name = f"M{index + 1}"
+            elif kind == '0':
+                short_name = _next_number(numbers, kind, taken, 0)
+                route_id = f"T{short_name}"
+            else:
+                short_name = str(90 + index) if index < 2 else _next_number(numbers, kind, taken, rng.random() < 0.3)
+                route_id = f"B{short_name}"
+            lines.append((route_id, short_name, kind, line_stops))
+
+    names = {}
+    for stop in range(len(pool.xy)):
+        names[stop] = f"{rng.choice(STREETS)} ({rng.choice(STREETS)})"
+    data_dir = os.path.join(output, 'given_data')
+    os.makedirs(data_dir, exist_ok=True)
+    start = start or datetime.date.today() - datetime.timedelta(days=30)
+    end = start + datetime.timedelta(days=days - 1)
+
+    def write_csv(name, header, rows):
+        with open(os.path.join(data_dir, name), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    write_csv('agency.txt', ['agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang'],
+              [['ATM', 'ATM Azienda Trasporti Milanesi', 'https://www.atm.it', 'Europe/Rome', 'it']])
+    write_csv('feed_info.txt', ['feed_publisher_name', 'feed_publisher_url', 'feed_lang', 'feed_start_date', 'feed_end_date'],
+              [['MilanoPT synthetic feed', 'https://www.atm.it', 'it', f"{start:%Y%m%d}", f"{end:%Y%m%d}"]])
+    write_csv('routes.txt', ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type', 'route_color'],
+              [[route_id, 'ATM', short_name, f"{names[line_stops[0]].split(' (')[0]} - {names[line_stops[-1]].split(' (')[0]}",
+                kind, METRO_COLORS[(int(short_name[1:]) - 1) % len(METRO_COLORS)] if kind == '1' else '']
+               for route_id, short_name, kind, line_stops in lines])
+    used = range(len(pool.xy))  # stops no line reaches are kept too, as in real feeds
+    write_csv('stops.txt', ['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon'],
+              [[10000 + stop, 10000 + stop, names[stop], *lat_lon(stop)] for stop in used])
+
+    # Weekday/Saturday/Sunday services in winter and summer: calendar.txt gives the days of the
+    # week, calendar_dates.txt switches the season and turns holidays into Sundays
+    write_csv('calendar.txt', ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+                               'sunday', 'start_date', 'end_date'],
+              [[service] + ([1] * 5 + [0, 0] if service.startswith('FER') else
+                            [0] * 5 + [1, 0] if service.startswith('SAB') else [0] * 6 + [1])
+               + [f"{start:%Y%m%d}", f"{end:%Y%m%d}"] for service in SERVICES])
+    exceptions = []
+    day = start
+    while day <= end:
+        summer = day.month in (7, 8)
+        kind = 'FES' if day.weekday() == 6 or (day.month, day.day) in HOLIDAYS else 'SAB' if day.weekday() == 5 else 'FER'
+        regular = 'FES' if day.weekday() == 6 else 'SAB' if day.weekday() == 5 else 'FER'
+        season, other = ('EST', 'INV') if summer else ('INV', 'EST')
+        exceptions.append([f"{regular}_{other}", f"{day:%Y%m%d}", 2])
+        if kind != regular:
+            exceptions.append([f"{regular}_{season}", f"{day:%Y%m%d}", 2])
+            exceptions.append([f"{kind}_{season}", f"{day:%Y%m%d}", 1])
+        day += datetime.timedelta(days=1)
+    write_csv('calendar_dates.txt', ['service_id', 'date', 'exception_type'], exceptions)
+
+    # Changes take longer at the stops metro lines share, and from a metro station up to the street
+    metro_stops = {}
+    for route_id, _, kind, line_stops in lines:
+        if kind == '1':
+            for stop in line_stops:
+                metro_stops[stop] = metro_stops.get(stop, 0) + 1
+    served = {stop for _, _, kind, line_stops in lines if kind != '1' for stop in line_stops}
+    transfers = []
+    for stop, count in sorted(metro_stops.items()):
+        if count > 1:
+            transfers.append([10000 + stop, 10000 + stop, 2, 240])
+        for other in sorted(pool.near(*pool.xy[stop], 200)):
+            if other != stop and other in served:
+                seconds = 120 + int(math.dist(pool.xy[stop], pool.xy[other]) / 1.2)
+                transfers += [[10000 + stop, 10000 + other, 2, seconds], [10000 + other, 10000 + stop, 2, seconds]]
+    write_csv('transfers.txt', ['from_stop_id', 'to_stop_id', 'transfer_type', 'min_transfer_time'], transfers)
+
+    times = _time_strings(30 * 3600)
+    trip_count = stop_time_count = shape_points = 0
+    with open(os.path.join(data_dir, 'shapes.txt'), 'w', encoding='utf-8') as shapes_file, \
+            open(os.path.join(data_dir, 'trips.txt'), 'w', encoding='utf-8') as trips_file, \
+            open(os.path.join(data_dir, 'stop_times.txt'), 'w', encoding='utf-8') as stop_times_file:
+        shapes_file.write('shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n')
+        trips_file.write('route_id,service_id,trip_id,trip_headsign,direction_id,shape_id\n')
+        stop_times_file.write('trip_id,arrival_time,departure_time,stop_id,stop_sequence\n')
+        for route_id, short_name, kind, line_stops in lines:
+            spacing, speed, headways, start_early, end_late = LINE_TYPES[kind]
+            route_factor = rng.uniform(0.8, 1.6) if kind == '3' else 1.0
+            for direction in (0, 1):
+                sequence = line_stops if direction == 0 else line_stops[::-1]
+                shape_id = f"{route_id}_{direction}"
+                # Shape: the stops joined by straight segments with a point every ~40 m
+                point = 0
+                rows = []
+                for a, b in zip(sequence, sequence[1:]):
+                    (alat, alon), (blat, blon) = lat_lon(a), lat_lon(b)
+                    pieces = max(1, int(math.dist(pool.xy[a], pool.xy[b]) // 40))
+                    for piece in range(pieces):
+                        rows.append(f"{shape_id},{alat + (blat - alat) * piece / pieces:.6f},"
+                                    f"{alon + (blon - alon) * piece / pieces:.6f},{point}\n")
+                        point += 1
+                last_lat, last_lon = lat_lon(sequence[-1])
+                rows.append(f"{shape_id},{last_lat:.6f},{last_lon:.6f},{point}\n")
+                shapes_file.writelines(rows)
+                shape_points += point + 1
+
+                # Seconds from the first stop to each stop, streets ~20% longer than straight lines
+                offsets = [0]
+                for a, b in zip(sequence, sequence[1:]):
+                    offsets.append(offsets[-1] + max(30, int(math.dist(pool.xy[a], pool.xy[b]) * 1.2 / speed)))
+                dwell = 20 if kind != '1' else 30
+                if len(times) <= TIME_BANDS[-1][1] + end_late * 60 + offsets[-1] + dwell:
+                    times = _time_strings(TIME_BANDS[-1][1] + end_late * 60 + offsets[-1] + dwell + 1)
+                stop_ids = [10000 + stop for stop in sequence]
+                headsign = names[sequence[-1]].split(' (')[0]
+                for service, multiplier in SERVICES.items():
+                    late_start = 3600 if service.startswith('FES') else 0
+                    for number, first in enumerate(departures(headways, start_early, end_late,
+                                                              multiplier * route_factor, frequency, rng)):
+                        if first < TIME_BANDS[0][0] + late_start - start_early * 60:
+                            continue
+                        trip_id = f"{route_id}_{service}_{direction}_{number}"
+                        trips_file.write(f"{route_id},{service},{trip_id},{headsign},{direction},{shape_id}\n")
+                        stop_times_file.write(''.join(
+                            f"{trip_id},{times[first + offset]},{times[first + offset + (dwell if 0 < i < len(offsets) - 1 else 0)]},"
+                            f"{stop_id},{i + 1}\n" for i, (offset, stop_id) in enumerate(zip(offsets, stop_ids))))
+                        trip_count += 1
+                        stop_time_count += len(stop_ids)
+
+    # The app's own inputs: every stop, and the stations of every line in direction 0 order
+    with open(os.path.join(output, 'stops_processed.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+        writer.writerows([10000 + stop, names[stop], *lat_lon(stop)] for stop in used)
+    memory = {}
+    for route_id, short_name, kind, line_stops in lines:
+        memory[route_id] = {
+            'stations': [{'name': names[stop], 'lat': lat_lon(stop)[0], 'lon': lat_lon(stop)[1], 'code': '',
+                          'stop_id': str(10000 + stop), 'sequence': i + 1} for i, stop in enumerate(line_stops)],
+            'route_info': {'short_name': short_name, 'long_name': '', 'type': kind},
+            'station_count': len(line_stops),
+            'ordering_method': 'synthetic'
+        }
+    with open(os.path.join(output, 'FINAL.json'), 'w', encoding='utf-8') as f:
+        json.dump(memory, f, ensure_ascii=False, indent=1)
+
+    summary = {'scale': scale, 'seed': seed, 'frequency': frequency, 'start_date': f"{start:%Y-%m-%d}", 'days': days,
+               'routes': len(lines), 'metro': counts['1'], 'tram': counts['0'], 'bus': counts['3'], 'stops': len(used),
+               'stops_served': len({stop for line in lines for stop in line[3]}), 'trips': trip_count,
+               'stop_times': stop_time_count, 'shape_points': shape_points, 'calendar_dates': len(exceptions),
+               'bytes': {name: os.path.getsize(os.path.join(data_dir, name)) for name in sorted(os.listdir(data_dir))},
+               'seconds': round(time.perf_counter() - started, 1)}
+    # Kept next to the feed (not in given_data, so it isn't part of the snapshot key)
+    with open(os.path.join(output, 'synthetic_feed.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic GTFS feed shaped like the ATM network')
+    parser.add_argument('output', help='directory for given_data/, stops_processed.csv and FINAL.json')
+    parser.add_argument('--scale', type=float, default=1.0, help='1 is about the size of the real urban network')
+    parser.add_argument('--metro', type=int, help='metro lines (default: 5 times the square root of the scale)')
+    parser.add_argument('--tram', type=int, help=f'tram lines (default: {BASE_TRAM_LINES} times the scale)')
+    parser.add_argument('--bus', type=int, help=f'bus lines (default: {BASE_BUS_LINES} times the scale)')
+    parser.add_argument('--stops', type=int, help=f'stops (default: {BASE_STOPS} times the scale)')
+    parser.add_argument('--frequency', type=float, default=1.0, help='trips per hour relative to ATM-like headways')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, help='first service day (default: 30 days ago)')
+    parser.add_argument('--days', type=int, default=400, help='service days covered')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    summary = generate(args.output, args.scale, args.metro, args.tram, args.bus, args.stops, args.frequency,
+                       args.start, args.days, args.seed)
+    print(f"Wrote {summary['routes']} routes ({summary['metro']} metro, {summary['tram']} tram, {summary['bus']} bus), "
+          f"{summary['stops']} stops, {summary['trips']} trips and {summary['stop_times']} stop times "
+          f"to {args.output} in {summary['seconds']}s")
+
+
+if __name__ == '__main__':
+    main()
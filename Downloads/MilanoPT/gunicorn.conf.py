@@ -0,0 +1,28 @@
+# gunicorn settings for wsgi.py; every value can be overridden from the environment
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# /line_stream keeps a thread busy for as long as a map is open. Each worker accepts at most
+# LINE_STREAM_MAX_SUBSCRIBERS streams (default: half of its threads) and answers 503 past
+# that, which makes the page poll /get_line_vehicle_data instead, so the other half of the
+# threads stays free for every other endpoint (and /healthz, /readyz).
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+# Load FINAL once in the master and fork afterwards (see wsgi.py)
+preload_app = True
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+keepalive = 5
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+
+
+def when_ready(server):
+    # Without the shared store every worker has its own ATM cache and its own line poller,
+    # so upstream calls grow with the number of workers
+    if workers > 1 and not os.environ.get('ATM_CACHE_REDIS_URL'):
+        server.log.warning(f"{workers} workers without ATM_CACHE_REDIS_URL: ATM polling is repeated in every worker")
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} forked with the GTFS snapshot already mapped")
@@ -0,0 +1,259 @@
+# Earliest-arrival journey planning with the Connection Scan Algorithm over the timetable
+# columns: every pair of consecutive stop times of a trip is a connection, and scanning them
+# once in departure order settles the earliest arrival at every stop.
+import datetime
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from math import cos, radians, sqrt
+
+# Walking links are drawn between stops closer than this, at WALK_SPEED_MPS
+WALK_RADIUS_M = 400
+WALK_SPEED_MPS = 1.2
+# Time to change vehicles at a stop when transfers.txt says nothing about it
+MIN_CHANGE_SECONDS = 60
+# Connections are scanned at most this long after the departure
+MAX_JOURNEY_SECONDS = 4 * 3600
+
+_INF = 1 << 30
+_METERS_PER_DEGREE = 111320
+
+
+def build_connections(row_trip, row_stop, row_seconds, trip_offsets):
+    """
+    The connection list: stop time rows that have a next stop in their trip, in departure order,
+    as (rows, departures, trips, from stops) columns. The scan reads the last three in step, so
+    it never has to go through the row for the connections it skips, which are most of them.
+    """
+    rows = array('I')
+    for trip in range(len(trip_offsets) - 1):
+        rows.extend(range(trip_offsets[trip], trip_offsets[trip + 1] - 1))
+    rows = array('I', sorted(rows, key=row_seconds.__getitem__))
+    return (rows, array('i', map(row_seconds.__getitem__, rows)), array('I', map(row_trip.__getitem__, rows)),
+            array('I', map(row_stop.__getitem__, rows)))
+
+
+def build_footpaths(stop_ids, stop_lat, stop_lon, transfers):
+    """
+    Walking links between stops (indexes in stop_ids) as a CSR index: (offsets, to, seconds),
+    plus the change time of every stop. Stops within WALK_RADIUS_M are linked at walking speed;
+    transfers.txt rows then override a pair's time (min_transfer_time), forbid it (type 3) or
+    set the change time of a stop when from_stop_id == to_stop_id.
+    """
+    count = len(stop_lat)
+    reference_lat = sum(stop_lat) / count if count else 45.4642
+    lon_scale = cos(radians(reference_lat))
+    cell = WALK_RADIUS_M / _METERS_PER_DEGREE
+    cells = {}
+    for stop in range(count):
+        cells.setdefault((int(stop_lat[stop] // cell), int(stop_lon[stop] * lon_scale // cell)), []).append(stop)
+
+    links = [{} for _ in range(count)]
+    for (cy, cx), members in cells.items():
+        neighbours = [other for dy in (-1, 0, 1) for dx in (-1, 0, 1) for other in cells.get((cy + dy, cx + dx), ())]
+        for stop in members:
+            lat, lon = stop_lat[stop], stop_lon[stop]
+            for other in neighbours:
+                if other == stop:
+                    continue
+                distance = _METERS_PER_DEGREE * sqrt((stop_lat[other] - lat) ** 2 + ((stop_lon[other] - lon) * lon_scale) ** 2)
+                if distance <= WALK_RADIUS_M:
+                    links[stop][other] = max(1, round(distance / WALK_SPEED_MPS))
+
+    change = array('i', [MIN_CHANGE_SECONDS]) * count
+    for from_id, to_id, transfer_type, seconds in transfers:
+        origin, target = stop_ids.get(from_id), stop_ids.get(to_id)
+        if origin is None or target is None:
+            continue
+        if origin == target:
+            if transfer_type != 3:
+                change[origin] = seconds if seconds is not None else change[origin]
+        elif transfer_type == 3:
+            links[origin].pop(target, None)
+        else:
+            links[origin][target] = max(1, seconds if seconds is not None else links[origin].get(target, 0))
+
+    offsets, to, walk_seconds = array('I', [0]), array('I'), array('i')
+    for stop_links in links:
+        for target, seconds in sorted(stop_links.items()):
+            to.append(target)
+            walk_seconds.append(seconds)
+        offsets.append(len(to))
+    return offsets, to, walk_seconds, change
+
+
+class JourneyPlanner:
+    """Earliest-arrival itineraries between sets of stops, read from a Timetable"""
+    def __init__(self, timetable, snapshot):
+        self.tt = timetable
+        self.connections = snapshot.array('tt_conn_rows', 'I')
+        self.connection_departures = snapshot.array('tt_conn_dep', 'i')
+        self.connection_trips = snapshot.array('tt_conn_trip', 'I')
+        self.connection_stops = snapshot.array('tt_conn_from', 'I')
+        self.walk_offsets = snapshot.array('tt_walk_off', 'I')
+        self.walk_to = snapshot.array('tt_walk_to', 'I')
+        self.walk_seconds = snapshot.array('tt_walk_sec', 'i')
+        self.change_seconds = snapshot.array('tt_stop_change', 'i')
+        self._last_departure = self.connection_departures[-1] if len(self.connections) else 0
+
+    def stop_access(self, stop_id):
+        """[(stop index, walk seconds)]: the stop itself and the stops within walking distance"""
+        stop = self.tt.stop_ids.position(stop_id)
+        if stop is None:
+            return []
+        return [(stop, 0)] + [(self.walk_to[i], self.walk_seconds[i])
+                              for i in range(self.walk_offsets[stop], self.walk_offsets[stop + 1])]
+
+    def _events(self, t):
+        """
+        (departure, trip key, from stop, row) of the connections leaving from t on. The trip key
+        is the trip index for today's service; yesterday's trips still running after midnight
+        are merged in shifted back by a day, with len(trips) added to their key.
+        """
+        departures, trips, stops, rows = self.connection_departures, self.connection_trips, self.connection_stops, self.connections
+        start = bisect_left(departures, t)
+        events = zip(departures[start:], trips[start:], stops[start:], rows[start:])
+        if t + 86400 <= self._last_departure:
+            start = bisect_left(departures, t + 86400)
+            offset = len(self.tt.trip_start)
+            events = merge(events, ((departures[i] - 86400, trips[i] + offset, stops[i], rows[i])
+                                    for i in range(start, len(rows))))
+        return events
+
+    def earliest_arrival(self, origins, destinations, day, depart, max_duration=MAX_JOURNEY_SECONDS):
+        """
+        One earliest-arrival journey leaving at `depart` (seconds into `day`'s service day) from
+        any of origins to any of destinations ([(stop index, walk seconds)] each), as
+        (arrival, legs) or None. The scan stops at the first connection leaving after the best
+        arrival found so far, so short journeys only touch a short slice of the day.
+        """
+        tt = self.tt
+        row_stop, seconds, trip_service = tt.row_stop, tt.seconds, tt.trip_service
+        walk_offsets, walk_to, walk_seconds, change = self.walk_offsets, self.walk_to, self.walk_seconds, self.change_seconds
+        arrival = array('i', [_INF]) * len(tt.stop_ids)
+        ready = array('i', [_INF]) * len(tt.stop_ids)  # earliest time a vehicle can be boarded there
+        via = {}  # stop -> ('access', walk) | ('ride', boarding row, alighting row, shift) | ('walk', from stop, seconds)
+        targets = {}
+        for stop, walk in destinations:
+            targets[stop] = min(walk, targets.get(stop, _INF))
+        best, best_stop = _INF, None
+        for stop, walk in origins:
+            if depart + walk < arrival[stop]:
+                arrival[stop] = ready[stop] = depart + walk
+                via[stop] = ('access', walk)
+                if stop in targets and arrival[stop] + targets[stop] < best:
+                    best, best_stop = arrival[stop] + targets[stop], stop
+
+        trip_count = len(tt.trip_start)
+        services = (tt.active_services(day), tt.active_services(day - datetime.timedelta(days=1)))
+        boarded = array('i', [-1]) * (2 * trip_count)  # trip key -> boarding row, -2 when not running
+        last = min(best, depart + max_duration)
+        for dep, key, from_stop, row in self._events(depart):
+            if dep >= last:
+                break
+            if boarded[key] < 0:
+                if ready[from_stop] > dep or boarded[key] == -2:
+                    continue
+                yesterday = key >= trip_count
+                if trip_service[key - trip_count if yesterday else key] not in services[yesterday]:
+                    boarded[key] = -2
+                    continue
+                boarded[key] = row
+            shift = 86400 if key >= trip_count else 0
+            arrive = seconds[row + 1] - shift
+            stop = row_stop[row + 1]
+            if arrive >= arrival[stop]:
+                continue
+            arrival[stop] = arrive
+            ready[stop] = min(ready[stop], arrive + change[stop])
+            via[stop] = ('ride', boarded[key], row + 1, shift)
+            if stop in targets and arrive + targets[stop] < best:
+                best, best_stop = arrive + targets[stop], stop
+                last = min(best, last)
+            for i in range(walk_offsets[stop], walk_offsets[stop + 1]):
+                other, walked = walk_to[i], arrive + walk_seconds[i]
+                if walked < arrival[other]:
+                    arrival[other] = walked
+                    ready[other] = min(ready[other], walked)
+                    via[other] = ('walk', stop, walk_seconds[i])
+                    if other in targets and walked + targets[other] < best:
+                        best, best_stop = walked + targets[other], other
+                        last = min(best, last)
+
+        if best_stop is None:
+            return None
+        return best, self._legs(via, best_stop, targets[best_stop])
+
+    def _legs(self, via, stop, egress):
+        """Walk back from the destination stop through `via`, in travel order"""
+        tt = self.tt
+        legs = [{'mode': 'walk', 'from': self._stop(stop), 'to': None, 'seconds': egress}] if egress else []
+        for _ in range(len(via) + 1):
+            step = via[stop]
+            if step[0] == 'access':
+                if step[1]:
+                    legs.append({'mode': 'walk', 'from': None, 'to': self._stop(stop), 'seconds': step[1]})
+                break
+            if step[0] == 'walk':
+                _, origin, walked = step
+                legs.append({'mode': 'walk', 'from': self._stop(origin), 'to': self._stop(stop), 'seconds': walked})
+                stop = origin
+                continue
+            _, board, alight, shift = step
+            trip = tt.row_trip[board]
+            legs.append({
+                'mode': 'ride',
+                'route_id': tt.trip_route(trip),
+                'trip_id': tt.trip_ids[trip],
+                'direction_id': tt.trip_direction[trip],
+                'from': self._stop(tt.row_stop[board]),
+                'to': self._stop(tt.row_stop[alight]),
+                'departure': tt.seconds[board] - shift,
+                'arrival': tt.seconds[alight] - shift,
+                'stops': alight - board
+            })
+            stop = tt.row_stop[board]
+        legs.reverse()
+        return legs
+
+    def _stop(self, stop):
+        tt = self.tt
+        return {'stop_id': tt.stop_ids[stop], 'name': tt.stop_names[stop], 'lat': tt.stop_lat[stop], 'lon': tt.stop_lon[stop]}
+
+    def plan(self, origins, destinations, when=None, count=3):
+        """
+        Up to `count` itineraries from origins to destinations leaving from `when` (default:
+        now), each the earliest arrival for a departure after the previous one's first vehicle.
+        Itineraries are {'departure', 'arrival', 'duration_s', 'transfers', 'legs'}, times in
+        seconds into the service day of `when`.
+        """
+        when = when or self.tt.now()
+        day = when.date()
+        depart = when.hour * 3600 + when.minute * 60 + when.second
+        itineraries, seen = [], set()
+        for _ in range(count * 3):
+            found = self.earliest_arrival(origins, destinations, day, depart)
+            if found is None:
+                break
+            arrive, legs = found
+            rides = [leg for leg in legs if leg['mode'] == 'ride']
+            signature = tuple((leg['trip_id'], leg['from']['stop_id']) for leg in rides)
+            # Only the access walk can come before the first ride
+            leave = rides[0]['departure'] - (legs[0]['seconds'] if legs[0]['mode'] == 'walk' else 0) if rides else depart
+            if itineraries and arrive == itineraries[-1]['arrival']:
+                itineraries.pop()  # same arrival for a later departure: that one is strictly better
+            if signature not in seen:
+                seen.add(signature)
+                clock = leave
+                for leg in legs:
+                    if leg['mode'] == 'walk':
+                        leg['departure'], leg['arrival'] = clock, clock + leg['seconds']
+                    clock = leg['arrival']
+                itineraries.append({'departure': leave, 'arrival': arrive, 'duration_s': arrive - leave,
+                                    'transfers': max(0, len(rides) - 1), 'legs': legs})
+                if len(itineraries) >= count:
+                    break
+            if not rides:
+                break  # walking is always the fastest from here on
+            depart = leave + 1
+        return itineraries
@@ -0,0 +1,96 @@
+# Precomputed resolution of user input ("M5", "5", "m5", "90", "B90", ...) to a GTFS route
+
+# GTFS route_type -> vehicle type and the prefix users put in front of the line number
+VEHICLE_TYPES = {'1': 'METRO', '0': 'TRAM', '3': 'BUS'}
+ROUTE_PREFIXES = {'1': 'M', '0': 'T', '3': 'B'}
+
+# Lower rank wins when an alias could mean more than one route
+_RANK_ROUTE_ID = 0
+_RANK_SHORT_NAME = 1
+_RANK_PREFIXED = 2
+_RANK_UNPREFIXED = 3
+
+# Tie-break between routes sharing an alias: metro first, then tram, then bus
+_TYPE_PRIORITY = {'1': 0, '0': 1, '3': 2}
+
+
+def strip_line_prefix(line_number):
+    return line_number.lstrip('MTB')
+
+
+class LineIndex:
+    """
+    Maps every alias of every route (route_id, short_name, prefixed and unprefixed forms,
+    case-insensitively) to its canonical entry in O(1).
+    Aliases that several routes share, at any rank, are kept in `ambiguous` ({alias: [route_ids]},
+    best match first) and resolve to the route with the lowest rank, then the highest priority.
+    """
+    def __init__(self, routes):
+        candidates = {}  # alias -> {route_id: best rank}
+        self.entries = {}
+        for route_id, route_info in routes.items():
+            short_name = route_info.get('short_name', '')
+            route_type = route_info.get('type', '')
+            self.entries[route_id] = {
+                'route_id': route_id,
+                'short_name': short_name,
+                'route_type': route_type,
+                'vehicle_type': VEHICLE_TYPES.get(route_type, 'BUS'),
+                'number': strip_line_prefix(route_id) or route_id
+            }
+            prefix = ROUTE_PREFIXES.get(route_type, '')
+            aliases = [
+                (route_id, _RANK_ROUTE_ID),
+                (short_name, _RANK_SHORT_NAME),
+                (prefix + strip_line_prefix(short_name), _RANK_PREFIXED),
+                (strip_line_prefix(route_id), _RANK_UNPREFIXED),
+                (strip_line_prefix(short_name), _RANK_UNPREFIXED),
+            ]
+            for alias, rank in aliases:
+                alias = alias.upper()
+                if not alias:
+                    continue
+                ranks = candidates.setdefault(alias, {})
+                ranks[route_id] = min(rank, ranks.get(route_id, rank))
+
+        self.aliases = {}
+        self.ambiguous = {}
+        for alias, ranks in candidates.items():
+            matches = sorted(ranks, key=lambda route_id: (
+                ranks[route_id], _TYPE_PRIORITY.get(self.entries[route_id]['route_type'], 9), route_id))
+            self.aliases[alias] = matches[0]
+            if len(matches) > 1:
+                self.ambiguous[alias] = matches
+
+        if self.ambiguous:
+            print(f"Line index: {len(self.ambiguous)} ambiguous aliases, e.g. "
+                  + ", ".join(f"{alias} -> {route_ids}" for alias, route_ids in list(self.ambiguous.items())[:5]))
+        if self.entries:  # the empty placeholder built at import stays quiet
+            print(f"Line index: {len(self.aliases)} aliases for {len(self.entries)} routes")
+
+    def resolve(self, line_number):
+        """Canonical route entry for user input, or None if no route matches"""
+        if not line_number:
+            return None
+        route_id = self.aliases.get(str(line_number).strip().upper())
+        return self.entries[route_id] if route_id is not None else None
+
+    def route_id(self, line_number):
+        entry = self.resolve(line_number)
+        return entry['route_id'] if entry else None
+
+    def alternatives(self, line_number):
+        """
+        Every route the input could refer to, the resolved one first (empty unless the alias is
+        ambiguous). Routes matching at a worse rank count too: tram 1 is "1" by its short name and
+        metro M1 only once its prefix is dropped, so "1" resolves to T1 but still lists M1.
+
+        >>> index = LineIndex({'M1': {'short_name': 'M1', 'type': '1'}, 'T1': {'short_name': '1', 'type': '0'}})
+        Line index: 1 ambiguous aliases, e.g. 1 -> ['T1', 'M1']
+        Line index: 3 aliases for 2 routes
+        >>> index.route_id('1'), index.alternatives('1')
+        ('T1', ['T1', 'M1'])
+        >>> index.alternatives('M1')
+        []
+        """
+        return self.ambiguous.get(str(line_number).strip().upper(), [])
@@ -0,0 +1,223 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app_logging import get_logger
+
+# How often a watched line is refreshed, and how long it keeps being refreshed after its
+# last subscriber left
+LINE_POLL_INTERVAL = float(os.environ.get('LINE_POLL_INTERVAL', '60'))
+LINE_IDLE_AFTER = float(os.environ.get('LINE_IDLE_AFTER', '120'))
+LINE_POLL_WORKERS = int(os.environ.get('LINE_POLL_WORKERS', '4'))
+# Every /line_stream viewer holds one worker thread; past this many per process new viewers
+# are turned away and poll instead, so the other endpoints keep threads to run on
+LINE_STREAM_MAX_SUBSCRIBERS = int(os.environ.get(
+    'LINE_STREAM_MAX_SUBSCRIBERS', max(1, int(os.environ.get('GUNICORN_THREADS', '16')) // 2)))
+
+log = get_logger('line_poller')
+
+
+class Subscription:
+    """One client watching a line; only the most recent payload is kept for it"""
+    def __init__(self, line_number):
+        self.line_number = line_number
+        self.messages = queue.Queue(maxsize=1)
+
+    def push(self, message):
+        try:
+            self.messages.get_nowait()  # a slow client only ever needs the newest snapshot
+        except queue.Empty:
+            pass
+        try:
+            self.messages.put_nowait(message)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        """Next serialized payload, or None if nothing arrived within timeout seconds"""
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisLinePollStore:
+    """
+    Elects one process per line to rebuild it each interval (a lock key expiring just before
+    the next refresh is due) and hands its serialized payload to the other processes, so
+    the upstream load doesn't grow with the number of workers.
+    """
+    def __init__(self, client, prefix='milanopt:line:'):
+        self.client = client
+        self.prefix = prefix
+
+    def claim(self, line_number, interval):
+        """True if this process should rebuild the line for the coming interval"""
+        return bool(self.client.set(self.prefix + 'lock:' + line_number, b'1', nx=True,
+                                    px=max(1, int(interval * 900))))
+
+    def get(self, line_number):
+        raw = self.client.get(self.prefix + line_number)
+        return None if raw is None else raw.decode('utf-8')
+
+    def put(self, line_number, message, interval):
+        self.client.set(self.prefix + line_number, message, px=max(1, int(interval * 2000)))
+
+
+class _WatchedLine:
+    def __init__(self):
+        self.subscribers = set()
+        self.payload = None
+        self.message = None  # payload serialized once for every subscriber
+        self.refreshed_at = 0.0
+        self.refreshing = False
+        self.idle_since = None
+
+
+class LinePoller:
+    """
+    Server-side scheduler for /get_line_vehicle_data payloads.
+    Each watched line is rebuilt once per interval, whatever the number of viewers, and the
+    serialized result is pushed to every subscriber. A line without subscribers is kept
+    warm for idle_after seconds and then dropped. With a shared store (RedisLinePollStore)
+    only one process rebuilds each line and the others reuse its payload. At most
+    max_subscribers clients are subscribed at once.
+    """
+    def __init__(self, build_payload, interval=LINE_POLL_INTERVAL, idle_after=LINE_IDLE_AFTER, workers=LINE_POLL_WORKERS,
+                 shared=None, max_subscribers=LINE_STREAM_MAX_SUBSCRIBERS):
+        self.build_payload = build_payload
+        self.interval = interval
+        self.idle_after = idle_after
+        self.shared = shared
+        self.max_subscribers = max_subscribers
+        self._lines = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='line-poller')
+        self._thread = None
+        self.counters = {'refreshes': 0, 'refresh_errors': 0, 'pushes': 0, 'shared_refreshes': 0,
+                         'shared_errors': 0, 'rejected_subscribers': 0}
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='line-poller', daemon=True)
+            self._thread.start()
+
+    def subscribe(self, line_number):
+        """A Subscription to the line, or None if this process already has max_subscribers"""
+        subscription = Subscription(line_number)
+        with self._lock:
+            if sum(len(watched.subscribers) for watched in self._lines.values()) >= self.max_subscribers:
+                self.counters['rejected_subscribers'] += 1
+                return None
+            self._ensure_started()
+            watched = self._lines.setdefault(line_number, _WatchedLine())
+            watched.subscribers.add(subscription)
+            watched.idle_since = None
+            if watched.message is not None:
+                subscription.push(watched.message)
+        self._wakeup.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            watched = self._lines.get(subscription.line_number)
+            if watched is not None:
+                watched.subscribers.discard(subscription)
+                if not watched.subscribers:
+                    watched.idle_since = time.monotonic()
+
+    def latest(self, line_number, max_age=None):
+        """The last payload built for a line if it is younger than max_age (default: interval)"""
+        max_age = self.interval if max_age is None else max_age
+        with self._lock:
+            watched = self._lines.get(line_number)
+            if watched is None or watched.payload is None:
+                return None
+            if time.monotonic() - watched.refreshed_at >= max_age:
+                return None
+            return watched.payload
+
+    def _shared_payload(self, line_number):
+        """(payload, message) published by the process elected for the line, or None to build it here"""
+        try:
+            if self.shared.claim(line_number, self.interval):
+                return None
+            message = self.shared.get(line_number)
+        except Exception as e:
+            log.warning('line_shared_error', "Shared line poll store unavailable: %s", e, line=line_number)
+            with self._lock:
+                self.counters['shared_errors'] += 1
+            return None
+        if message is None:
+            return None  # the elected process hasn't published yet
+        with self._lock:
+            self.counters['shared_refreshes'] += 1
+        return json.loads(message), message
+
+    def _refresh(self, line_number):
+        try:
+            shared = self._shared_payload(line_number) if self.shared is not None else None
+            if shared is not None:
+                payload, message = shared
+            else:
+                payload = self.build_payload(line_number)
+                message = json.dumps(payload, separators=(',', ':'))
+                if self.shared is not None:
+                    try:
+                        self.shared.put(line_number, message, self.interval)
+                    except Exception as e:
+                        log.warning('line_shared_error', "Could not share the line payload: %s", e, line=line_number)
+        except Exception as e:
+            log.error('line_refresh_error', "Error refreshing: %s", e, line=line_number)
+            with self._lock:
+                self.counters['refresh_errors'] += 1
+                watched = self._lines.get(line_number)
+                if watched is not None:
+                    watched.refreshing = False
+            return
+
+        with self._lock:
+            self.counters['refreshes'] += 1
+            watched = self._lines.get(line_number)
+            if watched is None:
+                return
+            watched.payload = payload
+            watched.message = message
+            watched.refreshed_at = time.monotonic()
+            watched.refreshing = False
+            subscribers = list(watched.subscribers)
+            self.counters['pushes'] += len(subscribers)
+        for subscription in subscribers:
+            subscription.push(message)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            next_due = now + self.interval
+            with self._lock:
+                for line_number, watched in list(self._lines.items()):
+                    if watched.idle_since is not None and now - watched.idle_since >= self.idle_after:
+                        log.info('line_idle', "No viewers, stopping its refresh", line=line_number)
+                        del self._lines[line_number]
+                        continue
+                    due = watched.refreshed_at + self.interval
+                    if due <= now and not watched.refreshing:
+                        watched.refreshing = True
+                        self._executor.submit(self._refresh, line_number)
+                    else:
+                        next_due = min(next_due, max(due, now + 1))
+                    if watched.idle_since is not None:
+                        next_due = min(next_due, watched.idle_since + self.idle_after)
+            self._wakeup.wait(max(0.0, next_due - time.monotonic()))
+            self._wakeup.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['watched_lines'] = len(self._lines)
+            stats['subscribers'] = sum(len(watched.subscribers) for watched in self._lines.values())
+        return stats
@@ -0,0 +1,181 @@
+# Local stand-in for the giromilano.atm.it proxy, for benchmarks and offline work. It answers
+# the same POST the app sends (url=tpPortal/geodata/pois/stops/<stop_id>) with a {"Lines": [...]}
+# payload: the recorded one for the stop if there is one, otherwise one made up from the lines
+# FINAL.json says stop there. Latency, HTTP errors, unreadable answers and slow answers are
+# configurable. Point the app at it with ATM_SERVER_URL=http://127.0.0.1:<port>/.
+#
+#   python mock_atm.py serve --port 8765 --latency 0.08 --error-rate 0.02
+#   python mock_atm.py record --stops 11154,12345 --output atm_recordings.json
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+
+# Made-up answers: "in arrivo", a number of minutes or no service, in roughly these shares
+WAIT_MESSAGES = ['in arrivo'] * 2 + [f'{minutes} min' for minutes in range(1, 21)] + ['no serv.'] * 2
+
+
+def load_recordings(path):
+    """{stop_id: Lines} saved by `record`, or {} without a file"""
+    if not path:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def lines_from_stations(path='FINAL.json'):
+    """{stop_id: [line codes]} from the line stations memory, to make up answers for any stop"""
+    with open(path, encoding='utf-8') as f:
+        memory = json.load(f)
+    stop_lines = {}
+    for line_id, line_info in memory.items():
+        code = (line_info.get('route_info') or {}).get('short_name') or line_id
+        for station in line_info.get('stations', []):
+            stop_lines.setdefault(str(station['stop_id']), []).append(str(code))
+    return stop_lines
+
+
+class MockATM:
+    """
+    Answers stop lookups after latency +- jitter seconds. A share error_rate of them get an
+    HTTP 503, garbage_rate a 200 with a body that isn't JSON, and slow_rate are delayed by
+    slow_latency instead (past the client's read timeout with the default settings).
+    """
+    def __init__(self, recordings=None, stop_lines=None, latency=0.05, jitter=0.02, error_rate=0.0,
+                 garbage_rate=0.0, slow_rate=0.0, slow_latency=6.0, seed=None):
+        self.recordings = recordings or {}
+        self.stop_lines = stop_lines or {}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.garbage_rate = garbage_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.counts = {'requests': 0, 'replayed': 0, 'made_up': 0, 'errors': 0, 'garbage': 0, 'slow': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def lines(self, stop_id):
+        recorded = self.recordings.get(stop_id)
+        if recorded is not None:
+            self._count('replayed')
+            return recorded
+        self._count('made_up')
+        return [{'BookletUrl2': code, 'WaitMessage': self.random.choice(WAIT_MESSAGES)}
+                for code in self.stop_lines.get(stop_id, ())]
+
+    def answer(self, stop_id):
+        """(status, body) for one stop lookup, after the simulated delay"""
+        self._count('requests')
+        roll = self.random.random()
+        if roll < self.slow_rate:
+            self._count('slow')
+            time.sleep(self.slow_latency)
+        else:
+            time.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        roll -= self.slow_rate
+        if 0 <= roll < self.error_rate:
+            self._count('errors')
+            return 503, b'Service Unavailable'
+        roll -= self.error_rate
+        if 0 <= roll < self.garbage_rate:
+            self._count('garbage')
+            return 200, b'<html>Request rejected</html>'
+        return 200, json.dumps({'Lines': self.lines(stop_id)}).encode('utf-8')
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def server(self, host='127.0.0.1', port=0):
+        """A ThreadingHTTPServer answering for this mock; call serve_forever() on it"""
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real proxy
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8', 'replace')
+                url = unquote(parse_qs(body).get('url', [''])[0])
+                status, payload = mock.answer(url.rstrip('/').rsplit('/', 1)[-1])
+                self._send(status, payload, 'application/json' if status == 200 else 'text/plain')
+
+            def do_GET(self):
+                # /stats: what has been answered so far, for the benchmark
+                self._send(200, json.dumps(mock.stats()).encode('utf-8'), 'application/json')
+
+            def _send(self, status, payload, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        httpd.daemon_threads = True
+        return httpd
+
+
+def record(stop_ids, output):
+    """Ask the live proxy for every stop once and save the answers for replay"""
+    import FINAL  # only for the proxy URL and headers; the GTFS data is not loaded
+    recordings = load_recordings(output) if output and os.path.exists(output) else {}
+    for stop_id in stop_ids:
+        lines = FINAL._fetch_stop_lines_upstream(stop_id)
+        if lines is not None:
+            recordings[stop_id] = lines
+        print(f"{stop_id}: {'no answer' if lines is None else f'{len(lines)} lines'}")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(recordings, f, ensure_ascii=False, indent=1)
+    print(f"Saved {len(recordings)} stops to {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the ATM proxy')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='answer stop lookups like the ATM proxy')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--recordings', help='JSON file written by record')
+    serve.add_argument('--stations', default='FINAL.json', help='line stations memory used to make up answers')
+    serve.add_argument('--latency', type=float, default=0.05, help='seconds per answer')
+    serve.add_argument('--jitter', type=float, default=0.02, help='+- seconds around the latency')
+    serve.add_argument('--error-rate', type=float, default=0.0, help='share of HTTP 503 answers')
+    serve.add_argument('--garbage-rate', type=float, default=0.0, help='share of answers that are not JSON')
+    serve.add_argument('--slow-rate', type=float, default=0.0, help='share of answers delayed by --slow-latency')
+    serve.add_argument('--slow-latency', type=float, default=6.0)
+    serve.add_argument('--seed', type=int)
+    rec = commands.add_parser('record', help='save live proxy answers for replay')
+    rec.add_argument('--stops', required=True, help='comma-separated stop ids')
+    rec.add_argument('--output', default='atm_recordings.json')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record([stop_id.strip() for stop_id in args.stops.split(',') if stop_id.strip()], args.output)
+        return
+    stop_lines = lines_from_stations(args.stations) if os.path.exists(args.stations) else {}
+    mock = MockATM(load_recordings(args.recordings), stop_lines, args.latency, args.jitter, args.error_rate,
+                   args.garbage_rate, args.slow_rate, args.slow_latency, args.seed)
+    httpd = mock.server(args.host, args.port)
+    print(f"Mock ATM proxy on http://{args.host}:{httpd.server_address[1]}/ "
+          f"({len(mock.recordings)} recorded stops, {len(stop_lines)} stops from {args.stations})", flush=True)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
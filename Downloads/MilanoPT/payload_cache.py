@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import json
+import threading
+
+from flask import Response
+
+try:
+    import brotli  # optional: only used when installed
+except ImportError:
+    brotli = None
+
+# (gzip level, brotli quality): the slowest, smallest settings only for payloads built ahead
+# of time; payloads built on demand are compressed inside the request that missed
+BEST_LEVELS = (9, 11)
+FAST_LEVELS = (6, 5)
+
+
+class CompressedPayload:
+    """A JSON body serialized once and stored gzip (and brotli, when available) compressed"""
+    def __init__(self, payload, version, best=False):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        self.etag = hashlib.sha1(version + body).hexdigest()
+        self.size = len(body)
+        self.levels = BEST_LEVELS if best else FAST_LEVELS
+        self.gzip = gzip.compress(body, compresslevel=self.levels[0], mtime=0)
+        self.br = brotli.compress(body, quality=self.levels[1]) if brotli is not None else None
+
+    def identity(self):
+        # Rare (clients without gzip), so the plain body is not kept around
+        return gzip.decompress(self.gzip)
+
+    def response(self, request, max_age=3600):
+        """
+        Response negotiated on Accept-Encoding. Each encoding (and compression level) is its
+        own representation with its own strong ETag; a conditional request matching any of
+        them, weakly (proxies rewrite to W/"...") or with *, gets a 304.
+        """
+        accept = request.accept_encodings
+        gzip_tag, br_tag = f"{self.etag}-gzip{self.levels[0]}", f"{self.etag}-br{self.levels[1]}"
+        if self.br is not None and accept['br']:
+            encoding, body, etag = 'br', self.br, br_tag
+        elif accept['gzip']:
+            encoding, body, etag = 'gzip', self.gzip, gzip_tag
+        else:
+            encoding, body, etag = None, None, self.etag
+
+        if any(request.if_none_match.contains_weak(known) for known in (self.etag, gzip_tag, br_tag)):
+            response = Response(status=304)
+        else:
+            response = Response(body if encoding else self.identity(), mimetype='application/json')
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'public, max-age={max_age}'
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+class PayloadCache:
+    """
+    Compressed payloads keyed by e.g. route_id. They only change with the GTFS feed, so the
+    feed version is part of every ETag and the cache is simply rebuilt with a new snapshot.
+    """
+    def __init__(self, version):
+        self.version = version
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, build, best=False):
+        """
+        Cached payload for key, built (once) with build() on a miss. best=True compresses at the
+        slowest settings, for payloads built ahead of time rather than inside a request.
+        """
+        with self._lock:
+            cached = self._payloads.get(key)
+        if cached is not None:
+            return cached
+        payload = CompressedPayload(build(), self.version, best)
+        with self._lock:
+            return self._payloads.setdefault(key, payload)
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def stats(self):
+        with self._lock:
+            payloads = list(self._payloads.values())
+        return {
+            'entries': len(payloads),
+            'raw_bytes': sum(payload.size for payload in payloads),
+            'gzip_bytes': sum(len(payload.gzip) for payload in payloads),
+            'br_bytes': sum(len(payload.br) for payload in payloads if payload.br is not None),
+        }
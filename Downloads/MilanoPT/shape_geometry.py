@@ -0,0 +1,159 @@
+# Zoom-aware simplification and compact encodings of GTFS shapes for /track_line
+from math import cos, hypot, radians
+
+from spatial_index import METERS_PER_DEGREE_LAT
+
+MIN_SHAPE_ZOOM = 0
+MAX_SHAPE_ZOOM = 18
+SHAPE_FORMATS = ('json', 'polyline', 'packed')
+
+# Web Mercator ground resolution at zoom 0 on the equator, in meters per 256px-tile pixel
+_METERS_PER_PIXEL_Z0 = 156543.03392
+# Shape variants closer than this to what is already drawn are never worth sending
+DEDUPE_MIN_M = 10
+POLYLINE_PRECISION = 5  # Google encoded polyline: 1e-5 degrees
+
+
+def meters_per_pixel(zoom, lat):
+    return _METERS_PER_PIXEL_Z0 * cos(radians(lat)) / 2 ** zoom
+
+
+def _projector(reference_lat):
+    """Equirectangular projection to meters, accurate enough at city scale"""
+    x_scale = METERS_PER_DEGREE_LAT * cos(radians(reference_lat))
+    return lambda point: (point['X'] * x_scale, point['Y'] * METERS_PER_DEGREE_LAT)
+
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+    return hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def douglas_peucker(points, tolerance_m):
+    """Points of a path that keep it within tolerance_m of the original (Douglas-Peucker)"""
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+    project = _projector(points[0]['Y'])
+    xy = [project(point) for point in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # Explicit stack: shapes with thousands of points would exceed the recursion limit
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        ax, ay = xy[start]
+        bx, by = xy[end]
+        farthest, farthest_distance = None, tolerance_m
+        for i in range(start + 1, end):
+            distance = _segment_distance(xy[i][0], xy[i][1], ax, ay, bx, by)
+            if distance > farthest_distance:
+                farthest, farthest_distance = i, distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((start, farthest))
+            stack.append((farthest, end))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _samples(xy, step):
+    """Points every `step` meters along a projected path (vertices included)"""
+    for (ax, ay), (bx, by) in zip(xy, xy[1:]):
+        steps = max(1, int(hypot(bx - ax, by - ay) / step))
+        for k in range(steps):
+            yield ax + (bx - ax) * k / steps, ay + (by - ay) * k / steps
+    if xy:
+        yield xy[-1]
+
+
+def _length(xy):
+    return sum(hypot(bx - ax, by - ay) for (ax, ay), (bx, by) in zip(xy, xy[1:]))
+
+
+def dedupe_paths(paths, distance_m, groups=None):
+    """
+    Indexes of the paths to keep once shape variants running within about distance_m of longer
+    variants already kept are dropped (short-turn trips, detours, ...). Paths are only compared
+    within their group (groups[i], e.g. the direction_id), so both directions of a line on the
+    same street are kept. Coverage is tested on a grid of distance_m / 2 cells, so the cost is
+    linear in the total path length. Indexes come back in the original order.
+    """
+    if len(paths) < 2:
+        return list(range(len(paths)))
+    groups = groups or [None] * len(paths)
+    project = _projector(paths[0][0]['Y'] if paths[0] else 45.4642)
+    projected = [[project(point) for point in path] for path in paths]
+    cell = distance_m / 2
+    covered = {}  # group -> cells drawn so far
+    kept = []
+    for index in sorted(range(len(paths)), key=lambda i: -_length(projected[i])):
+        cells = {(int(x // cell), int(y // cell)) for x, y in _samples(projected[index], cell / 2)}
+        group_covered = covered.setdefault(groups[index], set())
+        redundant = bool(group_covered) and all(
+            any((cx + dx, cy + dy) in group_covered for dx in (-1, 0, 1) for dy in (-1, 0, 1))
+            for cx, cy in cells)
+        if not redundant:
+            kept.append(index)
+            group_covered |= cells
+    return sorted(kept)
+
+
+def simplify_paths(paths, zoom, groups=None):
+    """
+    Paths reduced to what is visible at a map zoom: near-duplicate variants of the same group
+    dropped (see dedupe_paths), then simplified. Returns (paths, kept) where kept[i] is the
+    index in the original list of the i-th path returned.
+    """
+    indexes = [i for i, path in enumerate(paths) if path]
+    if not indexes:
+        return [], []
+    pixel_m = meters_per_pixel(zoom, paths[indexes[0]][0]['Y'])
+    kept = [indexes[i] for i in dedupe_paths([paths[i] for i in indexes], max(DEDUPE_MIN_M, 2 * pixel_m),
+                                             [groups[i] for i in indexes] if groups else None)]
+    # Half a pixel of error is invisible once drawn
+    return [douglas_peucker(paths[i], pixel_m / 2) for i in kept], kept
+
+
+def encode_polyline(path, precision=POLYLINE_PRECISION):
+    """Google encoded polyline string of a [{'Y', 'X'}] path"""
+    factor = 10 ** precision
+    chunks = []
+    previous_lat = previous_lon = 0
+    for point in path:
+        lat, lon = round(point['Y'] * factor), round(point['X'] * factor)
+        for delta in (lat - previous_lat, lon - previous_lon):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        previous_lat, previous_lon = lat, lon
+    return ''.join(chunks)
+
+
+def pack_path(path, precision=POLYLINE_PRECISION):
+    """
+    Flat integer list [lat0, lon0, dlat1, dlon1, ...] in 10^-precision degrees: the first
+    point absolute, every following one as a delta from the previous
+    """
+    factor = 10 ** precision
+    packed = []
+    previous_lat = previous_lon = 0
+    for point in path:
+        lat, lon = round(point['Y'] * factor), round(point['X'] * factor)
+        packed.append(lat - previous_lat)
+        packed.append(lon - previous_lon)
+        previous_lat, previous_lon = lat, lon
+    return packed
+
+
+def format_paths(paths, path_format):
+    """Paths in one of SHAPE_FORMATS"""
+    if path_format == 'polyline':
+        return [encode_polyline(path) for path in paths]
+    if path_format == 'packed':
+        return [pack_path(path) for path in paths]
+    return paths
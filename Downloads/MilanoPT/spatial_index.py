@@ -0,0 +1,139 @@
+from array import array
+from math import asin, cos, radians, sin, sqrt
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE_LAT = 111320
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters"""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * asin(sqrt(a))
+
+
+class StopSpatialIndex:
+    """
+    Uniform grid over stop coordinates for nearest / radius / bounding-box queries.
+    Cells are about cell_size_m wide; candidates found through the grid are refined with
+    the haversine distance, so a query only touches the handful of cells around the point.
+    """
+    def __init__(self, stops, cell_size_m=250):
+        self.ids = []
+        self.names = []
+        self.lat = array('d')
+        self.lon = array('d')
+        seen = set()
+        for stop in stops:
+            stop_id = str(stop.get('id', stop.get('stop_id', '')))
+            if not stop_id or stop_id in seen:
+                continue
+            seen.add(stop_id)
+            self.ids.append(stop_id)
+            self.names.append(stop.get('name', ''))
+            self.lat.append(float(stop['lat']))
+            self.lon.append(float(stop['lon']))
+
+        self._build_grid(cell_size_m)
+
+    @classmethod
+    def from_columns(cls, ids, names, lat, lon, cell_size_m=250):
+        """Index stops given as parallel columns of unique ids (e.g. mapped snapshot sections)"""
+        index = cls.__new__(cls)
+        index.ids, index.names, index.lat, index.lon = ids, names, lat, lon
+        index._build_grid(cell_size_m)
+        return index
+
+    def _build_grid(self, cell_size_m):
+        reference_lat = sum(self.lat) / len(self.lat) if len(self.lat) else 45.4642
+        self.cell_lat = cell_size_m / METERS_PER_DEGREE_LAT
+        self.cell_lon = cell_size_m / (METERS_PER_DEGREE_LAT * cos(radians(reference_lat)))
+        # Smallest real extent of a cell, used to bound the distance of cells not yet visited
+        self.cell_min_m = cell_size_m * min(1.0, cos(radians(reference_lat + 1)) / cos(radians(reference_lat)))
+
+        self.cells = {}
+        for i in range(len(self.ids)):
+            self.cells.setdefault(self._cell(self.lat[i], self.lon[i]), array('I')).append(i)
+        if len(self.ids):  # the empty placeholder built at import stays quiet
+            print(f"Spatial index: {len(self.ids)} stops in {len(self.cells)} cells of {cell_size_m} m")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cell(self, lat, lon):
+        return int(lat // self.cell_lat), int(lon // self.cell_lon)
+
+    def _ring(self, center, radius):
+        """Indices of the stops in the cells exactly `radius` cells away from center"""
+        cy, cx = center
+        if radius == 0:
+            yield from self.cells.get(center, ())
+            return
+        for dx in range(-radius, radius + 1):
+            yield from self.cells.get((cy - radius, cx + dx), ())
+            yield from self.cells.get((cy + radius, cx + dx), ())
+        for dy in range(-radius + 1, radius):
+            yield from self.cells.get((cy + dy, cx - radius), ())
+            yield from self.cells.get((cy + dy, cx + radius), ())
+
+    def stop(self, i, distance_m=None):
+        result = {'id': self.ids[i], 'name': self.names[i], 'lat': self.lat[i], 'lon': self.lon[i]}
+        if distance_m is not None:
+            result['distance_m'] = round(distance_m, 1)
+        return result
+
+    def nearest(self, lat, lon, k=5, max_distance_m=5000):
+        """The k stops closest to (lat, lon), nearest first, ignoring any farther than max_distance_m"""
+        if k < 1:
+            return []
+        center = self._cell(lat, lon)
+        found = []
+        max_rings = int(max_distance_m / self.cell_min_m) + 1
+        for radius in range(max_rings + 1):
+            for i in self._ring(center, radius):
+                distance = haversine_m(lat, lon, self.lat[i], self.lon[i])
+                if distance <= max_distance_m:
+                    found.append((distance, i))
+            # Every stop in an unvisited ring is at least `radius` whole cells away
+            if len(found) >= k:
+                found.sort()
+                del found[k:]
+                if found[-1][0] <= radius * self.cell_min_m:
+                    break
+        found.sort()
+        return [self.stop(i, distance) for distance, i in found[:k]]
+
+    def within_radius(self, lat, lon, radius_m, limit=None):
+        """Stops within radius_m of (lat, lon), nearest first"""
+        cy, cx = self._cell(lat, lon)
+        span_y = int(radius_m / (self.cell_lat * METERS_PER_DEGREE_LAT)) + 1
+        span_x = int(radius_m / self.cell_min_m) + 1
+        found = []
+        for y in range(cy - span_y, cy + span_y + 1):
+            for x in range(cx - span_x, cx + span_x + 1):
+                for i in self.cells.get((y, x), ()):
+                    distance = haversine_m(lat, lon, self.lat[i], self.lon[i])
+                    if distance <= radius_m:
+                        found.append((distance, i))
+        found.sort()
+        if limit is not None:
+            found = found[:limit]
+        return [self.stop(i, distance) for distance, i in found]
+
+    def in_bbox(self, west, south, east, north, limit=None):
+        """Stops inside the bounding box (degrees), in grid order"""
+        y0, x0 = self._cell(south, west)
+        y1, x1 = self._cell(north, east)
+        if (y1 - y0 + 1) * (x1 - x0 + 1) > len(self.cells):
+            # Zoomed far out: walking the occupied cells is cheaper than walking the box
+            cells = [cell for cell in self.cells if y0 <= cell[0] <= y1 and x0 <= cell[1] <= x1]
+        else:
+            cells = [(y, x) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+        found = []
+        for cell in cells:
+            for i in self.cells.get(cell, ()):
+                if south <= self.lat[i] <= north and west <= self.lon[i] <= east:
+                    found.append(i)
+                    if limit is not None and len(found) >= limit:
+                        return [self.stop(j) for j in found]
+        return [self.stop(i) for i in found]
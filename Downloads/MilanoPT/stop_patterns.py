@@ -0,0 +1,144 @@
+# Canonical stop pattern of every (route, direction): the stop order most trips follow,
+# with each stop's position along the route's shape
+from bisect import bisect_right
+from math import atan2, cos, degrees, hypot, radians
+
+from spatial_index import METERS_PER_DEGREE_LAT, haversine_m
+
+# A stop is placed on the first pass of the shape that comes this close to it
+SNAP_DISTANCE_M = 25
+
+
+def _project(points, reference_lat):
+    x_scale = METERS_PER_DEGREE_LAT * cos(radians(reference_lat))
+    return [(lon * x_scale, lat * METERS_PER_DEGREE_LAT) for lat, lon in points]
+
+
+def cumulative_distances(shape):
+    """Meters from the start of a [{'Y', 'X'}] shape to each of its points"""
+    if not shape:
+        return []
+    xy = _project([(point['Y'], point['X']) for point in shape], shape[0]['Y'])
+    cumulative = [0.0]
+    for (ax, ay), (bx, by) in zip(xy, xy[1:]):
+        cumulative.append(cumulative[-1] + hypot(bx - ax, by - ay))
+    return cumulative
+
+
+class ShapeTrack:
+    """
+    A shape as parallel lat / lon / cumulative-meters sequences (lists or snapshot arrays),
+    so a distance along it is turned into a position with a binary search.
+    """
+    def __init__(self, lat, lon, cumulative):
+        self.lat = lat
+        self.lon = lon
+        self.cumulative = cumulative
+
+    def __len__(self):
+        return len(self.cumulative)
+
+    @property
+    def length_m(self):
+        return self.cumulative[-1] if len(self.cumulative) else 0.0
+
+    def locate(self, distance_m):
+        """(segment, fraction) of the point distance_m along the shape, clamped to its ends"""
+        if len(self.cumulative) < 2:
+            return 0, 0.0
+        segment = min(max(bisect_right(self.cumulative, distance_m) - 1, 0), len(self.cumulative) - 2)
+        start, end = self.cumulative[segment], self.cumulative[segment + 1]
+        fraction = (distance_m - start) / (end - start) if end > start else 0.0
+        return segment, max(0.0, min(1.0, fraction))
+
+    def point_at(self, distance_m):
+        """(lat, lon, bearing in degrees clockwise from north) distance_m along the shape"""
+        if len(self.cumulative) < 2:
+            return (self.lat[0], self.lon[0], 0.0) if len(self.cumulative) else None
+        segment, fraction = self.locate(distance_m)
+        lat1, lon1 = self.lat[segment], self.lon[segment]
+        lat2, lon2 = self.lat[segment + 1], self.lon[segment + 1]
+        bearing = degrees(atan2((lon2 - lon1) * cos(radians(lat1)), lat2 - lat1)) % 360
+        return lat1 + (lat2 - lat1) * fraction, lon1 + (lon2 - lon1) * fraction, bearing
+
+
+def project_stops(shape, stops):
+    """
+    Project stops, in travel order, onto a shape ([{'Y', 'X'}] points).
+    Returns one (segment, fraction, distance_m, offset_m) per stop: the shape segment it falls
+    on, how far along that segment (0-1), the meters from the start of the shape and how far
+    the stop lies from the shape. Stops never move backwards along the shape: each one is
+    placed on the first pass that comes within SNAP_DISTANCE_M of it (so a looping shape
+    is followed in order), or else on the closest point of the rest of the shape.
+    """
+    reference_lat = shape[0]['Y']
+    xy = _project([(point['Y'], point['X']) for point in shape], reference_lat)
+    cumulative = cumulative_distances(shape)
+    if len(xy) < 2:
+        return [(0, 0.0, 0.0, 0.0) for _ in stops]
+
+    projections = []
+    first_segment, first_fraction = 0, 0.0
+    for px, py in _project([(stop['lat'], stop['lon']) for stop in stops], reference_lat):
+        best = previous = None
+        for segment in range(first_segment, len(xy) - 1):
+            (ax, ay), (bx, by) = xy[segment], xy[segment + 1]
+            dx, dy = bx - ax, by - ay
+            length_sq = dx * dx + dy * dy
+            fraction = ((px - ax) * dx + (py - ay) * dy) / length_sq if length_sq else 0.0
+            fraction = max(first_fraction if segment == first_segment else 0.0, min(1.0, fraction))
+            candidate = (hypot(px - ax - fraction * dx, py - ay - fraction * dy), segment, fraction)
+            if previous is not None and previous[0] <= SNAP_DISTANCE_M and candidate[0] > previous[0]:
+                best = previous  # closest point of the first close pass
+                break
+            if best is None or candidate[0] < best[0]:
+                best = candidate
+            previous = candidate
+        offset, segment, fraction = best
+        distance = cumulative[segment] + fraction * (cumulative[segment + 1] - cumulative[segment])
+        projections.append((segment, fraction, distance, offset))
+        first_segment, first_fraction = segment, fraction
+    return projections
+
+
+def build_stop_patterns(pattern_trips, line_paths, route_shapes, stops_data):
+    """
+    Pick the dominant stop pattern of every (route, direction).
+    pattern_trips: {(route_id, direction_id): {pattern: {shape_id: trip count}}}, a pattern
+    being a tuple of (stop_sequence, stop_id) in stop_sequence order.
+    route_shapes: {route_id: {shape_id: index in line_paths[route_id]}}.
+    Returns {route_id: [{'direction_id', 'shape_index', 'trip_count', 'stops'}]} where every
+    stop carries its stop_sequence and its projection onto the pattern's most used shape:
+    segment, fraction and dist_m, the meters travelled along the shape (without a shape,
+    segment and fraction are None and dist_m follows straight lines between stops).
+    """
+    stop_patterns = {}
+    for (route_id, direction_id), patterns in sorted(pattern_trips.items()):
+        # Most trips wins; on a tie the longer pattern (the full run rather than a short turn)
+        pattern, shape_counts = max(patterns.items(), key=lambda item: (sum(item[1].values()), len(item[0])))
+        stops = [{'stop_id': stop_id, 'name': stops_data[stop_id]['name'], 'lat': stops_data[stop_id]['lat'],
+                  'lon': stops_data[stop_id]['lon'], 'stop_sequence': stop_sequence}
+                 for stop_sequence, stop_id in pattern]
+        shape_id = max(shape_counts, key=shape_counts.get)
+        shape_index = route_shapes.get(route_id, {}).get(shape_id)
+
+        if shape_index is not None:
+            for stop, (segment, fraction, distance, _) in zip(stops, project_stops(line_paths[route_id][shape_index], stops)):
+                stop['segment'] = segment
+                stop['fraction'] = round(fraction, 4)
+                stop['dist_m'] = round(distance, 1)
+        else:
+            distance = 0.0
+            for previous, stop in zip([None] + stops, stops):
+                if previous is not None:
+                    distance += haversine_m(previous['lat'], previous['lon'], stop['lat'], stop['lon'])
+                stop['segment'] = stop['fraction'] = None
+                stop['dist_m'] = round(distance, 1)
+
+        stop_patterns.setdefault(route_id, []).append({
+            'direction_id': direction_id,
+            'shape_index': shape_index,
+            'trip_count': sum(shape_counts.values()),
+            'stops': stops
+        })
+    return stop_patterns
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from math import atan, degrees, pi, sinh
+
+# From this zoom up tiles carry the individual stops; below it, per-cell stop counts
+STOP_TILE_DETAIL_ZOOM = 14
+STOP_TILE_MIN_ZOOM = 8
+STOP_TILE_MAX_ZOOM = 18
+CLUSTER_GRID = 8  # a low-zoom tile is summarised on a CLUSTER_GRID x CLUSTER_GRID grid
+
+
+def tile_bounds(z, x, y):
+    """(west, south, east, north) in degrees of a slippy-map (Web Mercator) tile"""
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = degrees(atan(sinh(pi * (1 - 2 * y / n))))
+    south = degrees(atan(sinh(pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+class StopTileCache:
+    """
+    Serves the stops of one map tile as pre-encoded JSON.
+    Each tile is encoded once, kept in an LRU, and given an ETag derived from the feed
+    version, so browsers and proxies can cache it until the GTFS data changes.
+    """
+    def __init__(self, stop_index, version, max_tiles=4096):
+        self.stop_index = stop_index
+        self.version = version
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()  # (z, x, y) -> (etag, body)
+        self._lock = threading.Lock()
+
+    def get(self, z, x, y):
+        """(etag, body bytes) for a tile; raises ValueError for tiles outside the served range"""
+        if not STOP_TILE_MIN_ZOOM <= z <= STOP_TILE_MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Tile {z}/{x}/{y} is out of range")
+        if z > STOP_TILE_DETAIL_ZOOM:
+            # Deeper tiles would only repeat the detail tile's stops; clients should use that one
+            raise ValueError(f"Stop tiles go up to zoom {STOP_TILE_DETAIL_ZOOM}")
+
+        key = (z, x, y)
+        with self._lock:
+            cached = self._tiles.get(key)
+            if cached is not None:
+                self._tiles.move_to_end(key)
+                return cached
+
+        body = json.dumps(self._build(z, x, y), separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha1(self.version + f"{z}/{x}/{y}".encode() + body).hexdigest()
+        with self._lock:
+            self._tiles[key] = (etag, body)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return etag, body
+
+    def _build(self, z, x, y):
+        west, south, east, north = tile_bounds(z, x, y)
+        found = self.stop_index.in_bbox(west, south, east, north)
+        if z >= STOP_TILE_DETAIL_ZOOM:
+            return {"z": z, "x": x, "y": y, "stops": found}
+
+        cells = {}
+        for stop in found:
+            cx = min(int((stop['lon'] - west) / (east - west) * CLUSTER_GRID), CLUSTER_GRID - 1)
+            cy = min(int((north - stop['lat']) / (north - south) * CLUSTER_GRID), CLUSTER_GRID - 1)
+            cell = cells.setdefault((cx, cy), [0.0, 0.0, 0])
+            cell[0] += stop['lat']
+            cell[1] += stop['lon']
+            cell[2] += 1
+        clusters = [{"lat": lat / count, "lon": lon / count, "count": count} for lat, lon, count in cells.values()]
+        return {"z": z, "x": x, "y": y, "clusters": clusters}
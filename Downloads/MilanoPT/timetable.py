@@ -0,0 +1,340 @@
+# Scheduled timetable: stop_times as flat columns with interned integer ids (trip, stop,
+# seconds, sequence), CSR indexes by trip and by stop, and the service calendar. Answers
+# "where should this line's vehicles be now" and "what leaves this stop next".
+import datetime
+from array import array
+from bisect import bisect_left, bisect_right
+from zoneinfo import ZoneInfo
+
+from gtfs_snapshot import StringTableBuilder
+from journey_planner import build_connections, build_footpaths
+from stop_patterns import project_stops
+from vehicle_inference import vehicle_between
+
+DEFAULT_TIMEZONE = 'Europe/Rome'
+_WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+
+def parse_gtfs_time(value):
+    """Seconds since the start of the service day (GTFS times go past 24:00:00 after midnight)"""
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+class TimetableBuilder:
+    """Collects trips and calendar rows during the ingest, then lays them out as snapshot columns"""
+    def __init__(self):
+        self.trips = []
+        self.calendar = {}     # service_id -> [weekday flags, start date, end date]
+        self.exceptions = {}   # service_id -> {date: 1 added / 2 removed}
+        self.transfers = []    # (from_stop_id, to_stop_id, transfer_type, min_transfer_time or None)
+        self.timezone = DEFAULT_TIMEZONE
+
+    def add_trip(self, trip_id, route_id, direction_id, service_id, shape_id, pattern, seconds):
+        """pattern: (stop_sequence, stop_id) pairs in order; seconds: departure of each, same order"""
+        self.trips.append((route_id, seconds[0], trip_id, direction_id, service_id, shape_id, pattern, seconds))
+
+    def add_calendar(self, row):
+        self.calendar[row['service_id']] = [''.join(row[day].strip() or '0' for day in _WEEKDAYS),
+                                            row['start_date'], row['end_date']]
+
+    def add_calendar_date(self, row):
+        self.exceptions.setdefault(row['service_id'], {})[row['date']] = int(row['exception_type'])
+
+    def add_transfer(self, row):
+        seconds = (row.get('min_transfer_time') or '').strip()
+        self.transfers.append((row['from_stop_id'], row['to_stop_id'], int(row.get('transfer_type') or 0),
+                               int(seconds) if seconds else None))
+
+    def build(self, line_paths, route_shapes, stops_data):
+        """
+        Columns for the snapshot ({section name: array, string table or JSON value}).
+        Stop time rows are stored trip by trip, trips sorted by route then start time, so
+        tt_trip_off is the by-trip CSR index; tt_stop_off / tt_stop_rows index the same rows
+        by stop, in departure order. Trips sharing a stop pattern and a shape share one
+        "variant" holding the distance of each of its stops along the shape.
+
+        For the journey planner, tt_conn_rows lists the rows that lead on to a next stop in
+        departure order, and tt_walk_off / tt_walk_to / tt_walk_sec hold the walking links
+        between stops.
+        """
+        routes, services, stop_table = StringTableBuilder(), StringTableBuilder(), StringTableBuilder()
+        stop_names, stop_lat, stop_lon = StringTableBuilder(deduplicate=False), array('d'), array('d')
+        trip_ids = StringTableBuilder(deduplicate=False)
+        route_offsets, route_spans = array('I', [0]), array('i')
+        trip_direction, trip_service, trip_variant = array('i'), array('I'), array('I')
+        trip_start, trip_offsets = array('i'), array('I', [0])
+        row_trip, row_stop, row_seconds, row_sequence = array('I'), array('I'), array('i'), array('i')
+        variants = {}
+        variant_shape, variant_offsets, variant_dist = array('i'), array('I', [0]), array('f')
+
+        def stop_index(stop_id):
+            known = len(stop_table)
+            position = stop_table.add(stop_id)
+            if position == known:
+                stop = stops_data[stop_id]
+                stop_names.add(stop['name'])
+                stop_lat.append(stop['lat'])
+                stop_lon.append(stop['lon'])
+            return position
+
+        self.trips.sort(key=lambda trip: (trip[0], trip[1]))
+        current_route = None
+        for route_id, start, trip_id, direction_id, service_id, shape_id, pattern, seconds in self.trips:
+            if route_id != current_route:
+                if current_route is not None:
+                    route_offsets.append(len(trip_start))
+                routes.add(route_id)
+                route_spans.append(0)
+                current_route = route_id
+
+            shape_index = route_shapes.get(route_id, {}).get(shape_id)
+            key = (pattern, route_id, shape_index)
+            variant = variants.get(key)
+            if variant is None:
+                variant = variants[key] = len(variant_shape)
+                stops = [stops_data[stop_id] for _, stop_id in pattern]
+                if shape_index is not None:
+                    distances = [distance for _, _, distance, _ in project_stops(line_paths[route_id][shape_index], stops)]
+                else:
+                    distances = [0.0] * len(stops)
+                variant_shape.append(-1 if shape_index is None else shape_index)
+                variant_dist.extend(distances)
+                variant_offsets.append(len(variant_dist))
+
+            trip = len(trip_start)
+            trip_ids.add(trip_id)
+            trip_direction.append(direction_id)
+            trip_service.append(services.add(service_id))
+            trip_variant.append(variant)
+            trip_start.append(start)
+            for (stop_sequence, stop_id), departure in zip(pattern, seconds):
+                row_trip.append(trip)
+                row_stop.append(stop_index(stop_id))
+                row_seconds.append(departure)
+                row_sequence.append(stop_sequence)
+            trip_offsets.append(len(row_seconds))
+            route_spans[-1] = max(route_spans[-1], seconds[-1] - start)
+        route_offsets.append(len(trip_start))
+
+        # By-stop index: rows bucketed per stop (counting sort), each bucket in departure order
+        stop_offsets = array('I', [0] * (len(stop_table) + 1))
+        for stop in row_stop:
+            stop_offsets[stop + 1] += 1
+        for stop in range(len(stop_table)):
+            stop_offsets[stop + 1] += stop_offsets[stop]
+        stop_rows = array('I', [0] * len(row_stop))
+        fill = array('I', stop_offsets[:-1])
+        for row, stop in enumerate(row_stop):
+            stop_rows[fill[stop]] = row
+            fill[stop] += 1
+        for stop in range(len(stop_table)):
+            start, end = stop_offsets[stop], stop_offsets[stop + 1]
+            stop_rows[start:end] = array('I', sorted(stop_rows[start:end], key=row_seconds.__getitem__))
+
+        connections, connection_departures, connection_trips, connection_stops = build_connections(
+            row_trip, row_stop, row_seconds, trip_offsets)
+        walk_offsets, walk_to, walk_seconds, change_seconds = build_footpaths(stop_table.index, stop_lat, stop_lon, self.transfers)
+
+        return {
+            'tt_routes': routes, 'tt_route_off': route_offsets, 'tt_route_span': route_spans,
+            'tt_services': services,
+            'tt_trip_ids': trip_ids, 'tt_trip_dir': trip_direction, 'tt_trip_service': trip_service,
+            'tt_trip_variant': trip_variant, 'tt_trip_start': trip_start, 'tt_trip_off': trip_offsets,
+            'tt_row_trip': row_trip, 'tt_row_stop': row_stop, 'tt_seconds': row_seconds, 'tt_row_seq': row_sequence,
+            'tt_stop_off': stop_offsets, 'tt_stop_rows': stop_rows,
+            'tt_var_shape': variant_shape, 'tt_var_off': variant_offsets, 'tt_var_dist': variant_dist,
+            'tt_stop_ids': stop_table, 'tt_stop_names': stop_names, 'tt_stop_lat': stop_lat, 'tt_stop_lon': stop_lon,
+            'tt_conn_rows': connections, 'tt_conn_dep': connection_departures, 'tt_conn_trip': connection_trips,
+            'tt_conn_from': connection_stops, 'tt_walk_off': walk_offsets, 'tt_walk_to': walk_to, 'tt_walk_sec': walk_seconds,
+            'tt_stop_change': change_seconds,
+            'tt_calendar': {'timezone': self.timezone, 'services': self.calendar, 'exceptions': self.exceptions},
+        }
+
+
+class Timetable:
+    """Read side of the timetable columns of a GTFS snapshot"""
+    def __init__(self, snapshot):
+        self.routes = snapshot.strings('tt_routes')
+        self.route_offsets = snapshot.array('tt_route_off', 'I')
+        self.route_spans = snapshot.array('tt_route_span', 'i')
+        self.services = snapshot.strings('tt_services')
+        self.trip_ids = snapshot.strings('tt_trip_ids')
+        self.trip_direction = snapshot.array('tt_trip_dir', 'i')
+        self.trip_service = snapshot.array('tt_trip_service', 'I')
+        self.trip_variant = snapshot.array('tt_trip_variant', 'I')
+        self.trip_start = snapshot.array('tt_trip_start', 'i')
+        self.trip_offsets = snapshot.array('tt_trip_off', 'I')
+        self.row_trip = snapshot.array('tt_row_trip', 'I')
+        self.row_stop = snapshot.array('tt_row_stop', 'I')
+        self.seconds = snapshot.array('tt_seconds', 'i')
+        self.row_sequence = snapshot.array('tt_row_seq', 'i')
+        self.stop_offsets = snapshot.array('tt_stop_off', 'I')
+        self.stop_rows = snapshot.array('tt_stop_rows', 'I')
+        self.variant_shape = snapshot.array('tt_var_shape', 'i')
+        self.variant_offsets = snapshot.array('tt_var_off', 'I')
+        self.variant_dist = snapshot.array('tt_var_dist', 'f')
+        self.stop_ids = snapshot.strings('tt_stop_ids')
+        self.stop_names = snapshot.strings('tt_stop_names')
+        self.stop_lat = snapshot.array('tt_stop_lat', 'd')
+        self.stop_lon = snapshot.array('tt_stop_lon', 'd')
+        calendar = snapshot.json('tt_calendar')
+        self.timezone = ZoneInfo(calendar['timezone'])
+        self.calendar = calendar['services']
+        self.exceptions = calendar['exceptions']
+        self._active = {}  # date -> set of active service indexes
+
+    def __len__(self):
+        return len(self.trip_start)
+
+    def now(self):
+        return datetime.datetime.now(self.timezone)
+
+    def active_services(self, day):
+        """Indexes of the services running on a date (calendar.txt, then calendar_dates.txt exceptions)"""
+        key = day.strftime('%Y%m%d')
+        active = self._active.get(key)
+        if active is None:
+            weekday = day.weekday()
+            active = set()
+            for position in range(len(self.services)):
+                service_id = self.services[position]
+                running = False
+                rule = self.calendar.get(service_id)
+                if rule is not None:
+                    days, start, end = rule
+                    running = days[weekday] == '1' and start <= key <= end
+                exception = self.exceptions.get(service_id, {}).get(key)
+                if exception is not None:
+                    running = exception == 1
+                if running:
+                    active.add(position)
+            if len(self._active) > 8:
+                self._active.clear()
+            self._active[key] = active
+        return active
+
+    def trip_route(self, trip):
+        """route_id of a trip index (trips are grouped by route)"""
+        return self.routes[bisect_right(self.route_offsets, trip) - 1]
+
+    def _row_stop(self, row, dist_m):
+        stop = self.row_stop[row]
+        return {'stop_id': self.stop_ids[stop], 'name': self.stop_names[stop], 'lat': self.stop_lat[stop],
+                'lon': self.stop_lon[stop], 'stop_sequence': self.row_sequence[row], 'dist_m': dist_m}
+
+    def trip_pattern(self, trip_id):
+        """[{'stop_id', 'stop_sequence', 'seconds'}] of a trip in stop order, or None if unknown"""
+        trip = self.trip_ids.position(trip_id)
+        if trip is None:
+            return None
+        return [{'stop_id': self.stop_ids[self.row_stop[row]], 'stop_sequence': self.row_sequence[row],
+                 'seconds': self.seconds[row]}
+                for row in range(self.trip_offsets[trip], self.trip_offsets[trip + 1])]
+
+    def next_departures(self, stop_id, when=None, horizon=3 * 3600, limit=None):
+        """
+        Trips leaving a stop within `horizon` seconds of `when` (default: now), soonest first:
+        [(seconds until departure, stop time row)]. A binary search in the stop's rows, which
+        are in departure order, for today's and for yesterday's after-midnight service.
+        """
+        stop = self.stop_ids.position(stop_id)
+        if stop is None:
+            return []
+        when = when or self.now()
+        first, last = self.stop_offsets[stop], self.stop_offsets[stop + 1]
+        departure = self.seconds.__getitem__
+        found = []
+        for days_back in (0, 1):
+            t = when.hour * 3600 + when.minute * 60 + when.second + days_back * 86400
+            services = self.active_services(when.date() - datetime.timedelta(days=days_back))
+            start = bisect_left(self.stop_rows, t, first, last, key=departure)
+            end = bisect_right(self.stop_rows, t + horizon, start, last, key=departure)
+            for i in range(start, end):
+                row = self.stop_rows[i]
+                if self.trip_service[self.row_trip[row]] in services and row + 1 < self.trip_offsets[self.row_trip[row] + 1]:
+                    found.append((departure(row) - t, row))  # the trip's last stop is an arrival, not a departure
+        found.sort()
+        return found[:limit] if limit is not None else found
+
+    def stop_departures(self, stop_id, when=None, horizon=3 * 3600, per_route=3):
+        """
+        Next departures at a stop grouped by route, each route capped at per_route:
+        {route_id: [{'trip_id', 'direction_id', 'stop_sequence', 'seconds', 'in_seconds'}]}
+        ('seconds' is the GTFS time of day, past 86400 for after-midnight trips)
+        """
+        by_route = {}
+        full = set()
+        for in_seconds, row in self.next_departures(stop_id, when, horizon):
+            trip = self.row_trip[row]
+            route_id = self.trip_route(trip)
+            if route_id in full:
+                continue
+            departures = by_route.setdefault(route_id, [])
+            departures.append({'trip_id': self.trip_ids[trip], 'direction_id': self.trip_direction[trip],
+                               'stop_sequence': self.row_sequence[row], 'seconds': self.seconds[row],
+                               'in_seconds': in_seconds})
+            if len(departures) >= per_route:
+                full.add(route_id)
+        return by_route
+
+    def stop_name(self, stop_id):
+        position = self.stop_ids.position(stop_id)
+        return self.stop_names[position] if position is not None else None
+
+    def running_trips(self, route_id, when=None):
+        """(trip index, seconds into its service day) of every trip of the route running at `when`"""
+        route = self.routes.position(route_id)
+        if route is None:
+            return []
+        when = when or self.now()
+        first, last = self.route_offsets[route], self.route_offsets[route + 1]
+        starts = self.trip_start
+        running = []
+        # Trips of yesterday's service day still running after midnight count as well
+        for days_back in (0, 1):
+            day = when.date() - datetime.timedelta(days=days_back)
+            t = when.hour * 3600 + when.minute * 60 + when.second + days_back * 86400
+            services = self.active_services(day)
+            # Trips are sorted by start, and none runs longer than the route's span
+            for trip in range(bisect_left(starts, t - self.route_spans[route], first, last),
+                              bisect_right(starts, t, first, last)):
+                if self.trip_service[trip] in services and self.seconds[self.trip_offsets[trip + 1] - 1] > t:
+                    running.append((trip, t))
+        return running
+
+    def scheduled_vehicles(self, route_id, when=None, track_for=None, id_prefix='sched_'):
+        """
+        Where the route's vehicles are according to the timetable at `when` (default: now).
+        track_for(shape_index) returns the ShapeTrack of one of the route's paths, or None.
+        Between two stops a vehicle is interpolated linearly in time along the shape.
+        """
+        vehicles = []
+        for trip, t in self.running_trips(route_id, when):
+            rows_start, rows_end = self.trip_offsets[trip], self.trip_offsets[trip + 1]
+            next_row = bisect_right(self.seconds, t, rows_start, rows_end)
+            if next_row == rows_start:
+                continue  # not departed yet
+            variant = self.trip_variant[trip]
+            base = self.variant_offsets[variant] - rows_start  # variant row of stop time row
+            from_stop = self._row_stop(next_row - 1, float(self.variant_dist[base + next_row - 1]))
+            next_stop = self._row_stop(next_row, float(self.variant_dist[base + next_row]))
+            departed, arrival = self.seconds[next_row - 1], self.seconds[next_row]
+            fraction = (t - departed) / (arrival - departed) if arrival > departed else 1.0
+            distance = from_stop['dist_m'] + fraction * (next_stop['dist_m'] - from_stop['dist_m'])
+
+            shape_index = self.variant_shape[variant]
+            track = track_for(shape_index) if track_for is not None and shape_index >= 0 else None
+            last_dist = float(self.variant_dist[self.variant_offsets[variant + 1] - 1])
+            vehicle = vehicle_between(from_stop, next_stop, distance, track, track.length_m if track else last_dist)
+            wait = max(0, round((arrival - t) / 60))
+            vehicle.update({
+                'id': f"{id_prefix}{self.trip_ids[trip]}",
+                'trip_id': self.trip_ids[trip],
+                'direction_id': self.trip_direction[trip],
+                'wait_time': wait,
+                'raw_message': f"{wait} min (scheduled)" if wait else "in arrivo (scheduled)",
+                'source': 'schedule'
+            })
+            vehicles.append(vehicle)
+        return vehicles
@@ -0,0 +1,210 @@
+# Lightweight request tracing: a tree of timed spans per request (the endpoint, each stop
+# fetch of a line fan-out, parsing, vehicle assembly), exported when the request ends and
+# kept in memory for the slowest recent requests. Outside a traced request every span is a
+# shared no-op object, so the instrumentation costs one context variable lookup.
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Share of the requests that are traced, the file finished traces are appended to as JSON
+# lines (none by default), and which of them are kept for /debug/trace and how many
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1'))
+TRACE_EXPORT_PATH = os.environ.get('TRACE_EXPORT_PATH', '')
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '250'))
+TRACE_KEEP = int(os.environ.get('TRACE_KEEP', '100'))
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start', 'end', 'attributes')
+
+    def __init__(self, trace, name, parent_id, start, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def child(self, name, start=None, **attributes):
+        return self.trace.add(Span(self.trace, name, self.span_id, time.time() if start is None else start, attributes))
+
+    def finish(self, end=None):
+        self.end = time.time() if end is None else end
+
+    def to_dict(self):
+        return {'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'start': self.start, 'duration_ms': round(((self.end or time.time()) - self.start) * 1000, 3),
+                'attributes': self.attributes}
+
+
+class _NoopSpan:
+    """Stands in for a span when the request is not traced: accepts everything, records nothing"""
+    trace = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def child(self, name, start=None, **attributes):
+        return self
+
+    def finish(self, end=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        # Spans from fetches still running after the request ended are dropped
+        with self._lock:
+            if not self.closed:
+                self.spans.append(span)
+        return span
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            return list(self.spans)
+
+    def to_dict(self, spans=None):
+        spans = self.spans if spans is None else spans
+        root = spans[0]
+        return {'trace_id': self.trace_id, 'name': root.name, 'start': root.start,
+                'duration_ms': round((root.end - root.start) * 1000, 3) if root.end else None,
+                'spans': [span.to_dict() for span in spans]}
+
+
+class JsonLinesExporter:
+    """Appends one JSON object per finished trace to a file, from a background thread"""
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def export(self, trace_dict):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-export', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trace_dict)
+        except queue.Full:
+            pass  # the disk can't keep up: drop traces rather than slow requests down
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                trace_dict = self._queue.get()
+                f.write(json.dumps(trace_dict, default=str, separators=(',', ':')) + '\n')
+                if self._queue.empty():
+                    f.flush()
+
+
+class Tracer:
+    """
+    start_trace() opens the root span of a request and makes it current; span() opens a child
+    of the current span, record() adds an already timed one under an explicit parent (for work
+    done on other threads). finish_trace() hands the trace to every exporter and keeps it for
+    /debug/trace if it took at least slow_ms.
+    """
+    def __init__(self, exporters=(), sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS, keep=TRACE_KEEP):
+        self.exporters = list(exporters)
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.keep = keep
+        self._recent = OrderedDict()  # trace_id -> trace dict, the slow ones only
+        self._lock = threading.Lock()
+
+    def start_trace(self, name, **attributes):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            _current_span.set(None)
+            return NOOP_SPAN
+        trace = Trace()
+        root = trace.add(Span(trace, name, None, time.time(), attributes))
+        _current_span.set(root)
+        return root
+
+    def current(self):
+        return _current_span.get() or NOOP_SPAN
+
+    @contextmanager
+    def span(self, name, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            yield NOOP_SPAN
+            return
+        span = parent.child(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            span.finish()
+            _current_span.reset(token)
+
+    def record(self, parent, name, start, end, **attributes):
+        if parent is None or parent.trace is None:
+            return
+        parent.child(name, start=start, **attributes).finish(end)
+
+    def finish_trace(self, root, **attributes):
+        _current_span.set(None)
+        if root.trace is None:
+            return
+        root.set(**attributes)
+        root.finish()
+        trace_dict = root.trace.to_dict(root.trace.close())
+        for exporter in self.exporters:
+            exporter.export(trace_dict)
+        if trace_dict['duration_ms'] >= self.slow_ms:
+            with self._lock:
+                self._recent[trace_dict['trace_id']] = trace_dict
+                while len(self._recent) > self.keep:
+                    self._recent.popitem(last=False)
+
+    def get(self, trace_id):
+        with self._lock:
+            return self._recent.get(trace_id)
+
+    def recent(self):
+        """Summaries of the kept slow traces, slowest first"""
+        with self._lock:
+            traces = list(self._recent.values())
+        traces.sort(key=lambda trace: trace['duration_ms'], reverse=True)
+        return [{'trace_id': trace['trace_id'], 'name': trace['name'], 'start': trace['start'],
+                 'duration_ms': trace['duration_ms'], 'spans': len(trace['spans']),
+                 'attributes': trace['spans'][0]['attributes']} for trace in traces]
+
+
+def span_tree(trace_dict):
+    """The spans of a trace as nested {'span', 'children'} dicts, children in start order"""
+    nodes = {span['span_id']: {**span, 'children': []} for span in trace_dict['spans']}
+    roots = []
+    for span in sorted(nodes.values(), key=lambda span: span['start']):
+        parent = nodes.get(span['parent_id'])
+        (parent['children'] if parent is not None else roots).append(span)
+    return roots
+
+
+tracer = Tracer([JsonLinesExporter(TRACE_EXPORT_PATH)] if TRACE_EXPORT_PATH else [])
@@ -0,0 +1,91 @@
+# Where the vehicles of a line are, inferred from the wait times announced at its stops
+from math import atan2, cos, degrees, radians
+
+# Average commercial speed (dwell times included) used to turn a wait into a distance, m/s
+AVERAGE_SPEEDS = {'METRO': 8.5, 'TRAM': 4.5, 'BUS': 4.0}
+# A vehicle announced at the first stop of a pattern is only shown if it is about to leave
+TERMINUS_MAX_WAIT = 1
+
+
+def _bearing(lat1, lon1, lat2, lon2):
+    return degrees(atan2((lon2 - lon1) * cos(radians(lat1)), lat2 - lat1)) % 360
+
+
+def infer_vehicles(pattern, stop_waits, track=None, speed_mps=AVERAGE_SPEEDS['BUS'], id_prefix=''):
+    """
+    Vehicles of one direction of a line.
+    pattern: a canonical stop pattern (see stop_patterns), stops in travel order with dist_m.
+    stop_waits: {stop_id: (minutes, raw message)} for the stops that announced this line.
+    track: the pattern's ShapeTrack, used for position and bearing; without it vehicles are
+    placed on the straight line between their two stops.
+
+    Walking the stops in order, a wait shorter than the one announced at the previous
+    stop can only come from a different vehicle, which has already passed that previous
+    stop: so a vehicle lies between every such pair, `wait * speed` meters before the stop
+    it is heading to. One pass over the stops, then a binary search on the shape per vehicle.
+    """
+    stops = pattern['stops']
+    route_length = track.length_m if track else (stops[-1]['dist_m'] if stops else 0.0)
+    vehicles = []
+    previous = None  # index of the last stop upstream with a known wait
+    for i, stop in enumerate(stops):
+        known = stop_waits.get(stop['stop_id'])
+        if known is None or known[0] is None:
+            continue
+        wait, raw_message = known
+        if previous is None:
+            # Nothing upstream to compare with: the vehicle is somewhere before this stop
+            is_vehicle = wait <= TERMINUS_MAX_WAIT if i == 0 else stop['dist_m'] - wait * 60 * speed_mps >= stops[0]['dist_m']
+            lower = stops[0]['dist_m']
+        else:
+            is_vehicle = wait < stop_waits[stops[previous]['stop_id']][0]
+            lower = stops[previous]['dist_m']
+        if is_vehicle:
+            vehicles.append(_place_vehicle(pattern, i, max(lower, stop['dist_m'] - wait * 60 * speed_mps),
+                                           previous, track, route_length, wait, raw_message, id_prefix))
+        previous = i
+    return vehicles
+
+
+def _place_vehicle(pattern, next_index, distance, previous_index, track, route_length, wait, raw_message, id_prefix):
+    stops = pattern['stops']
+    next_stop = stops[next_index]
+    from_stop = stops[previous_index if previous_index is not None else max(next_index - 1, 0)]
+    vehicle = vehicle_between(from_stop, next_stop, distance, track, route_length)
+    vehicle.update({
+        'id': f"{id_prefix}{pattern['direction_id']}_{next_stop['stop_id']}",
+        'direction_id': pattern['direction_id'],
+        'wait_time': wait,
+        'raw_message': raw_message,
+        'source': 'live'
+    })
+    return vehicle
+
+
+def vehicle_between(from_stop, next_stop, distance, track, route_length):
+    """
+    Position, bearing and progress of a vehicle distance meters along a pattern, on its way
+    from from_stop to next_stop (stops with 'stop_id', 'name', 'lat', 'lon', 'stop_sequence', 'dist_m')
+    """
+    span = next_stop['dist_m'] - from_stop['dist_m']
+    if track is not None and len(track) > 1:
+        lat, lon, bearing = track.point_at(distance)
+    else:
+        t = (distance - from_stop['dist_m']) / span if span > 0 else 1.0
+        lat = from_stop['lat'] + (next_stop['lat'] - from_stop['lat']) * t
+        lon = from_stop['lon'] + (next_stop['lon'] - from_stop['lon']) * t
+        bearing = _bearing(from_stop['lat'], from_stop['lon'], next_stop['lat'], next_stop['lon']) if span > 0 else 0.0
+    return {
+        'lat': lat,
+        'lon': lon,
+        'bearing': round(bearing, 1),
+        'distance_m': round(distance, 1),
+        # Share of the way from the previous stop to the next one, and along the whole pattern
+        'progress': round((distance - from_stop['dist_m']) / span, 3) if span > 0 else 1.0,
+        'route_progress': round(distance / route_length, 3) if route_length > 0 else 0.0,
+        'previous_stop_id': from_stop['stop_id'] if from_stop is not next_stop else None,
+        'next_stop': {key: next_stop[key] for key in ('stop_id', 'name', 'lat', 'lon')},
+        'stop_id': next_stop['stop_id'],
+        'stop_name': next_stop['name'],
+        'sequence': next_stop['stop_sequence']
+    }
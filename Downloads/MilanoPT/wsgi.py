@@ -0,0 +1,22 @@
+# Production entry point:  gunicorn -c gunicorn.conf.py wsgi:app
+#
+# gunicorn imports this module once in the master (preload_app) and then forks the workers,
+# so the GTFS snapshot is mapped, the indexes are built and every /track_line payload is
+# compressed a single time and shared copy-on-write by all of them. The snapshot itself is
+# a read-only mmap of gtfs_snapshot.bin, so its pages live once in the page cache whatever
+# the number of processes.
+import gc
+import os
+
+# Warm the /track_line payloads here, in the master, rather than in a thread of each worker
+os.environ.setdefault('TRACK_LINE_WARMUP', 'off')
+
+import FINAL
+
+app = FINAL.create_app('eager')
+if os.environ['TRACK_LINE_WARMUP'] == 'off':
+    FINAL.warm_track_line_payloads()
+
+# Everything loaded so far lives as long as the process: move it out of the collector's
+# reach so collections in the workers don't write to (and so copy) the shared pages
+gc.freeze()